@@ -1,79 +1,377 @@
 import logging
 import requests
 import os
+import time
+from datetime import datetime
 
-import music_tag
 from orator import Model
 from persiantools import digits
-from telegram.error import TelegramError
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import Updater, CallbackContext, CommandHandler, MessageHandler, Filters, \
-     Defaults, PicklePersistence
-from telegram import Update, ReplyKeyboardMarkup, ChatAction, ParseMode, ReplyKeyboardRemove
+     Defaults, ContextTypes
+from telegram import Bot, Update, ReplyKeyboardMarkup, ChatAction, ParseMode, ReplyKeyboardRemove
 from telegram import ( 
     ReplyKeyboardMarkup, 
 )
 
 import localization as lp
 from utils import translate_key_to, reset_user_data_context, generate_start_over_keyboard, convert_seconds_to_human_readable_form, \
-create_user_directory, download_file, generate_back_button_keyboard, increment_usage_counter_for_user, delete_file, \
+create_user_directory, download_file, download_path_for, ensure_downloaded, generate_back_button_keyboard, increment_usage_counter_for_user, delete_file, \
 generate_module_selector_keyboard, generate_module_selector_video_keyboard, generate_tag_editor_keyboard, \
 generate_music_info, generate_tag_editor_video_keyboard, generate_module_selector_voice_keyboard, save_tags_to_file, \
-ffmpegcommand, myffmpegcommand, video_to_gif, generate_module_setting_keyboard, generate_module_coin_pay, \
-save_text_into_tag, parse_cutting_range
-
-from models.user import User
-from dbConfig import db
+ffmpegcommand, myffmpegcommand, generate_module_setting_keyboard, generate_module_coin_pay, \
+save_text_into_tag, parse_cutting_range, read_music_tags, cache_music_tags, cached_music_tags
+from utils.dispatch import UserSerialDispatcher
+from utils.executor import TranscodeExecutor
+from utils.aio import run_blocking
+from utils.blobs import BLOB_COLLECT_INTERVAL, blobs
+from utils.ffmpeg import FFmpegResult, run_ffmpeg_async
+from utils.output_cache import OUTPUT_CACHE_RESCAN_INTERVAL, cache_key, output_cache
+from utils.profiles import ANIMATION, MP3_AUDIO, VIDEO_NOTE, VOICE_NOTE, TranscodeProfile, output_path_for, transcode
+from utils.persistence import PERSISTENCE_FLUSH_INTERVAL, USER_DATA_EVICT_INTERVAL, create_persistence
+from utils.session import Module, TagEditor, UserSession
+from utils.sharding import LocalWorkerPool, ShardRouter, SHARD_WORKERS, SHARD_WORKER_URLS, runs_global_jobs, \
+    shard_suffix
+from utils.webhook import PaymentServer, UpdateIntake, dispatcher_consumer, serve_webhook
+
+from repositories.admin import admins
+from repositories.export import EXPORTS, export_csv
+from repositories.ledger import COIN_COST_PER_JOB, LEDGER_FLUSH_INTERVAL, LEDGER_RECONCILE_INTERVAL, \
+    handle_payment_callback, ledger
+from repositories.stats import stats
+from repositories.uploads import uploads
+from repositories.usage import USAGE_EVENT_FLUSH_INTERVAL, USAGE_ROLLUP_INTERVAL, usage
+from repositories.user import USAGE_FLUSH_INTERVAL, users
+from dbConfig import db, DB_POOL_METRICS_INTERVAL
 
 Model.set_connection_resolver(db)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
+BOT_MODE = os.getenv("BOT_MODE") if os.getenv("BOT_MODE") else 'polling'
 
 logger = logging.getLogger()
 
+transcode_executor = TranscodeExecutor()
+update_dispatcher = UserSerialDispatcher()
+
+def submit_media_job(
+    message,
+    lang: str,
+    job,
+    on_done,
+    operation: str = 'media',
+    input_path: str = '',
+    duration: int = 0,
+    output_key: str = '',
+    output_path: str = '',
+    prepare=None,
+    upload_key: str = ''
+) -> None:
+    """Hand a media job over to `transcode_executor` so the dispatcher thread returns
+    immediately. `on_done` is called with the job's result once it finishes, in the
+    user's mailbox so it never races with the user's next update.
+
+    Every job is logged as a usage event, rejected ones included. Jobs cost
+    `COIN_COST_PER_JOB` coins, which are given back if the job doesn't succeed.
+
+    Jobs with an `output_key` are looked up in `output_cache` first: on a hit the cached
+    output is put at `output_path` and `on_done` is called right away, without running
+    `prepare` or the job. Otherwise their output is cached once the job succeeded. Jobs
+    whose output was uploaded before under `upload_key` don't even need the output, see
+    `send_output`.
+
+    A job identical to one in flight, by its `output_key` or else its `upload_key`, isn't
+    run but shares the result of the job in flight, taking the output from the cache.
+
+    **Keyword arguments:**
+     - message (Message) -- The message to reply to if the job can't be accepted
+     - lang (str) -- The language of the user
+     - job (callable) -- A coroutine function doing the media work, usually an ffmpeg call
+     - on_done (callable) -- The completion callback doing the upload
+     - operation (str) -- The name of the operation in the usage events
+     - input_path (str) -- The file the job processes, for the usage events
+     - duration (int) -- The duration of the processed media in seconds
+     - output_key (str) -- The `cache_key` of the job's output
+     - output_path (str) -- The file the job writes its output to
+     - prepare (callable) -- Called before the job is submitted, e.g. to download its input;
+       returns `False` if the job can't run
+     - upload_key (str) -- The `cache_key` the output is recorded under in `uploads`
+    """
+    user_id = message.from_user.id if message.from_user else message.chat_id
+
+    if COIN_COST_PER_JOB and not ledger.debit(user_id, COIN_COST_PER_JOB):
+        message.reply_text(
+            translate_key_to(lp.ERR_NOT_ENOUGH_COINS, lang),
+            reply_markup=generate_start_over_keyboard(lang)
+        )
+        return
+
+    if upload_key and uploads.file_id(upload_key) or output_key and output_cache.fetch(output_key, output_path):
+        usage.record(user_id, operation, 'cached', 0, duration)
+        on_done(FFmpegResult([], 0, '', 0.0))
+        return
+
+    if prepare is not None and not prepare():
+        ledger.refund(user_id, COIN_COST_PER_JOB)
+        return
+
+    input_size = os.path.getsize(input_path) if input_path and os.path.exists(input_path) else 0
+    ran = False
+
+    async def held_job():
+        nonlocal ran
+        ran = True
+        started_at = time.monotonic()
+
+        try:
+            result = await job()
+        except BaseException:
+            usage.record(user_id, operation, 'error', input_size, duration, _elapsed_ms(started_at))
+            ledger.refund(user_id, COIN_COST_PER_JOB)
+            raise
+
+        outcome = 'ok' if result.ok else 'timeout' if result.timed_out else 'failed'
+        usage.record(user_id, operation, outcome, input_size, duration, _elapsed_ms(started_at))
+        if not result.ok:
+            ledger.refund(user_id, COIN_COST_PER_JOB)
+        elif output_key:
+            await run_blocking(output_cache.store, output_key, output_path)
+
+        return result
+
+    def on_shared(result) -> None:
+        # `None` if the job in flight raised
+        if result is not None and result.ok and output_key and not output_cache.fetch(output_key, output_path):
+            result = None
+        if result is None:
+            result = FFmpegResult([], -1, '', 0.0)
+
+        usage.record(user_id, operation, 'shared' if result.ok else 'failed', input_size, duration)
+        if not result.ok:
+            ledger.refund(user_id, COIN_COST_PER_JOB)
+
+        on_done(result)
+
+    def on_failed(_) -> None:
+        # The job raised, it was recorded and refunded already
+        on_done(FFmpegResult([], -1, '', 0.0))
+
+    def post_to_mailbox(result) -> None:
+        if not ran:
+            callback = on_shared
+        else:
+            callback = on_done if result is not None else on_failed
+
+        try:
+            update_dispatcher.post(user_id, callback, result)
+        finally:
+            update_dispatcher.release(user_id)
+
+    # Keeps the user's data in memory until `on_done` got hold of it
+    update_dispatcher.hold(user_id)
+
+    if not transcode_executor.submit(held_job, post_to_mailbox, key=output_key or upload_key or None):
+        update_dispatcher.release(user_id)
+        usage.record(user_id, operation, 'rejected', input_size, duration)
+        ledger.refund(user_id, COIN_COST_PER_JOB)
+        message.reply_text(
+            translate_key_to(lp.ERR_SERVER_BUSY, lang),
+            reply_markup=generate_start_over_keyboard(lang)
+        )
+
+def convert_video(
+    message,
+    context: CallbackContext,
+    profile: TranscodeProfile,
+    operation: str,
+    send,
+    media: str
+) -> None:
+    """Encode the user's video with `profile` and send the result with `send`.
+
+    **Keyword arguments:**
+     - message (Message) -- The message to reply to
+     - context (CallbackContext) -- The context object of the user
+     - profile (TranscodeProfile) -- How the video is encoded
+     - operation (str) -- The name of the operation in the usage events
+     - send (callable) -- The send method, e.g. `message.reply_video_note`
+     - media (str) -- The name of its file argument, e.g. `video_note`
+    """
+    user_data = context.user_data
+    lang = user_data.language
+    video_path = user_data.video_path
+    video_unique_id = user_data.video_unique_id
+    output_path = output_path_for(video_path, profile)
+    output_key = cache_key(video_unique_id, operation, profile.output_args) if video_unique_id else ''
+
+    start_over_button_keyboard = generate_start_over_keyboard(lang)
+    reply_to_message_id = message.message_id
+
+    def upload(result: FFmpegResult) -> None:
+        if not result.ok:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+            delete_file(output_path)
+            return
+
+        try:
+            send_output(
+                send,
+                media,
+                output_path,
+                upload_key=output_key,
+                output_key=output_key,
+                reply_to_message_id=reply_to_message_id,
+                reply_markup=start_over_button_keyboard,
+            )
+        except (TelegramError, BaseException) as error:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+            logger.exception("Telegram error: %s", error)
+
+        delete_file(output_path)
+
+        if user_data.video_path == video_path:
+            reset_user_data_context(context)
+
+    submit_media_job(
+        message,
+        lang,
+        lambda: transcode(profile, video_path, output_path, video_unique_id),
+        upload,
+        operation=operation,
+        input_path=video_path,
+        duration=user_data.video_duration,
+        output_key=output_key,
+        output_path=output_path,
+        upload_key=output_key
+    )
+
+def send_output(
+    send,
+    media: str,
+    output_path: str,
+    upload_key: str = '',
+    output_key: str = '',
+    before_upload=None,
+    **kwargs
+):
+    """Send an output with one of the bot's send methods, by its `file_id` if it was
+    uploaded before, so identical outputs are only ever uploaded once.
+
+    If Telegram doesn't accept the recorded `file_id` anymore, the output is uploaded
+    after all, taken from `output_cache` if it isn't on disk.
+
+    **Keyword arguments:**
+     - send (callable) -- The send method, e.g. `context.bot.send_audio`
+     - media (str) -- The name of its file argument, e.g. `audio`
+     - output_path (str) -- The file to upload
+     - upload_key (str) -- The `cache_key` the output is recorded under in `uploads`
+     - output_key (str) -- The `cache_key` of the output in `output_cache`
+     - before_upload (callable) -- Called before the file is uploaded, e.g. to write its tags
+
+    **Returns:**
+     The sent message
+    """
+    file_id = uploads.file_id(upload_key) if upload_key else None
+
+    if file_id is not None:
+        try:
+            return send(**{media: file_id}, **kwargs)
+        except BadRequest:
+            logger.warning("Telegram doesn't accept the file_id of %s anymore", upload_key, exc_info=True)
+            uploads.forget(upload_key)
+
+        if not os.path.exists(output_path) and not (output_key and output_cache.fetch(output_key, output_path)):
+            raise FileNotFoundError(f"The output {upload_key} is neither uploaded nor cached")
+
+    if before_upload is not None:
+        before_upload()
+
+    with open(output_path, 'rb') as output_file:
+        sent = send(**{media: output_file}, **kwargs)
+
+    attachment = getattr(sent, media)
+    if upload_key and attachment is not None:
+        uploads.remember(upload_key, attachment.file_id)
+
+    return sent
+
+def download_input(message, context: CallbackContext, kind: str) -> bool:
+    """Download the user's current music or voice, which is only downloaded once an
+    operation needs it, and tell the user if that fails.
+
+    **Keyword arguments:**
+     - message (Message) -- The message to reply to if the download fails
+     - context (CallbackContext) -- The context object of the user
+     - kind (str) -- Either 'music' or 'voice'
+
+    **Returns:**
+     Whether the file is there
+    """
+    user_data = context.user_data
+    lang = user_data.language
+
+    try:
+        ensure_downloaded(
+            getattr(user_data, f"{kind}_file_id"),
+            getattr(user_data, f"{kind}_unique_id"),
+            getattr(user_data, f"{kind}_path"),
+            context
+        )
+    except (ValueError, BaseException):
+        message.reply_text(
+            translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, lang),
+            reply_markup=generate_start_over_keyboard(lang)
+        )
+        logger.error("Error on downloading %s's file. File type: %s", message.chat_id, kind, exc_info=True)
+        return False
+
+    return True
+
+def _elapsed_ms(started_at: float) -> int:
+    return int((time.monotonic() - started_at) * 1000)
+
 def command_start(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
     username = update.effective_user.username
 
     reset_user_data_context(context)
 
-    user = User.where('user_id', '=', user_id).first()
+    users.upsert(user_id, username)
 
     update.message.reply_text(
-        translate_key_to(lp.START_MESSAGE, context.user_data['language']),
+        translate_key_to(lp.START_MESSAGE, context.user_data.language),
         reply_markup=ReplyKeyboardRemove()
     )
 
     show_language_keyboard(update, context)
 
-    if not user:
-        new_user = User()
-        new_user.user_id = user_id
-        new_user.username = username
-        new_user.number_of_files_sent = 0
-
-        new_user.save()
-
-        logger.info("A user with id %s has been started to use the bot.", user_id)
+    logger.info("A user with id %s has started using the bot.", user_id)
 
 def start_over(update: Update, context: CallbackContext) -> None:
     reset_user_data_context(context)
 
     update.message.reply_text(
-        translate_key_to(lp.START_OVER_MESSAGE, context.user_data['language']),
+        translate_key_to(lp.START_OVER_MESSAGE, context.user_data.language),
         reply_to_message_id=update.effective_message.message_id,
         reply_markup=ReplyKeyboardRemove()
     )
 
 def command_help(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text(translate_key_to(lp.HELP_MESSAGE, context.user_data['language']))
+    update.message.reply_text(translate_key_to(lp.HELP_MESSAGE, context.user_data.language))
 
 def command_about(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text(translate_key_to(lp.ABOUT_MESSAGE, context.user_data['language']))
+    update.message.reply_text(translate_key_to(lp.ABOUT_MESSAGE, context.user_data.language))
 
 def command_setting(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    language = user_data['language']
+    language = user_data.language
 
     update.message.reply_text(
         translate_key_to(lp.START_OVER_MESSAGE, language),
@@ -101,19 +399,17 @@ def set_language(update: Update, context: CallbackContext) -> None:
     user_id = update.effective_user.id
 
     if "english" in lang:
-        user_data['language'] = 'en'
+        user_data.language = 'en'
     elif "فارسی" in lang:
-        user_data['language'] = 'fa'
+        user_data.language = 'fa'
 
-    update.message.reply_text(translate_key_to(lp.LANGUAGE_CHANGED, user_data['language']))
+    update.message.reply_text(translate_key_to(lp.LANGUAGE_CHANGED, user_data.language))
     update.message.reply_text(
-        translate_key_to(lp.START_OVER_MESSAGE, user_data['language']),
+        translate_key_to(lp.START_OVER_MESSAGE, user_data.language),
         reply_markup=ReplyKeyboardRemove()
     )
 
-    user = User.where('user_id', '=', user_id).first()
-    user.language = user_data['language']
-    user.push()
+    users.update(user_id, language=user_data.language)
 
 def handle_voice_message(update: Update, context: CallbackContext) -> None:
     message = update.message
@@ -121,10 +417,10 @@ def handle_voice_message(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     voice_duration = message.voice.duration
     voice_file_size = message.voice.file_size
-    old_voice_path = user_data['voice_path']
-    old_art_path = user_data['voice_art_path']
-    old_new_art_path = user_data['new_voice_art_path']
-    language = user_data['language']
+    old_voice_path = user_data.voice_path
+    old_art_path = user_data.voice_art_path
+    old_new_art_path = user_data.new_voice_art_path
+    language = user_data.language
 
     if voice_duration >= 3600 and voice_file_size > 48000000:
         message.reply_text(
@@ -145,50 +441,21 @@ def handle_voice_message(update: Update, context: CallbackContext) -> None:
         logger.error("Couldn't create directory for user %s", user_id, exc_info=True)
         return
 
-    try:
-        file_download_path = download_file(
-            user_id=user_id,
-            file_to_download=message.voice,
-            file_type='voice',
-            context=context
-        )
-    except ValueError:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error("Error on downloading %s's file. File type: Audio", user_id, exc_info=True)
-        return
-
-    try:
-        music = music_tag.load_file(file_download_path)
-    except (OSError, NotImplementedError):
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_READING_TAGS, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error(
-            "Error on reading the tags %s's file. File path: %s",
-            user_id,
-            file_download_path,
-            exc_info=True
-        )
-        return
+    # Downloaded once an operation needs it, see `download_input`
+    file_download_path = download_path_for(user_id, message.voice, 'voice')
 
     reset_user_data_context(context)
 
-    user_data['voice_path'] = file_download_path
-    user_data['art_path'] = ''
-    user_data['voice_message_id'] = message.message_id
-    user_data['voice_duration'] = message.voice.duration
+    user_data.voice_path = file_download_path
+    user_data.voice_file_id = message.voice.file_id
+    user_data.voice_unique_id = message.voice.file_unique_id
+    user_data.art_path = ''
+    user_data.voice_message_id = message.message_id
+    user_data.voice_duration = message.voice.duration
 
     show_module_selector_voice(update, context)
 
-    increment_usage_counter_for_user(user_id=user_id)
-
-    user = User.where('user_id', '=', user_id).first()
-    user.username = update.effective_user.username
-    user.push()
+    increment_usage_counter_for_user(user_id, update.effective_user.username)
 
     delete_file(old_voice_path)
     delete_file(old_art_path)
@@ -200,10 +467,10 @@ def handle_music_message(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     music_duration = message.audio.duration
     music_file_size = message.audio.file_size
-    old_music_path = user_data['music_path']
-    old_art_path = user_data['art_path']
-    old_new_art_path = user_data['new_art_path']
-    language = user_data['language']
+    old_music_path = user_data.music_path
+    old_art_path = user_data.art_path
+    old_new_art_path = user_data.new_art_path
+    language = user_data.language
 
     if music_duration >= 3600 and music_file_size > 48000000:
         message.reply_text(
@@ -224,74 +491,68 @@ def handle_music_message(update: Update, context: CallbackContext) -> None:
         logger.error("Couldn't create directory for user %s", user_id, exc_info=True)
         return
 
-    try:
-        file_download_path = download_file(
-            user_id=user_id,
-            file_to_download=message.audio,
-            file_type='audio',
-            context=context
-        )
-    except ValueError:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error("Error on downloading %s's file. File type: Audio", user_id, exc_info=True)
-        return
+    file_download_path = download_path_for(user_id, message.audio, 'audio')
+    cached_tags = cached_music_tags(message.audio.file_unique_id)
 
-    try:
-        music = music_tag.load_file(file_download_path)
-    except (OSError, NotImplementedError):
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_READING_TAGS, language),
-            reply_markup=generate_start_over_keyboard(language)
-        )
-        logger.error(
-            "Error on reading the tags %s's file. File path: %s",
-            user_id,
-            file_download_path,
-            exc_info=True
-        )
-        return
+    if cached_tags is not None:
+        # Sent before, so it's only downloaded once an operation needs it
+        tags, art = cached_tags
+    else:
+        try:
+            ensure_downloaded(
+                message.audio.file_id,
+                message.audio.file_unique_id,
+                file_download_path,
+                context,
+                force=True
+            )
+        except (ValueError, BaseException):
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, language),
+                reply_markup=generate_start_over_keyboard(language)
+            )
+            logger.error("Error on downloading %s's file. File type: Audio", user_id, exc_info=True)
+            return
 
-    reset_user_data_context(context)
+        try:
+            tags, art = read_music_tags(file_download_path)
+        except (OSError, NotImplementedError):
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_READING_TAGS, language),
+                reply_markup=generate_start_over_keyboard(language)
+            )
+            logger.error(
+                "Error on reading the tags %s's file. File path: %s",
+                user_id,
+                file_download_path,
+                exc_info=True
+            )
+            return
+
+        cache_music_tags(message.audio.file_unique_id, tags, art)
 
-    user_data['music_path'] = file_download_path
-    user_data['art_path'] = ''
-    user_data['music_message_id'] = message.message_id
-    user_data['music_duration'] = message.audio.duration
+    reset_user_data_context(context)
 
-    tag_editor_context = user_data['tag_editor']
+    user_data.music_path = file_download_path
+    user_data.music_file_id = message.audio.file_id
+    user_data.music_unique_id = message.audio.file_unique_id
+    user_data.art_path = ''
+    user_data.music_message_id = message.message_id
+    user_data.music_duration = message.audio.duration
 
-    artist = music['artist']
-    title = music['title']
-    album = music['album']
-    genre = music['genre']
-    art = music['artwork']
-    year = music.raw['year']
-    disknumber = music.raw['disknumber']
-    tracknumber = music.raw['tracknumber']
+    tag_editor_context = user_data.tag_editor
 
     if art:
-        art_path = user_data['art_path'] = f"{file_download_path}.jpg"
+        art_path = user_data.art_path = f"{file_download_path}.jpg"
         with open(art_path, 'wb') as art_file:
-            art_file.write(art.first.data)
+            art_file.write(art)
 
-    tag_editor_context['artist'] = str(artist)
-    tag_editor_context['title'] = str(title)
-    tag_editor_context['album'] = str(album)
-    tag_editor_context['genre'] = str(genre)
-    tag_editor_context['year'] = str(year)
-    tag_editor_context['disknumber'] = str(disknumber)
-    tag_editor_context['tracknumber'] = str(tracknumber)
+    for name, value in tags.items():
+        setattr(tag_editor_context, name, value)
 
     show_module_selector(update, context)
 
-    increment_usage_counter_for_user(user_id=user_id)
-
-    user = User.where('user_id', '=', user_id).first()
-    user.username = update.effective_user.username
-    user.push()
+    increment_usage_counter_for_user(user_id, update.effective_user.username)
 
     delete_file(old_music_path)
     delete_file(old_art_path)
@@ -301,15 +562,15 @@ def handle_photo_message(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     message = update.message
     user_id = update.effective_user.id
-    music_path = user_data['music_path']
-    current_active_module = user_data['current_active_module']
-    current_tag = user_data['tag_editor']['current_tag']
-    lang = user_data['language']
+    music_path = user_data.music_path
+    current_active_module = user_data.current_module
+    current_tag = user_data.tag_editor.current_tag
+    lang = user_data.language
 
     tag_editor_keyboard = generate_tag_editor_keyboard(lang)
 
     if music_path:
-        if current_active_module == 'tag_editor':
+        if current_active_module == Module.TAG_EDITOR:
             if not current_tag or current_tag != 'album_art':
                 reply_message = translate_key_to(lp.ASK_WHICH_TAG, lang)
                 message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
@@ -325,8 +586,8 @@ def handle_photo_message(update: Update, context: CallbackContext) -> None:
                                     f"{translate_key_to(lp.CLICK_PREVIEW_MESSAGE, lang)} " \
                                     f"{translate_key_to(lp.OR, lang).upper()} " \
                                     f"{translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
-                    user_data['new_art_path'] = file_download_path
-                    user_data['edit_tag_music'] = True
+                    user_data.new_art_path = file_download_path
+                    user_data.edit_tag_music = True
                     message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
                 except (ValueError, BaseException):
                     message.reply_text(translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, lang))
@@ -346,8 +607,8 @@ def handle_video_message(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     video_duration = message.video.duration
     video_file_size = message.video.file_size
-    old_video_path = user_data['video_path']
-    language = user_data['language']
+    old_video_path = user_data.video_path
+    language = user_data.language
 
     if video_duration >= 3600 and video_file_size > 48000000:
         message.reply_text(
@@ -400,24 +661,21 @@ def handle_video_message(update: Update, context: CallbackContext) -> None:
 
     reset_user_data_context(context)
 
-    user_data['video_path'] = file_download_path
-    user_data['video_message_id'] = message.message_id
-    user_data['video_duration'] = message.video.duration
+    user_data.video_path = file_download_path
+    user_data.video_unique_id = message.video.file_unique_id
+    user_data.video_message_id = message.message_id
+    user_data.video_duration = message.video.duration
 
     show_module_selector_video(update, context)
 
-    increment_usage_counter_for_user(user_id=user_id)
-
-    user = User.where('user_id', '=', user_id).first()
-    user.username = update.effective_user.username
-    user.push()
+    increment_usage_counter_for_user(user_id, update.effective_user.username)
 
     delete_file(old_video_path)
 
 def show_module_selector_video(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    context.user_data['current_active_module'] = ''
-    lang = user_data['language']
+    context.user_data.current_module = Module.NONE
+    lang = user_data.language
 
     module_selector_keyboard = generate_module_selector_video_keyboard(lang)
 
@@ -429,8 +687,8 @@ def show_module_selector_video(update: Update, context: CallbackContext) -> None
 
 def show_module_selector_voice(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    context.user_data['current_active_module'] = ''
-    lang = user_data['language']
+    context.user_data.current_module = Module.NONE
+    lang = user_data.language
 
     module_selector_keyboard = generate_module_selector_voice_keyboard(lang)
 
@@ -445,7 +703,7 @@ def handle_download_message(update: Update, context: CallbackContext) -> None:
     url = message.text
     user_id = update.effective_user.id
     user_data = context.user_data
-    lang = user_data['language']
+    lang = user_data.language
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
     response = requests.get(url)
@@ -482,13 +740,13 @@ def handle_convert_video_message(update: Update, context: CallbackContext) -> No
     message = update.message
     user_id = update.effective_user.id
     user_data = context.user_data
-    video_path = user_data['video_path']
-    lang = user_data['language']
+    video_path = user_data.video_path
+    lang = user_data.language
 
-    user_data['current_active_module'] = 'tag_editor'
+    user_data.current_module = Module.TAG_EDITOR
 
-    tag_editor_context = user_data['tag_editor']
-    tag_editor_context['current_tag'] = ''
+    tag_editor_context = user_data.tag_editor
+    tag_editor_context.current_tag = ''
 
     tag_editor_keyboard = generate_tag_editor_video_keyboard(lang)
 
@@ -510,8 +768,8 @@ def handle_convert_video_message(update: Update, context: CallbackContext) -> No
                             f"{translate_key_to(lp.CLICK_PREVIEW_MESSAGE, lang)} " \
                             f"{translate_key_to(lp.OR, lang).upper()} " \
                             f"{translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
-            user_data['video_path'] = video_path
-            user_data['convert_video_to_circle'] = True
+            user_data.video_path = video_path
+            user_data.convert_video_to_circle = True
             message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
         except (ValueError, BaseException):
             message.reply_text(translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, lang))
@@ -532,15 +790,15 @@ def handle_convert_video_to_gif_message(update: Update, context: CallbackContext
     message = update.message
     user_id = update.effective_user.id
     user_data = context.user_data
-    video_path = user_data['video_path']
-    lang = user_data['language']
+    video_path = user_data.video_path
+    lang = user_data.language
 
-    user_data['current_active_module'] = 'tag_editor'
+    user_data.current_module = Module.TAG_EDITOR
 
-    tag_editor_context = user_data['tag_editor']
-    tag_editor_context['current_tag'] = ''
+    tag_editor_context = user_data.tag_editor
+    tag_editor_context.current_tag = ''
 
-    user_data['convert_video_to_gif'] = True
+    user_data.convert_video_to_gif = True
 
     tag_editor_keyboard = generate_tag_editor_video_keyboard(lang)
 
@@ -562,8 +820,8 @@ def handle_convert_video_to_gif_message(update: Update, context: CallbackContext
                             f"{translate_key_to(lp.CLICK_PREVIEW_MESSAGE, lang)} " \
                             f"{translate_key_to(lp.OR, lang).upper()} " \
                             f"{translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
-            user_data['video_path'] = video_path
-            user_data['convert_video_to_gif'] = True
+            user_data.video_path = video_path
+            user_data.convert_video_to_gif = True
             message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
         except (ValueError, BaseException):
             message.reply_text(translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, lang))
@@ -588,15 +846,20 @@ def handle_convert_voice_message(update: Update, context: CallbackContext) -> No
     )
 
     user_data = context.user_data
-    input_voice_path = user_data['voice_path']
-    music_path = f"{user_data['voice_path']}.mp3"
-    lang = user_data['language']
-    # user_data['current_active_module'] = 'mp3_to_voice_converter'  # TODO: Make modules a dict
+    input_voice_path = user_data.voice_path
+    music_path = output_path_for(input_voice_path, MP3_AUDIO)
+    lang = user_data.language
+    # user_data.current_module = Module.MUSIC_TO_VOICE_CONVERTER
 
     # logging.error(input_voice_path)
     # logging.error(music_path)
 
-    os.system(f"ffmpeg -i {input_voice_path} -map_metadata 0:s:0 {music_path}")
+    start_over_button_keyboard = generate_start_over_keyboard(lang)
+    music_duration = user_data.music_duration
+    music_message_id = user_data.music_message_id
+    voice_unique_id = user_data.voice_unique_id
+    output_key = cache_key(voice_unique_id, 'voice_to_music', MP3_AUDIO.output_args) if voice_unique_id else ''
+
     # os.system(["ffmpeg", "-n", "-i", input_voice_path, "-acodec", "libmp3lame", "-ab", "128k", music_path])
 
     # os.system(
@@ -606,41 +869,66 @@ def handle_convert_voice_message(update: Update, context: CallbackContext) -> No
     # os.system(f"ffmpeg -i {input_voice_path} -c:a libvorbis -q:a 4 {music_path}")
 
     # os.system(f"ffmpeg -i {input_voice_path} -c:a aac libmp3lame -q:a 4 {music_path}")
-    # voice_path = user_data['voice_path']
+    # voice_path = user_data.voice_path
 
     # myffmpegcommand(voice_path, user_data)
 
-    # lang = user_data['language']
+    # lang = user_data.language
 
-    start_over_button_keyboard = generate_start_over_keyboard(lang)
+    def upload(result: FFmpegResult) -> None:
+        if not result.ok:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+            delete_file(music_path)
+            return
 
-    context.bot.send_chat_action(
-        chat_id=update.message.chat_id,
-        action=ChatAction.UPLOAD_AUDIO
-    )
+        context.bot.send_chat_action(
+            chat_id=message.chat_id,
+            action=ChatAction.UPLOAD_AUDIO
+        )
 
-    try:
-        with open(music_path, 'rb') as music_file:
-            context.bot.send_audio(
-                audio=music_file,
-                duration=user_data['music_duration'],
+        try:
+            send_output(
+                context.bot.send_audio,
+                'audio',
+                music_path,
+                upload_key=output_key,
+                output_key=output_key,
+                duration=music_duration,
                 chat_id=message.chat_id,
                 caption=f"🆔 {BOT_USERNAME}",
                 reply_markup=start_over_button_keyboard,
-                reply_to_message_id=user_data['music_message_id']
+                reply_to_message_id=music_message_id
             )
-    except TelegramError as error:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_UPLOADING, lang),
-            reply_markup=start_over_button_keyboard
-        )
-        logger.exception("Telegram error: %s", error)
+        except (TelegramError, OSError) as error:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+            logger.exception("Telegram error: %s", error)
 
-    delete_file(music_path)
+        delete_file(music_path)
 
-    reset_user_data_context(context)
+        if user_data.voice_path == input_voice_path:
+            reset_user_data_context(context)
+
+    submit_media_job(
+        message,
+        lang,
+        lambda: transcode(MP3_AUDIO, input_voice_path, music_path, voice_unique_id),
+        upload,
+        operation='voice_to_music',
+        input_path=input_voice_path,
+        duration=music_duration,
+        output_key=output_key,
+        output_path=music_path,
+        prepare=lambda: download_input(message, context, 'voice'),
+        upload_key=output_key
+    )
 
-    # new_voice_path = user_data['new_voice_art_path']
+    # new_voice_path = user_data.new_voice_art_path
 
     # start_over_button_keyboard = generate_start_over_keyboard(lang)
 
@@ -663,13 +951,13 @@ def handle_convert_voice_message(update: Update, context: CallbackContext) -> No
     # message = update.message
     # user_id = update.effective_user.id
     # user_data = context.user_data
-    # voice_path = user_data['voice_path']
-    # lang = user_data['language']
+    # voice_path = user_data.voice_path
+    # lang = user_data.language
 
-    # user_data['current_active_module'] = 'tag_editor'
+    # user_data.current_module = Module.TAG_EDITOR
 
-    # tag_editor_context = user_data['tag_editor']
-    # tag_editor_context['current_tag'] = ''
+    # tag_editor_context = user_data.tag_editor
+    # tag_editor_context.current_tag = ''
 
     # tag_editor_keyboard = generate_module_selector_voice_keyboard(lang)
 
@@ -691,8 +979,8 @@ def handle_convert_voice_message(update: Update, context: CallbackContext) -> No
     #                         f"{translate_key_to(lp.CLICK_PREVIEW_MESSAGE, lang)} " \
     #                         f"{translate_key_to(lp.OR, lang).upper()} " \
     #                         f"{translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
-    #         user_data['voice_path'] = voice_path
-    #         user_data['convert_audio_to_voice'] = True
+    #         user_data.voice_path = voice_path
+    #         user_data.convert_audio_to_voice = True
     #         message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
     #     except (ValueError, BaseException):
     #         message.reply_text(translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, lang))
@@ -711,8 +999,8 @@ def handle_convert_voice_message(update: Update, context: CallbackContext) -> No
 
 def show_module_selector(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    context.user_data['current_active_module'] = ''
-    lang = user_data['language']
+    context.user_data.current_module = Module.NONE
+    lang = user_data.language
 
     module_selector_keyboard = generate_module_selector_keyboard(lang)
 
@@ -726,15 +1014,15 @@ def handle(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     message = update.message
     user_id = update.effective_user.id
-    music_path = user_data['music_path']
-    current_active_module = user_data['current_active_module']
-    current_tag = user_data['tag_editor']['current_tag']
-    lang = user_data['language']
+    music_path = user_data.music_path
+    current_active_module = user_data.current_module
+    current_tag = user_data.tag_editor.current_tag
+    lang = user_data.language
 
     tag_editor_keyboard = generate_tag_editor_keyboard(lang)
 
     if music_path:
-        if current_active_module == 'tag_editor':
+        if current_active_module == Module.TAG_EDITOR:
             if not current_tag or current_tag != 'album_art':
                 reply_message = translate_key_to(lp.ASK_WHICH_TAG, lang)
                 message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
@@ -750,7 +1038,7 @@ def handle(update: Update, context: CallbackContext) -> None:
                                     f"{translate_key_to(lp.CLICK_PREVIEW_MESSAGE, lang)} " \
                                     f"{translate_key_to(lp.OR, lang).upper()} " \
                                     f"{translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
-                    user_data['new_art_path'] = file_download_path
+                    user_data.new_art_path = file_download_path
                     message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
                 except (ValueError, BaseException):
                     message.reply_text(translate_key_to(lp.ERR_ON_DOWNLOAD_AUDIO_MESSAGE, lang))
@@ -767,13 +1055,13 @@ def handle(update: Update, context: CallbackContext) -> None:
 def handle_music_tag_editor(update: Update, context: CallbackContext) -> None:
     message = update.message
     user_data = context.user_data
-    art_path = user_data['art_path']
-    lang = user_data['language']
+    art_path = user_data.art_path
+    lang = user_data.language
 
-    user_data['current_active_module'] = 'tag_editor'
+    user_data.current_module = Module.TAG_EDITOR
 
-    tag_editor_context = user_data['tag_editor']
-    tag_editor_context['current_tag'] = ''
+    tag_editor_context = user_data.tag_editor
+    tag_editor_context.current_tag = ''
 
     tag_editor_keyboard = generate_tag_editor_keyboard(lang)
 
@@ -795,11 +1083,11 @@ def handle_music_tag_editor(update: Update, context: CallbackContext) -> None:
 
 def handle_music_cutter(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
-    user_data['current_active_module'] = 'music_cutter'
-    lang = user_data['language']
+    user_data.current_module = Module.MUSIC_CUTTER
+    lang = user_data.language
 
     back_button_keyboard = generate_back_button_keyboard(lang)
-    music_duration = convert_seconds_to_human_readable_form(user_data['music_duration'])
+    music_duration = convert_seconds_to_human_readable_form(user_data.music_duration)
 
     # TODO: Send back the length of the music
     update.message.reply_text(
@@ -808,7 +1096,7 @@ def handle_music_cutter(update: Update, context: CallbackContext) -> None:
     )
 
 def throw_not_implemented(update: Update, context: CallbackContext) -> None:
-    lang = context.user_data['language']
+    lang = context.user_data.language
 
     back_button_keyboard = generate_back_button_keyboard(lang)
 
@@ -819,68 +1107,68 @@ def throw_not_implemented(update: Update, context: CallbackContext) -> None:
 
 def handle_music_bitrate_changer(update: Update, context: CallbackContext) -> None:
     throw_not_implemented(update, context)
-    context.user_data['current_active_module'] = ''
+    context.user_data.current_module = Module.NONE
 
 def prepare_for_artist(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'artist'
-        message_text = translate_key_to(lp.ASK_FOR_ARTIST, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'artist'
+        message_text = translate_key_to(lp.ASK_FOR_ARTIST, context.user_data.language)
 
     update.message.reply_text(message_text)
 
 def prepare_for_title(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'title'
-        message_text = translate_key_to(lp.ASK_FOR_TITLE, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'title'
+        message_text = translate_key_to(lp.ASK_FOR_TITLE, context.user_data.language)
 
     update.message.reply_text(message_text)
 
 def prepare_for_album(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'album'
-        message_text = translate_key_to(lp.ASK_FOR_ALBUM, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'album'
+        message_text = translate_key_to(lp.ASK_FOR_ALBUM, context.user_data.language)
 
     update.message.reply_text(message_text)
 
 def prepare_for_genre(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'genre'
-        message_text = translate_key_to(lp.ASK_FOR_GENRE, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'genre'
+        message_text = translate_key_to(lp.ASK_FOR_GENRE, context.user_data.language)
 
     update.message.reply_text(message_text)
 
 def prepare_for_year(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'year'
-        message_text = translate_key_to(lp.ASK_FOR_YEAR, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'year'
+        message_text = translate_key_to(lp.ASK_FOR_YEAR, context.user_data.language)
 
     update.message.reply_text(message_text)
 
 def prepare_for_disknumber(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'disknumber'
-        message_text = translate_key_to(lp.ASK_FOR_DISK_NUMBER, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'disknumber'
+        message_text = translate_key_to(lp.ASK_FOR_DISK_NUMBER, context.user_data.language)
 
     update.message.reply_text(message_text)
 
 def prepare_for_tracknumber(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'tracknumber'
-        message_text = translate_key_to(lp.ASK_FOR_TRACK_NUMBER, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'tracknumber'
+        message_text = translate_key_to(lp.ASK_FOR_TRACK_NUMBER, context.user_data.language)
 
     update.message.reply_text(message_text)
 
@@ -892,51 +1180,76 @@ def handle_music_to_voice_converter(update: Update, context: CallbackContext) ->
     )
 
     user_data = context.user_data
-    input_music_path = user_data['music_path']
-    voice_path = f"{user_data['music_path']}.ogg"
-    lang = user_data['language']
-    user_data['current_active_module'] = 'mp3_to_voice_converter'  # TODO: Make modules a dict
-
-    os.system(
-        f"ffmpeg -i -y {input_music_path} -ac 1 -map 0:a -codec:a opus -b:a 128k -vbr off \
-         {input_music_path}"
-    )
-    os.system(f"ffmpeg -i {input_music_path} -c:a libvorbis -q:a 4 {voice_path}")
+    input_music_path = user_data.music_path
+    voice_path = output_path_for(input_music_path, VOICE_NOTE)
+    lang = user_data.language
+    user_data.current_module = Module.MUSIC_TO_VOICE_CONVERTER
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
+    music_duration = user_data.music_duration
+    music_message_id = user_data.music_message_id
+    music_unique_id = user_data.music_unique_id
+    output_key = cache_key(music_unique_id, 'music_to_voice', VOICE_NOTE.output_args) if music_unique_id else ''
 
-    context.bot.send_chat_action(
-        chat_id=update.message.chat_id,
-        action=ChatAction.UPLOAD_AUDIO
-    )
+    def upload(result: FFmpegResult) -> None:
+        if not result.ok:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+            delete_file(voice_path)
+            return
 
-    try:
-        with open(voice_path, 'rb') as voice_file:
-            context.bot.send_voice(
-                voice=voice_file,
-                duration=user_data['music_duration'],
+        context.bot.send_chat_action(
+            chat_id=message.chat_id,
+            action=ChatAction.UPLOAD_AUDIO
+        )
+
+        try:
+            send_output(
+                context.bot.send_voice,
+                'voice',
+                voice_path,
+                upload_key=output_key,
+                output_key=output_key,
+                duration=music_duration,
                 chat_id=message.chat_id,
                 caption=f"🆔 {BOT_USERNAME}",
                 reply_markup=start_over_button_keyboard,
-                reply_to_message_id=user_data['music_message_id']
+                reply_to_message_id=music_message_id
             )
-    except TelegramError as error:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_UPLOADING, lang),
-            reply_markup=start_over_button_keyboard
-        )
-        logger.exception("Telegram error: %s", error)
+        except (TelegramError, OSError) as error:
+            message.reply_text(
+                translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                reply_markup=start_over_button_keyboard
+            )
+            logger.exception("Telegram error: %s", error)
 
-    delete_file(voice_path)
+        delete_file(voice_path)
 
-    reset_user_data_context(context)
+        if user_data.music_path == input_music_path:
+            reset_user_data_context(context)
+
+    submit_media_job(
+        message,
+        lang,
+        lambda: transcode(VOICE_NOTE, input_music_path, voice_path, music_unique_id),
+        upload,
+        operation='music_to_voice',
+        input_path=input_music_path,
+        duration=music_duration,
+        output_key=output_key,
+        output_path=voice_path,
+        prepare=lambda: download_input(message, context, 'music'),
+        upload_key=output_key
+    )
 
 def prepare_for_album_art(update: Update, context: CallbackContext) -> None:
-    if len(context.user_data) == 0:
-        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data['language'])
+    if not context.user_data.music_path:
+        message_text = translate_key_to(lp.DEFAULT_MESSAGE, context.user_data.language)
     else:
-        context.user_data['tag_editor']['current_tag'] = 'album_art'
-        message_text = translate_key_to(lp.ASK_FOR_ALBUM_ART, context.user_data['language'])
+        context.user_data.tag_editor.current_tag = 'album_art'
+        message_text = translate_key_to(lp.ASK_FOR_ALBUM_ART, context.user_data.language)
 
     update.message.reply_text(message_text)
 
@@ -948,81 +1261,36 @@ def finish_convert_voice_to_audio(update: Update, context: CallbackContext) -> N
     )
 
     user_data = context.user_data
-    input_voice_path = user_data['voice_path']
-    music_path = f"{user_data['voice_path']}.mp3"
-    lang = user_data['language']
-    user_data['current_active_module'] = 'mp3_to_voice_converter'  # TODO: Make modules a dict
-
-    os.system(
-        f"ffmpeg -i -y {input_voice_path} -ac 1 -map 0:a -codec:a opus -b:a 128k -vbr off \
-         {input_voice_path}"
-    )
-    os.system(f"ffmpeg -i {input_voice_path} -c:a libvorbis -q:a 4 {music_path}")
-
-    # voice_path = user_data['voice_path']
-
-    # myffmpegcommand(voice_path, user_data)
-
-    # lang = user_data['language']
-
-    new_voice_path = user_data['new_voice_art_path']
+    input_voice_path = user_data.voice_path
+    voice_note_path = output_path_for(input_voice_path, VOICE_NOTE)
+    voice_unique_id = user_data.voice_unique_id
+    lang = user_data.language
+    user_data.current_module = Module.MUSIC_TO_VOICE_CONVERTER
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
 
-    try:
-        with open(new_voice_path, 'rb') as voice:
-            message.reply_voice(
-                voice=voice,
-                reply_to_message_id=update.effective_message.message_id,
-                reply_markup=start_over_button_keyboard,
-            )
-    except (TelegramError, BaseException) as error:
-        message.reply_text(
-            translate_key_to(lp.ERR_ON_UPLOADING, lang),
-            reply_markup=start_over_button_keyboard
-        )
-        logger.exception("Telegram error: %s", error)
-
-    reset_user_data_context(context)
-
-def finish_convert_video(update: Update, context: CallbackContext) -> None:
-    message = update.message
-    user_data = context.user_data
+    # voice_path = user_data.voice_path
 
-    context.bot.send_chat_action(
-        chat_id=update.message.chat_id,
-        action=ChatAction.UPLOAD_VIDEO
-    )
-
-    video_path = user_data['video_path']
+    # myffmpegcommand(voice_path, user_data)
 
-    lang = user_data['language']
-    video_file = open(video_path, 'rb').read()
+    # lang = user_data.language
 
-    start_over_button_keyboard = generate_start_over_keyboard(lang)
+    reply_to_message_id = update.effective_message.message_id
 
-    covert_video_to_gif = user_data['convert_video_to_gif']
-    if covert_video_to_gif == True:
-        video_to_gif(video_path, user_data)
-        try:
-            with open(video_path, 'rb') as video_file:
-                message.reply_video(
-                    video=video_file,
-                    reply_to_message_id=update.effective_message.message_id,
-                    reply_markup=start_over_button_keyboard,
-                )
-        except (TelegramError, BaseException) as error:
+    def upload(result: FFmpegResult) -> None:
+        if not result.ok:
             message.reply_text(
-                translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                translate_key_to(lp.ERR_ON_CONVERTING, lang),
                 reply_markup=start_over_button_keyboard
             )
-            logger.exception("Telegram error: %s", error)
-    else :
+            delete_file(voice_note_path)
+            return
+
         try:
-            with open(video_path, 'rb') as video_file:
-                message.reply_video_note(
-                    video_note=video_file,
-                    reply_to_message_id=update.effective_message.message_id,
+            with open(voice_note_path, 'rb') as voice:
+                message.reply_voice(
+                    voice=voice,
+                    reply_to_message_id=reply_to_message_id,
                     reply_markup=start_over_button_keyboard,
                 )
         except (TelegramError, BaseException) as error:
@@ -1032,47 +1300,62 @@ def finish_convert_video(update: Update, context: CallbackContext) -> None:
             )
             logger.exception("Telegram error: %s", error)
 
-    reset_user_data_context(context)
+        delete_file(voice_note_path)
+
+        if user_data.voice_path == input_voice_path:
+            reset_user_data_context(context)
+
+    submit_media_job(
+        message,
+        lang,
+        lambda: transcode(VOICE_NOTE, input_voice_path, voice_note_path, voice_unique_id),
+        upload,
+        operation='voice_to_voice_note',
+        input_path=input_voice_path,
+        duration=user_data.voice_duration,
+        prepare=lambda: download_input(message, context, 'voice')
+    )
+
+def finish_convert_video(update: Update, context: CallbackContext) -> None:
+    message = update.message
+    user_data = context.user_data
+
+    context.bot.send_chat_action(
+        chat_id=update.message.chat_id,
+        action=ChatAction.UPLOAD_VIDEO
+    )
+
+    if user_data.convert_video_to_gif == True:
+        convert_video(message, context, ANIMATION, 'video_to_gif', message.reply_animation, 'animation')
+        return
+
+    convert_video(message, context, VIDEO_NOTE, 'video_to_video_note', message.reply_video_note, 'video_note')
 
 def finish(update: Update, context: CallbackContext) -> None:
     message = update.message
     user_data = context.user_data
     user_id = update.effective_user.id
 
-    covert_video_to_gif = user_data['convert_video_to_gif']
-    convert_video_to_circle = user_data['convert_video_to_circle']
-    convert_audio_to_voice = user_data['convert_audio_to_voice']
-    edit_tag_music = user_data['edit_tag_music']
-    download_from_link = user_data['download_from_link']
+    covert_video_to_gif = user_data.convert_video_to_gif
+    convert_video_to_circle = user_data.convert_video_to_circle
+    convert_audio_to_voice = user_data.convert_audio_to_voice
+    edit_tag_music = user_data.edit_tag_music
+    download_from_link = user_data.download_from_link
 
-    lang = user_data['language']
+    lang = user_data.language
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
 
+    reply_to_message_id = update.effective_message.message_id
+
     if covert_video_to_gif == True:
         context.bot.send_chat_action(
         chat_id=update.message.chat_id,
         action=ChatAction.UPLOAD_VIDEO
         )
 
-        video_path = user_data['video_path']
-
-        lang = user_data['language']
-        video_file = open(video_path, 'rb').read()
-        video_to_gif(video_path, user_data)
-        try:
-            with open(video_path, 'rb') as video_file:
-                message.reply_video(
-                    video=video_file,
-                    reply_to_message_id=update.effective_message.message_id,
-                    reply_markup=start_over_button_keyboard,
-                )
-        except (TelegramError, BaseException) as error:
-            message.reply_text(
-                translate_key_to(lp.ERR_ON_UPLOADING, lang),
-                reply_markup=start_over_button_keyboard
-            )
-            logger.exception("Telegram error: %s", error)
+        convert_video(message, context, ANIMATION, 'video_to_gif', message.reply_animation, 'animation')
+        return
 
     elif convert_video_to_circle == True:
         context.bot.send_chat_action(
@@ -1080,57 +1363,67 @@ def finish(update: Update, context: CallbackContext) -> None:
         action=ChatAction.UPLOAD_VIDEO
         )
 
-        video_path = user_data['video_path']
-
-        lang = user_data['language']
-        video_file = open(video_path, 'rb').read()
-        video_to_gif(video_path, user_data)
-        try:
-            with open(video_path, 'rb') as video_file:
-                message.reply_video_note(
-                    video_note=video_file,
-                    reply_to_message_id=update.effective_message.message_id,
-                    reply_markup=start_over_button_keyboard,
-                )
-        except (TelegramError, BaseException) as error:
-            message.reply_text(
-                translate_key_to(lp.ERR_ON_UPLOADING, lang),
-                reply_markup=start_over_button_keyboard
-            )
-            logger.exception("Telegram error: %s", error)
+        convert_video(message, context, VIDEO_NOTE, 'video_to_video_note', message.reply_video_note, 'video_note')
+        return
 
     elif convert_audio_to_voice == True:
         context.bot.send_chat_action(
             chat_id=update.message.chat_id,
             action=ChatAction.UPLOAD_AUDIO
         )
-        # voice_path = user_data['voice_path']
-        myffmpegcommand(user_data)
-        lang = user_data['language']
-        new_voice_path = user_data['new_voice_art_path']
-        try:
-            with open(new_voice_path, 'rb') as voice:
-                message.reply_voice(
-                    voice=voice,
-                    reply_to_message_id=update.effective_message.message_id,
-                    reply_markup=start_over_button_keyboard,
+        voice_path = user_data.voice_path
+        new_voice_path = output_path_for(voice_path, VOICE_NOTE)
+
+        def upload_voice(result: FFmpegResult) -> None:
+            if not result.ok:
+                message.reply_text(
+                    translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                    reply_markup=start_over_button_keyboard
                 )
-        except (TelegramError, BaseException) as error:
-            message.reply_text(
-                translate_key_to(lp.ERR_ON_UPLOADING, lang),
-                reply_markup=start_over_button_keyboard
-            )
-            logger.exception("Telegram error: %s", error)
+                return
+            try:
+                with open(new_voice_path, 'rb') as voice:
+                    message.reply_voice(
+                        voice=voice,
+                        reply_to_message_id=reply_to_message_id,
+                        reply_markup=start_over_button_keyboard,
+                    )
+            except (TelegramError, BaseException) as error:
+                message.reply_text(
+                    translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                    reply_markup=start_over_button_keyboard
+                )
+                logger.exception("Telegram error: %s", error)
+
+            delete_file(new_voice_path)
+
+            if user_data.voice_path == voice_path:
+                reset_user_data_context(context)
+
+        submit_media_job(
+            message,
+            lang,
+            lambda: myffmpegcommand(voice_path),
+            upload_voice,
+            operation='audio_to_voice',
+            input_path=voice_path,
+            duration=user_data.voice_duration,
+            prepare=lambda: download_input(message, context, 'voice')
+        )
+        return
     elif edit_tag_music == True:
         context.bot.send_chat_action(
             chat_id=update.message.chat_id,
             action=ChatAction.UPLOAD_AUDIO
         )
-        music_path = user_data['music_path']
-        new_art_path = user_data['new_art_path']
-        music_tags = user_data['tag_editor']
-        lang = user_data['language']
+        music_path = user_data.music_path
+        new_art_path = user_data.new_art_path
+        music_tags = user_data.tag_editor
+        lang = user_data.language
         thumb = open(new_art_path, 'rb').read()
+        if not download_input(message, context, 'music'):
+            return
+
         try:
             save_tags_to_file(
                 file=music_path,
@@ -1148,12 +1441,12 @@ def finish(update: Update, context: CallbackContext) -> None:
             with open(music_path, 'rb') as music_file:
                 context.bot.send_audio(
                     audio=music_file,
-                    duration=user_data['music_duration'],
+                    duration=user_data.music_duration,
                     chat_id=update.message.chat_id,
                     caption=f"🆔 {BOT_USERNAME}",
                     thumb=thumb,
                     reply_markup=start_over_button_keyboard,
-                    reply_to_message_id=user_data['music_message_id']
+                    reply_to_message_id=user_data.music_message_id
                 )
         except (TelegramError, BaseException) as error:
             message.reply_text(
@@ -1176,10 +1469,13 @@ def finish(update: Update, context: CallbackContext) -> None:
             )
             logger.exception("Telegram error: %s", error)
     else :
-        music_path = user_data['music_path']
-        new_art_path = user_data['new_art_path']
-        music_tags = user_data['tag_editor']
-        lang = user_data['language']
+        music_path = user_data.music_path
+        new_art_path = user_data.new_art_path
+        music_tags = user_data.tag_editor
+        lang = user_data.language
+        if not download_input(message, context, 'music'):
+            return
+
         try:
             save_tags_to_file(
                 file=music_path,
@@ -1198,11 +1494,11 @@ def finish(update: Update, context: CallbackContext) -> None:
             with open(music_path, 'rb') as music_file:
                 context.bot.send_audio(
                     audio=music_file,
-                    duration=user_data['music_duration'],
+                    duration=user_data.music_duration,
                     chat_id=update.message.chat_id,
                     caption=f"🆔 {BOT_USERNAME}",
                     reply_markup=start_over_button_keyboard,
-                    reply_to_message_id=user_data['music_message_id']
+                    reply_to_message_id=user_data.music_message_id
                 )
         except (TelegramError, BaseException) as error:
             message.reply_text(
@@ -1244,14 +1540,17 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
         action=ChatAction.UPLOAD_AUDIO
     )
 
-    music_path = user_data['music_path']
-    new_art_path = user_data['new_art_path']
-    music_tags = user_data['tag_editor']
-    lang = user_data['language']
+    music_path = user_data.music_path
+    new_art_path = user_data.new_art_path
+    music_tags = user_data.tag_editor
+    lang = user_data.language
     thumb = open(new_art_path, 'rb').read()
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
 
+    if not download_input(message, context, 'music'):
+        return
+
     try:
         save_tags_to_file(
             file=music_path,
@@ -1270,12 +1569,12 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
         with open(music_path, 'rb') as music_file:
             context.bot.send_audio(
                 audio=music_file,
-                duration=user_data['music_duration'],
+                duration=user_data.music_duration,
                 chat_id=update.message.chat_id,
                 caption=f"🆔 {BOT_USERNAME}",
                 thumb=thumb,
                 reply_markup=start_over_button_keyboard,
-                reply_to_message_id=user_data['music_message_id']
+                reply_to_message_id=user_data.music_message_id
             )
     except (TelegramError, BaseException) as error:
         message.reply_text(
@@ -1290,11 +1589,11 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     # message = update.message
     # message_text = digits.ar_to_fa(digits.fa_to_en(message.text))
     # user_data = context.user_data
-    # music_path = user_data['music_path']
-    # art_path = user_data['art_path']
-    # music_tags = user_data['tag_editor']
-    # current_tag = music_tags.get('current_tag')
-    # lang = user_data['language']
+    # music_path = user_data.music_path
+    # art_path = user_data.art_path
+    # music_tags = user_data.tag_editor
+    # current_tag = music_tags.current_tag
+    # lang = user_data.language
 
     # logging.info(
     #     "%s:%s:%s",
@@ -1303,7 +1602,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     #     update.message.text
     # )
 
-    # current_active_module = user_data['current_active_module']
+    # current_active_module = user_data.current_module
 
     # tag_editor_keyboard = generate_tag_editor_keyboard(lang)
 
@@ -1312,7 +1611,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     # back_button_keyboard = generate_back_button_keyboard(lang)
     # start_over_button_keyboard = generate_start_over_keyboard(lang)
 
-    # if current_active_module == 'tag_editor':
+    # if current_active_module == Module.TAG_EDITOR:
     #     if not current_tag:
     #         reply_message = translate_key_to(lp.ASK_WHICH_TAG, lang)
     #         message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
@@ -1332,7 +1631,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     #                         f"{translate_key_to(lp.OR, lang).upper()}" \
     #                         f" {translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
     #         message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
-    # elif current_active_module == 'music_cutter':
+    # elif current_active_module == Module.MUSIC_CUTTER:
     #     try:
     #         pass
     #         # beginning_sec, ending_sec = parse_cutting_range(message_text)
@@ -1343,7 +1642,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     #         message.reply_text(reply_message, reply_markup=back_button_keyboard)
     #         return
     #     music_path_cut = f"{music_path}_cut.mp3"
-    #     music_duration = user_data['music_duration']
+    #     music_duration = user_data.music_duration
 
     #     if beginning_sec > music_duration or ending_sec > music_duration:
     #         reply_message = translate_key_to(lp.ERR_OUT_OF_RANGE, lang).format(
@@ -1393,7 +1692,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     #                             f"*To*: {convert_seconds_to_human_readable_form(ending_sec)}\n\n"
     #                             f"🆔 {BOT_USERNAME}",
     #                     reply_markup=start_over_button_keyboard,
-    #                     reply_to_message_id=user_data['music_message_id']
+    #                     reply_to_message_id=user_data.music_message_id
     #                 )
     #         except (TelegramError, BaseException) as error:
     #             message.reply_text(
@@ -1407,7 +1706,7 @@ def finish_editing_tags(update: Update, context: CallbackContext) -> None:
     #         reset_user_data_context(context)
     # else:
     #     if music_path:
-    #         if user_data['current_active_module']:
+    #         if user_data.current_module:
     #             message.reply_text(
     #                 translate_key_to(lp.ASK_WHICH_MODULE, lang),
     #                 reply_markup=module_selector_keyboard
@@ -1427,11 +1726,11 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
     message = update.message
     message_text = digits.ar_to_fa(digits.fa_to_en(message.text))
     user_data = context.user_data
-    music_path = user_data['music_path']
-    art_path = user_data['art_path']
-    music_tags = user_data['tag_editor']
-    current_tag = music_tags.get('current_tag')
-    lang = user_data['language']
+    music_path = user_data.music_path
+    art_path = user_data.art_path
+    music_tags = user_data.tag_editor
+    current_tag = music_tags.current_tag
+    lang = user_data.language
 
     logging.info(
         "%s:%s:%s",
@@ -1440,7 +1739,7 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
         update.message.text
     )
 
-    current_active_module = user_data['current_active_module']
+    current_active_module = user_data.current_module
 
     tag_editor_keyboard = generate_tag_editor_keyboard(lang)
 
@@ -1449,7 +1748,7 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
     back_button_keyboard = generate_back_button_keyboard(lang)
     start_over_button_keyboard = generate_start_over_keyboard(lang)
 
-    if current_active_module == 'tag_editor':
+    if current_active_module == Module.TAG_EDITOR:
         if not current_tag:
             reply_message = translate_key_to(lp.ASK_WHICH_TAG, lang)
             message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
@@ -1468,7 +1767,7 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
                             f"{translate_key_to(lp.OR, lang).upper()}" \
                             f" {translate_key_to(lp.CLICK_DONE_MESSAGE, lang).lower()}"
             message.reply_text(reply_message, reply_markup=tag_editor_keyboard)
-    elif current_active_module == 'music_cutter':
+    elif current_active_module == Module.MUSIC_CUTTER:
         try:
             beginning_sec, ending_sec = parse_cutting_range(message_text)
         except (ValueError, BaseException):
@@ -1478,7 +1777,7 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
             message.reply_text(reply_message, reply_markup=back_button_keyboard)
             return
         music_path_cut = f"{music_path}_cut.mp3"
-        music_duration = user_data['music_duration']
+        music_duration = user_data.music_duration
 
         if beginning_sec > music_duration or ending_sec > music_duration:
             reply_message = translate_key_to(lp.ERR_OUT_OF_RANGE, lang).format(
@@ -1497,52 +1796,91 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
             )
         else:
             diff_sec = ending_sec - beginning_sec
+            # A copy, the user may edit the tags again before the cut is uploaded
+            cut_tags = TagEditor()
+            cut_tags.load(music_tags.to_dict())
+            music_message_id = user_data.music_message_id
+            chat_id = message.chat_id
+            output_key = upload_key = ''
+            if user_data.music_unique_id:
+                output_key = cache_key(user_data.music_unique_id, 'music_cutter', beginning_sec, diff_sec)
+                # The uploaded cut also carries the tags the user edited
+                upload_key = cache_key(
+                    user_data.music_unique_id, 'music_cutter', beginning_sec, diff_sec, cut_tags.to_dict()
+                )
 
-            os.system(
-                f"ffmpeg -y -ss {beginning_sec} -t {diff_sec} -i {music_path} -acodec copy \
-                {music_path_cut}"
-            )
+            def save_cut_tags() -> None:
+                try:
+                    save_tags_to_file(
+                        file=music_path_cut,
+                        tags=cut_tags,
+                        new_art_path=art_path if art_path else ''
+                    )
+                except (OSError, BaseException):
+                    message.reply_text(translate_key_to(lp.ERR_ON_UPDATING_TAGS, lang))
+                    logger.error(
+                        "Error on updating tags for file %s's file.",
+                        music_path_cut,
+                        exc_info=True
+                    )
 
-            try:
-                save_tags_to_file(
-                    file=music_path_cut,
-                    tags=music_tags,
-                    new_art_path=art_path if art_path else ''
-                )
-            except (OSError, BaseException):
-                update.message.reply_text(translate_key_to(lp.ERR_ON_UPDATING_TAGS, lang))
-                logger.error(
-                    "Error on updating tags for file %s's file.",
-                    music_path_cut,
-                    exc_info=True
-                )
+            def upload_cut(result: FFmpegResult) -> None:
+                if not result.ok:
+                    message.reply_text(
+                        translate_key_to(lp.ERR_ON_CONVERTING, lang),
+                        reply_markup=back_button_keyboard
+                    )
+                    delete_file(music_path_cut)
+                    return
 
-            try:
-                with open(music_path_cut, 'rb') as music_file:
+                try:
                     # FIXME: After sending the file, the album art can't be read back
-                    context.bot.send_audio(
-                        audio=music_file,
-                        chat_id=update.message.chat_id,
+                    send_output(
+                        context.bot.send_audio,
+                        'audio',
+                        music_path_cut,
+                        upload_key=upload_key,
+                        output_key=output_key,
+                        before_upload=save_cut_tags,
+                        chat_id=chat_id,
                         duration=diff_sec,
                         caption=f"*From*: {convert_seconds_to_human_readable_form(beginning_sec)}\n"
                                 f"*To*: {convert_seconds_to_human_readable_form(ending_sec)}\n\n"
                                 f"🆔 {BOT_USERNAME}",
                         reply_markup=start_over_button_keyboard,
-                        reply_to_message_id=user_data['music_message_id']
+                        reply_to_message_id=music_message_id
                     )
-            except (TelegramError, BaseException) as error:
-                message.reply_text(
-                    translate_key_to(lp.ERR_ON_UPLOADING, lang),
-                    reply_markup=start_over_button_keyboard
-                )
-                logger.exception("Telegram error: %s", error)
-
-            delete_file(music_path_cut)
-
-            reset_user_data_context(context)
+                except (TelegramError, BaseException) as error:
+                    message.reply_text(
+                        translate_key_to(lp.ERR_ON_UPLOADING, lang),
+                        reply_markup=start_over_button_keyboard
+                    )
+                    logger.exception("Telegram error: %s", error)
+
+                delete_file(music_path_cut)
+
+                if user_data.music_path == music_path:
+                    reset_user_data_context(context)
+
+            submit_media_job(
+                message,
+                lang,
+                lambda: run_ffmpeg_async([
+                    '-y', '-ss', beginning_sec, '-t', diff_sec, '-i', music_path, '-acodec', 'copy',
+                    music_path_cut
+                ]),
+                upload_cut,
+                operation='music_cutter',
+                input_path=music_path,
+                duration=diff_sec,
+                output_key=output_key,
+                output_path=music_path_cut,
+                prepare=lambda: download_input(message, context, 'music'),
+                upload_key=upload_key
+            )
     else:
         if music_path:
-            if user_data['current_active_module']:
+            if user_data.current_module:
                 message.reply_text(
                     translate_key_to(lp.ASK_WHICH_MODULE, lang),
                     reply_markup=module_selector_keyboard
@@ -1557,10 +1895,10 @@ def handle_responses(update: Update, context: CallbackContext) -> None:
 def display_preview(update: Update, context: CallbackContext) -> None:
     message = update.message
     user_data = context.user_data
-    tag_editor_context = user_data['tag_editor']
-    art_path = user_data['art_path']
-    new_art_path = user_data['new_art_path']
-    lang = user_data['language']
+    tag_editor_context = user_data.tag_editor
+    art_path = user_data.art_path
+    new_art_path = user_data.new_art_path
+    lang = user_data.language
 
     if art_path or new_art_path:
         with open(new_art_path if new_art_path else art_path, "rb") as art_file:
@@ -1583,12 +1921,12 @@ def show_profile(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     user_id = update.effective_user.id
     message = update.message
-    lang = user_data['language']
+    lang = user_data.language
 
-    user = User.where('user_id', '=', user_id).first()
+    user = users.get(user_id)
     username = user.username
     number_of_files_sent = user.number_of_files_sent
-    coin = user.coin
+    coin = ledger.balance(user_id)
 
     start_over_button_keyboard = generate_start_over_keyboard(lang)
     reply_message = f"{translate_key_to(lp.USER_NAME, lang)} {username} \n" \
@@ -1600,7 +1938,7 @@ def by_coins(update: Update, context: CallbackContext) -> None:
     user_data = context.user_data
     user_id = update.effective_user.id
     message = update.message
-    lang = user_data['language']
+    lang = user_data.language
 
     coins_20 = "15,000"
     coins_50 = "35,000"
@@ -1615,12 +1953,106 @@ def by_coins(update: Update, context: CallbackContext) -> None:
         reply_markup=start_pay_coin
         )
 
+def command_stats(update: Update, context: CallbackContext) -> None:
+    """Admin only: the statistics aggregated by `stats`, plus the live queue state."""
+    user_id = update.effective_user.id
+    lang = context.user_data.language
+
+    if not admins.is_admin(user_id):
+        return
+
+    snapshot = stats.refresh_if_stale()
+    if snapshot.refreshed_at is None:
+        update.message.reply_text(translate_key_to(lp.ADMIN_STATS_NOT_READY, lang))
+        return
+
+    operations = "\n".join(
+        translate_key_to(lp.ADMIN_STATS_OPERATION, lang).format(
+            operation=operation,
+            events=events,
+            failed=failed,
+            average_ms=average_ms
+        )
+        for operation, (events, failed, average_ms) in snapshot.operations.items()
+    )
+    pool = db.metrics().get(db.get_default_connection(), {'in_use': 0, 'size': 0, 'wait_seconds_max': 0})
+
+    update.message.reply_text(
+        translate_key_to(lp.ADMIN_STATS, lang).format(
+            users=snapshot.users,
+            active_today=snapshot.active_today,
+            operations=operations or '-',
+            **transcode_executor.stats(),
+            **update_dispatcher.stats(),
+            in_use=pool['in_use'],
+            size=pool['size'],
+            wait_seconds_max=pool['wait_seconds_max'],
+            **{f"cache_{name}": value for name, value in output_cache.metrics().items()},
+            **blobs.metrics(),
+            age=int(time.time() - snapshot.refreshed_at)
+        ),
+        parse_mode=None
+    )
+
+def command_export(update: Update, context: CallbackContext) -> None:
+    """Owner only: send a table as gzipped CSV, e.g. `/export users`."""
+    user_id = update.effective_user.id
+    message = update.message
+    lang = context.user_data.language
+
+    if not admins.is_owner(user_id):
+        return
+
+    name = context.args[0] if context.args else ''
+    if name not in EXPORTS:
+        message.reply_text(translate_key_to(lp.EXPORT_HELP, lang).format(names=', '.join(EXPORTS)), parse_mode=None)
+        return
+
+    context.bot.send_chat_action(chat_id=message.chat_id, action=ChatAction.UPLOAD_DOCUMENT)
+
+    file_name = f"{name}-{datetime.utcnow():%Y%m%d-%H%M%S}.csv.gz"
+    export_path = f"{create_user_directory(user_id)}/{file_name}"
+
+    try:
+        export_csv(db, name, export_path)
+        with open(export_path, 'rb') as export_file:
+            message.reply_document(document=export_file, filename=file_name, timeout=600)
+    except (TelegramError, OSError) as error:
+        message.reply_text(translate_key_to(lp.ERR_ON_UPLOADING, lang))
+        logger.exception("Couldn't send the %s export: %s", name, error)
+    finally:
+        delete_file(export_path)
+
+def evict_idle_users(persistence) -> None:
+    """Move idle users' data out of memory. Eviction runs in each user's mailbox, so it
+    never races with their handlers, and skips users with media jobs in flight or updates
+    queued behind it."""
+    def evict(user_id: int, last_seen: float) -> None:
+        if not update_dispatcher.is_held(user_id) and not update_dispatcher.pending(user_id):
+            persistence.evict(user_id, last_seen)
+
+    for user_id, last_seen in persistence.eviction_candidates():
+        update_dispatcher.post(user_id, evict, user_id, last_seen)
+
 def main():
+    output_cache.open()
+    blobs.open()
+
     defaults = Defaults(parse_mode=ParseMode.MARKDOWN, timeout=120)
-    persistence = PicklePersistence('persistence_storage')
+    persistence = create_persistence(db, suffix=shard_suffix())
+
+    updater = Updater(
+        BOT_TOKEN,
+        persistence=persistence,
+        defaults=defaults,
+        context_types=ContextTypes(user_data=UserSession)
+    )
+    update_dispatcher.dispatcher = updater.dispatcher
 
-    updater = Updater(BOT_TOKEN, persistence=persistence, defaults=defaults)
-    add_handler = updater.dispatcher.add_handler
+    def add_handler(handler) -> None:
+        # Handlers share `context.user_data`, so every callback goes through the user's mailbox
+        handler.callback = update_dispatcher.wrap(handler.callback)
+        updater.dispatcher.add_handler(handler)
 
     ##########################
     # Users Command Handlers #
@@ -1631,6 +2063,8 @@ def main():
     add_handler(CommandHandler('help', command_help))
     add_handler(CommandHandler('about', command_about))
     add_handler(CommandHandler('setting', command_setting))
+    add_handler(CommandHandler('stats', command_stats))
+    add_handler(CommandHandler('export', command_export))
 
     #################
     # File Handlers #
@@ -1757,8 +2191,72 @@ def main():
     ##########
     add_handler(MessageHandler(Filters.text, handle_responses))
     ##########
-    updater.start_polling()
-    updater.idle()
+    # Changed user data is written in batches instead of after every update
+    updater.job_queue.run_repeating(lambda _: persistence.flush(), interval=PERSISTENCE_FLUSH_INTERVAL)
+    updater.job_queue.run_repeating(lambda _: evict_idle_users(persistence), interval=USER_DATA_EVICT_INTERVAL)
+    updater.job_queue.run_repeating(lambda _: users.flush_counters(), interval=USAGE_FLUSH_INTERVAL)
+    updater.job_queue.run_repeating(lambda _: usage.flush(), interval=USAGE_EVENT_FLUSH_INTERVAL)
+    updater.job_queue.run_repeating(lambda _: ledger.flush(), interval=LEDGER_FLUSH_INTERVAL)
+    if runs_global_jobs():
+        updater.job_queue.run_repeating(lambda _: usage.rollup_recent(), interval=USAGE_ROLLUP_INTERVAL)
+        updater.job_queue.run_repeating(lambda _: ledger.reconcile(), interval=LEDGER_RECONCILE_INTERVAL)
+    updater.job_queue.run_repeating(lambda _: blobs.collect(), interval=BLOB_COLLECT_INTERVAL)
+    updater.job_queue.run_repeating(lambda _: output_cache.rescan(), interval=OUTPUT_CACHE_RESCAN_INTERVAL)
+    updater.job_queue.run_repeating(
+        lambda _: logger.info("Database pool: %s", db.metrics()),
+        interval=DB_POOL_METRICS_INTERVAL
+    )
+
+    if BOT_MODE == 'webhook':
+        updater.job_queue.start()
+        serve_webhook(
+            UpdateIntake(dispatcher_consumer(updater.dispatcher)),
+            bot=updater.bot,
+            payments=handle_payment_callback
+        )
+        updater.job_queue.stop()
+    else:
+        payment_server = PaymentServer(handle_payment_callback)
+        payment_server.start()
+        updater.start_polling()
+        updater.idle()
+        payment_server.stop()
+
+    transcode_executor.shutdown()
+    update_dispatcher.shutdown()
+
+    # Work that finished after the updater stopped still has to reach the storage
+    updater.dispatcher.update_persistence()
+    persistence.flush()
+    users.flush_counters()
+    usage.flush()
+    ledger.flush()
+    db.disconnect()
+
+def run_front():
+    """Receive updates over the webhook and spread them over the shard workers by user id."""
+    pool = None
+    worker_urls = [url.strip() for url in SHARD_WORKER_URLS.split(',') if url.strip()]
+
+    if not worker_urls:
+        if SHARD_WORKERS < 1:
+            raise ValueError("BOT_MODE=front needs SHARD_WORKER_URLS or a positive SHARD_WORKERS")
+
+        pool = LocalWorkerPool(SHARD_WORKERS)
+        pool.start()
+        worker_urls = pool.urls
+
+    router = ShardRouter(worker_urls)
+
+    try:
+        serve_webhook(router, bot=Bot(BOT_TOKEN), payments=router.credit_payment)
+    finally:
+        router.stop()
+        if pool:
+            pool.stop()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if BOT_MODE == 'front':
+        run_front()
+    else:
+        main()
\ No newline at end of file
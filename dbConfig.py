@@ -1,18 +1,32 @@
 import os
-from orator import DatabaseManager
+import sys
 
 from dotenv import load_dotenv
 
+# `orator migrate -c dbConfig.py` runs this file without putting the project on the path
+if os.getcwd() not in sys.path:
+    sys.path.insert(0, os.getcwd())
+
+from dbPool import PooledDatabaseManager  # pylint: disable=wrong-import-position
+
 load_dotenv(verbose=True)
 
+DB_CONNECTION = os.getenv("DB_CONNECTION") if os.getenv("DB_CONNECTION") else 'mysql'
 DB_HOST = os.getenv("DB_HOST") if os.getenv("DB_HOST") else 'localhost'
-DB_PORT = int(os.getenv("DB_PORT")) if int(os.getenv("DB_PORT")) else 3306
+DB_PORT = int(os.getenv("DB_PORT")) if os.getenv("DB_PORT") else 3306
 DB_USERNAME = os.getenv("DB_USERNAME") if os.getenv("DB_USERNAME") else ''
 DB_PASSWORD = os.getenv("DB_PASSWORD") if os.getenv("DB_PASSWORD") else ''
 DB_NAME = os.getenv("DB_NAME") if os.getenv("DB_NAME") else ''
+DB_READ_HOSTS = os.getenv("DB_READ_HOSTS") if os.getenv("DB_READ_HOSTS") else ''
+DB_READ_STICKINESS = int(os.getenv("DB_READ_STICKINESS")) if os.getenv("DB_READ_STICKINESS") else 5
+DB_SQLITE_PATH = os.getenv("DB_SQLITE_PATH") if os.getenv("DB_SQLITE_PATH") else 'database.sqlite3'
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE")) if os.getenv("DB_POOL_SIZE") else 10
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT")) if os.getenv("DB_POOL_TIMEOUT") else 30
+DB_POOL_PRE_PING_AFTER = int(os.getenv("DB_POOL_PRE_PING_AFTER")) if os.getenv("DB_POOL_PRE_PING_AFTER") else 60
+DB_POOL_METRICS_INTERVAL = int(os.getenv("DB_POOL_METRICS_INTERVAL")) if os.getenv("DB_POOL_METRICS_INTERVAL") else 300
 
 DATABASES = {
-    'default': 'mysql',
+    'default': DB_CONNECTION,
     'mysql': {
         'driver': 'mysql',
         'host': DB_HOST,
@@ -21,7 +35,43 @@ DATABASES = {
         'password': DB_PASSWORD,
         'database': DB_NAME,
         'prefix': ''
+    },
+    'sqlite': {
+        'driver': 'sqlite',
+        'database': DB_SQLITE_PATH,
+        'prefix': '',
+        # Pooled connections are used by whichever thread checks them out
+        'check_same_thread': False,
+        # Seconds to wait for another connection's write lock
+        'timeout': 30,
     }
 }
 
-db = DatabaseManager(DATABASES)
+
+def replica_config(host: str) -> dict:
+    host, _, port = host.strip().partition(':')
+
+    return {'host': host, 'port': int(port) if port else DB_PORT}
+
+
+if DB_READ_HOSTS:
+    # Every connection of the pool reads from one of the replicas, picked at random, and
+    # writes to the primary; selects inside a transaction stay on the primary
+    DATABASES['mysql']['read'] = [replica_config(host) for host in DB_READ_HOSTS.split(',') if host.strip()]
+    DATABASES['mysql']['write'] = [{'host': DB_HOST, 'port': DB_PORT}]
+
+
+def configure_connection(connection) -> None:
+    """Put SQLite in WAL mode, so readers and the writer don't block each other."""
+    if connection.get_config('driver') == 'sqlite':
+        connection.get_connection().execute('PRAGMA journal_mode=WAL')
+        connection.get_connection().execute('PRAGMA synchronous=NORMAL')
+
+
+db = PooledDatabaseManager(
+    DATABASES,
+    pool_size=DB_POOL_SIZE,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pre_ping_after=DB_POOL_PRE_PING_AFTER,
+    on_connect=configure_connection
+)
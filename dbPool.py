@@ -0,0 +1,341 @@
+import time
+import logging
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from orator.connections import Connection
+from orator.database_manager import BaseDatabaseManager
+from orator.query import QueryBuilder
+
+logger = logging.getLogger()
+
+
+class PoolTimeoutError(Exception):
+    """No connection became available within the pool's timeout"""
+
+
+class ConnectionPool:
+    """A bounded set of orator connections that threads check out one query at a time.
+
+    A connection that sat idle for longer than `pre_ping_after` seconds is pinged before
+    it's handed out and reconnected if the server dropped it in the meantime.
+
+    **Keyword arguments:**
+     - connect (callable) -- Creates a new, connected orator `Connection`
+     - size (int) -- The maximum number of open connections
+     - timeout (int) -- Seconds to wait for a free connection before giving up
+     - pre_ping_after (int) -- Idle seconds after which a connection is pinged first
+    """
+
+    def __init__(self, connect: Callable[[], Connection], size: int, timeout: int, pre_ping_after: int) -> None:
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.pre_ping_after = pre_ping_after
+        self._idle = deque()
+        self._created = 0
+        self._in_use = 0
+        self._available = threading.Condition()
+        self._local = threading.local()
+        self._metrics = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'timeouts': 0,
+            'reconnects': 0,
+            'peak_in_use': 0,
+        }
+
+    def _acquire(self) -> Connection:
+        started_at = time.monotonic()
+        waited = False
+
+        with self._available:
+            while not self._idle and self._created >= self.size:
+                waited = True
+                remaining = self.timeout - (time.monotonic() - started_at)
+                if remaining <= 0 or not self._available.wait(remaining):
+                    if not self._idle and self._created >= self.size:
+                        self._metrics['timeouts'] += 1
+                        raise PoolTimeoutError(f"No database connection available after {self.timeout}s")
+
+            if self._idle:
+                connection, last_used = self._idle.pop()
+            else:
+                connection, last_used = None, None
+                self._created += 1
+
+            self._in_use += 1
+            wait_seconds = time.monotonic() - started_at
+            self._metrics['checkouts'] += 1
+            self._metrics['peak_in_use'] = max(self._metrics['peak_in_use'], self._in_use)
+            if waited:
+                self._metrics['waits'] += 1
+                self._metrics['wait_seconds_total'] += wait_seconds
+                self._metrics['wait_seconds_max'] = max(self._metrics['wait_seconds_max'], wait_seconds)
+
+        try:
+            if connection is None:
+                connection = self.connect()
+            elif time.monotonic() - last_used >= self.pre_ping_after:
+                self._ping(connection)
+        except BaseException:
+            with self._available:
+                self._in_use -= 1
+                self._created -= 1
+                self._available.notify()
+            raise
+
+        return connection
+
+    def _ping(self, connection: Connection) -> None:
+        try:
+            connection.get_connection().cursor().execute('SELECT 1')
+            if connection.get_read_connection() is not connection.get_connection():
+                connection.get_read_connection().cursor().execute('SELECT 1')
+        except Exception:  # pylint: disable=broad-except
+            logger.warning("Database connection %s was dropped, reconnecting", connection.get_name())
+            with self._available:
+                self._metrics['reconnects'] += 1
+            connection.reconnect()
+
+    def _release(self, connection: Connection) -> None:
+        broken = False
+
+        if connection.transaction_level() > 0:
+            # Left behind by an unbalanced `begin_transaction`; don't hand out an open transaction
+            try:
+                while connection.transaction_level() > 0:
+                    connection.rollback()
+            except Exception:  # pylint: disable=broad-except
+                broken = True
+
+        with self._available:
+            self._in_use -= 1
+            if broken:
+                self._created -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._available.notify()
+
+        if broken:
+            connection.disconnect()
+
+    @contextmanager
+    def checkout(self):
+        """Borrow a connection; nested checkouts on the same thread reuse it."""
+        held = getattr(self._local, 'held', None)
+        if held is not None:
+            self._local.depth += 1
+            try:
+                yield held
+            finally:
+                self._local.depth -= 1
+            return
+
+        connection = self._acquire()
+        self._local.held = connection
+        self._local.depth = 1
+
+        try:
+            yield connection
+        finally:
+            self._local.held = None
+            self._local.depth = 0
+            self._release(connection)
+
+    def pin(self) -> Connection:
+        """Keep a connection checked out by this thread until `unpin`, e.g. for a transaction."""
+        manager = self.checkout()
+        connection = manager.__enter__()  # pylint: disable=no-member
+        self._local.pins = getattr(self._local, 'pins', [])
+        self._local.pins.append(manager)
+
+        return connection
+
+    def unpin(self) -> None:
+        self._local.pins.pop().__exit__(None, None, None)
+
+    def metrics(self) -> Dict[str, float]:
+        """Counters describing how contended the pool is."""
+        with self._available:
+            return dict(
+                self._metrics,
+                size=self.size,
+                open=self._created,
+                in_use=self._in_use,
+                idle=len(self._idle),
+                saturation=self._in_use / self.size,
+            )
+
+    def close(self) -> None:
+        with self._available:
+            idle, self._idle = list(self._idle), deque()
+            self._created -= len(idle)
+
+        for connection, _ in idle:
+            connection.disconnect()
+
+
+def _checked_out(method: str):
+    def run(self, *args, **kwargs):
+        with self.pool.checkout() as connection:
+            result = getattr(connection, method)(*args, **kwargs)
+            self._local.cursor = connection.get_cursor()
+
+            return result
+
+    run.__name__ = method
+
+    return run
+
+
+class PooledConnection:
+    """Stands in for an orator `Connection` and runs every query on a pooled connection.
+
+    Models and query builders only ever see this object; the actual connection is checked
+    out for the duration of a single query, or of a whole transaction.
+    """
+
+    select = _checked_out('select')
+    select_one = _checked_out('select_one')
+    select_from_write_connection = _checked_out('select_from_write_connection')
+    insert = _checked_out('insert')
+    update = _checked_out('update')
+    delete = _checked_out('delete')
+    statement = _checked_out('statement')
+    affecting_statement = _checked_out('affecting_statement')
+    unprepared = _checked_out('unprepared')
+
+    def __init__(self, pool: ConnectionPool, template: Connection) -> None:
+        self.pool = pool
+        self.template = template
+        self._local = threading.local()
+
+    def select_many(self, *args, **kwargs):
+        # A generator; the connection stays checked out until it's exhausted or closed
+        with self.pool.checkout() as connection:
+            yield from connection.select_many(*args, **kwargs)
+
+    def query(self) -> QueryBuilder:
+        return QueryBuilder(self, self.template.get_query_grammar(), self.template.get_post_processor())
+
+    def table(self, table: str) -> QueryBuilder:
+        return self.query().from_(table)
+
+    def get_cursor(self):
+        """The cursor of this thread's last query, e.g. for `lastrowid`."""
+        return getattr(self._local, 'cursor', None)
+
+    @contextmanager
+    def transaction(self):
+        with self.pool.checkout() as connection:
+            with connection.transaction():
+                yield self
+
+    def begin_transaction(self) -> None:
+        self.pool.pin().begin_transaction()
+
+    def commit(self) -> None:
+        with self.pool.checkout() as connection:
+            connection.commit()
+        self.pool.unpin()
+
+    def rollback(self) -> None:
+        with self.pool.checkout() as connection:
+            connection.rollback()
+        self.pool.unpin()
+
+    def transaction_level(self) -> int:
+        with self.pool.checkout() as connection:
+            return connection.transaction_level()
+
+    def __getattr__(self, item):
+        # Grammars, configuration and the like are the same for every connection
+        return getattr(self.template, item)
+
+
+class PooledDatabaseManager(BaseDatabaseManager):
+    """A `DatabaseManager` whose connections are shared by all threads through a pool.
+
+    **Keyword arguments:**
+     - config (dict) -- The connections configuration, as for `DatabaseManager`
+     - pool_size (int) -- The maximum number of open connections per configured database
+     - pool_timeout (int) -- Seconds to wait for a free connection
+     - pre_ping_after (int) -- Idle seconds after which a connection is checked before use
+     - on_connect (callable) -- Called with every new connection, e.g. to set pragmas
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        pool_size: int,
+        pool_timeout: int,
+        pre_ping_after: int,
+        on_connect: Callable[[Connection], None] = None
+    ) -> None:
+        super().__init__(config)
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.pre_ping_after = pre_ping_after
+        self.on_connect = on_connect
+        self.pools: Dict[str, ConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def connection(self, name=None) -> PooledConnection:
+        name, _ = self._parse_connection_name(name)
+
+        with self._lock:
+            if name not in self._connections:
+                self._connections[name] = self._make_pooled_connection(name)
+
+        return self._connections[name]
+
+    def _make_connection(self, name: str) -> Connection:
+        connection = super()._make_connection(name)
+
+        if self.on_connect is not None:
+            self.on_connect(connection)
+
+        return connection
+
+    def _connect(self, name: str) -> Connection:
+        connection = self._make_connection(name)
+
+        def reconnect(connection_: Connection) -> None:
+            fresh = self._make_connection(name)
+            connection_.set_connection(fresh.get_connection())
+            connection_.set_read_connection(fresh.get_read_connection())
+
+        connection.set_reconnector(reconnect)
+
+        return connection
+
+    def _make_pooled_connection(self, name: str) -> PooledConnection:
+        pool = ConnectionPool(lambda: self._connect(name), self.pool_size, self.pool_timeout, self.pre_ping_after)
+        self.pools[name] = pool
+
+        # The template only provides grammars and configuration; it reconnects by itself in
+        # the rare case something bypasses the pool, e.g. the schema builder
+        template = self._connect(name)
+        template.disconnect()
+
+        return PooledConnection(pool, template)
+
+    def disconnect(self, name=None) -> None:
+        name, _ = self._parse_connection_name(name)
+
+        if name in self.pools:
+            self.pools[name].close()
+
+    def reconnect(self, name=None) -> PooledConnection:
+        self.disconnect(name)
+
+        return self.connection(name)
+
+    def metrics(self) -> Dict[str, Dict[str, float]]:
+        return {name: pool.metrics() for name, pool in self.pools.items()}
@@ -39,6 +39,13 @@ ERR_NOT_IMPLEMENTED = "ERR_NOT_IMPLEMENTED"
 ERR_OUT_OF_RANGE = "ERR_OUT_OF_RANGE"
 ERR_MALFORMED_RANGE = "ERR_MALFORMED_RANGE"
 ERR_BEGINNING_POINT_IS_GREATER = "ERR_BEGINNING_POINT_IS_GREATER"
+ERR_ON_CONVERTING = "ERR_ON_CONVERTING"
+ERR_SERVER_BUSY = "ERR_SERVER_BUSY"
+ERR_NOT_ENOUGH_COINS = "ERR_NOT_ENOUGH_COINS"
+ADMIN_STATS = "ADMIN_STATS"
+ADMIN_STATS_OPERATION = "ADMIN_STATS_OPERATION"
+ADMIN_STATS_NOT_READY = "ADMIN_STATS_NOT_READY"
+EXPORT_HELP = "EXPORT_HELP"
 BTN_TAG_EDITOR = "BTN_TAG_EDITOR"
 BTN_CONVERT_VIDEO_TO_CIRCLE = "BTN_CONVERT_VIDEO_TO_CIRCLE"
 BTN_CONVERT_VIDEO_TO_GIF = "BTN_CONVERT_VIDEO_TO_GIF"
@@ -260,6 +267,52 @@ keys = {
         "en": "The ending point should be greater than starting point",
         "fa": "زمان پایان باید از زمان شروع بزرگتر باشد.",
     },
+    ERR_ON_CONVERTING: {
+        "en": f"Sorry, I couldn't convert your file... {REPORT_BUG_MESSAGE_EN}",
+        "fa": f"متاسفم، نتونستم فایلت رو تبدیل کنم... {REPORT_BUG_MESSAGE_FA}",
+    },
+    ERR_SERVER_BUSY: {
+        "en": "I'm processing too many files right now. Please try again in a minute.",
+        "fa": "الان سرم خیلی شلوغه و دارم فایل های زیادی رو پردازش می کنم. لطفا یک دقیقه دیگه دوباره امتحان کن.",
+    },
+    ERR_NOT_ENOUGH_COINS: {
+        "en": "You don't have enough coins for this. You can buy more from your profile.",
+        "fa": "سکه کافی برای این کار نداری. می تونی از پروفایلت سکه بخری.",
+    },
+    ADMIN_STATS: {
+        "en": "👥 Users: {users}\n"
+              "🔥 Active today: {active_today}\n\n"
+              "📊 Files processed in the last 7 days:\n{operations}\n\n"
+              "⏳ Media jobs: {running} running, {waiting} waiting, {capacity} at most, {rejected} rejected, {coalesced} shared\n"
+              "📬 Users with queued updates: {busy_users} ({queued} updates)\n"
+              "🗄 Database connections: {in_use}/{size} in use, longest wait {wait_seconds_max:.2f}s\n"
+              "💾 Output cache: {cache_hits} hits, {cache_misses} misses, {cache_entries} files, "
+              "{cache_bytes} bytes, {cache_evictions} evicted\n"
+              "📥 Downloads: {downloads} downloaded, {shared} shared with other users\n\n"
+              "🕒 Updated {age} seconds ago",
+        "fa": "👥 کاربران: {users}\n"
+              "🔥 کاربران فعال امروز: {active_today}\n\n"
+              "📊 فایل های پردازش شده در 7 روز گذشته:\n{operations}\n\n"
+              "⏳ پردازش ها: {running} در حال اجرا، {waiting} در صف، حداکثر {capacity}، {rejected} رد شده، {coalesced} مشترک\n"
+              "📬 کاربران با پیام در صف: {busy_users} ({queued} پیام)\n"
+              "🗄 اتصال های پایگاه داده: {in_use}/{size} در حال استفاده، بیشترین انتظار {wait_seconds_max:.2f} ثانیه\n"
+              "💾 کش خروجی ها: {cache_hits} موفق، {cache_misses} ناموفق، {cache_entries} فایل، "
+              "{cache_bytes} بایت، {cache_evictions} حذف شده\n"
+              "📥 دانلود ها: {downloads} دانلود شده، {shared} مشترک با کاربران دیگر\n\n"
+              "🕒 {age} ثانیه پیش به روز شده",
+    },
+    ADMIN_STATS_OPERATION: {
+        "en": "{operation}: {events} ({failed} failed), {average_ms} ms on average",
+        "fa": "{operation}: {events} ({failed} ناموفق)، به طور میانگین {average_ms} میلی ثانیه",
+    },
+    ADMIN_STATS_NOT_READY: {
+        "en": "The statistics are still being computed, please try again in a minute.",
+        "fa": "آمار هنوز در حال محاسبه است، لطفا یک دقیقه دیگه دوباره امتحان کن.",
+    },
+    EXPORT_HELP: {
+        "en": "Send /export followed by what to export: {names}",
+        "fa": "بعد از /export بنویس چه چیزی رو می خوای: {names}",
+    },
     BTN_TAG_EDITOR: {
         "en": "🎵 Tag Editor",
         "fa": "🎵 تغییر تگ ها",
@@ -0,0 +1,17 @@
+# pylint: disable=invalid-name
+
+from orator.migrations import Migration
+
+
+class CreateUserDataTable(Migration):
+
+    def up(self):
+        with self.schema.create('user_data') as table:
+            table.big_integer('user_id')
+            table.long_text('data')
+            table.timestamp('updated_at').use_current()
+
+            table.primary('user_id')
+
+    def down(self):
+        self.schema.drop('user_data')
@@ -0,0 +1,22 @@
+# pylint: disable=invalid-name
+
+from orator.migrations import Migration
+
+
+class CreateUsageEventsTable(Migration):
+
+    def up(self):
+        with self.schema.create('usage_events') as table:
+            table.big_increments('id')
+            table.big_integer('user_id')
+            table.string('operation', 32)
+            table.big_integer('input_size').default(0)
+            table.integer('duration').default(0)
+            table.integer('processing_ms').default(0)
+            table.string('outcome', 16)
+            table.timestamp('created_at')
+
+            table.index('created_at')
+
+    def down(self):
+        self.schema.drop('usage_events')
@@ -0,0 +1,22 @@
+# pylint: disable=invalid-name
+
+from orator.migrations import Migration
+
+
+class CreateDailyUsageTable(Migration):
+
+    def up(self):
+        with self.schema.create('daily_usage') as table:
+            table.date('day')
+            table.string('operation', 32)
+            table.string('outcome', 16)
+            table.integer('events').default(0)
+            table.integer('unique_users').default(0)
+            table.big_integer('input_bytes').default(0)
+            table.big_integer('media_seconds').default(0)
+            table.big_integer('processing_ms').default(0)
+
+            table.primary(['day', 'operation', 'outcome'])
+
+    def down(self):
+        self.schema.drop('daily_usage')
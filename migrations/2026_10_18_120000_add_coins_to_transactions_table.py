@@ -0,0 +1,44 @@
+# pylint: disable=invalid-name
+
+from datetime import datetime
+
+from orator.migrations import Migration
+
+# Matches `repositories.ledger.OPENING_BANK`
+OPENING_BANK = 'opening'
+BATCH_SIZE = 500
+
+
+class AddCoinsToTransactionsTable(Migration):
+
+    def up(self):
+        with self.schema.table('transactions') as table:
+            table.integer('coins').default(0)
+
+            table.index('user_id')
+
+        # The balances from before the ledger become the users' first rows, so that
+        # `users.coin` is the sum of their rows from here on
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [
+            {
+                'user_id': user['user_id'],
+                'transaction_code': f"{OPENING_BANK}-{user['user_id']}",
+                'amount': 0,
+                'bank': OPENING_BANK,
+                'coins': user['coin'],
+                'created_at': now,
+                'updated_at': now,
+            }
+            for user in self.db.table('users').where('coin', '!=', 0).select('user_id', 'coin').get()
+        ]
+
+        for start in range(0, len(rows), BATCH_SIZE):
+            self.db.table('transactions').insert(rows[start:start + BATCH_SIZE])
+
+    def down(self):
+        self.db.table('transactions').where('bank', OPENING_BANK).delete()
+
+        with self.schema.table('transactions') as table:
+            table.drop_index('transactions_user_id_index')
+            table.drop_column('coins')
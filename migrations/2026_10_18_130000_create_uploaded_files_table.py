@@ -0,0 +1,17 @@
+# pylint: disable=invalid-name
+
+from orator.migrations import Migration
+
+
+class CreateUploadedFilesTable(Migration):
+
+    def up(self):
+        with self.schema.create('uploaded_files') as table:
+            table.string('cache_key', 64)
+            table.string('file_id', 255)
+            table.timestamps()
+
+            table.primary('cache_key')
+
+    def down(self):
+        self.schema.drop('uploaded_files')
@@ -0,0 +1,6 @@
+from orator import Model
+
+
+class DailyUsage(Model):
+    __table__ = 'daily_usage'
+    __timestamps__ = False
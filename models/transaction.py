@@ -0,0 +1,5 @@
+from orator import Model
+
+
+class Transaction(Model):
+    __fillable__ = ['user_id', 'transaction_code', 'amount', 'bank', 'coins']
@@ -0,0 +1,5 @@
+from orator import Model
+
+
+class UploadedFile(Model):
+    __fillable__ = ['cache_key', 'file_id']
@@ -0,0 +1,6 @@
+from orator import Model
+
+
+class UsageEvent(Model):
+    __timestamps__ = False
+    __fillable__ = ['user_id', 'operation', 'input_size', 'duration', 'processing_ms', 'outcome', 'created_at']
@@ -0,0 +1,49 @@
+import os
+import time
+import threading
+
+from typing import Dict
+
+from models.admin import Admin
+from repositories.user import USER_CACHE_TTL
+
+OWNER_USER_ID = int(os.getenv("OWNER_USER_ID")) if os.getenv("OWNER_USER_ID") else 0
+
+
+class AdminRepository:
+    """Answers whether a user is an admin from an in-memory copy of the `admins` table.
+
+    The table is tiny, so it's read as a whole and again after `ttl` seconds.
+    `OWNER_USER_ID` is always an owner, whether it's in the table or not.
+    """
+
+    def __init__(self, ttl: int = USER_CACHE_TTL, owner_user_id: int = OWNER_USER_ID) -> None:
+        self.ttl = ttl
+        self.owner_user_id = owner_user_id
+        self._admins: Dict[int, bool] = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[int, bool]:
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+                self._admins = {
+                    admin.admin_user_id: bool(admin.is_owner)
+                    for admin in Admin.select('admin_user_id', 'is_owner').get()
+                }
+                self._loaded_at = time.monotonic()
+
+            return self._admins
+
+    def is_admin(self, user_id: int) -> bool:
+        return user_id == self.owner_user_id or user_id in self._load()
+
+    def is_owner(self, user_id: int) -> bool:
+        return user_id == self.owner_user_id or self._load().get(user_id, False)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = None
+
+
+admins = AdminRepository()
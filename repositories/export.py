@@ -0,0 +1,98 @@
+import os
+import csv
+import gzip
+import logging
+
+from typing import Iterator, List
+
+logger = logging.getLogger()
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE")) if os.getenv("EXPORT_CHUNK_SIZE") else 1000
+
+EXPORTS = {
+    'users': ('users', [
+        'id', 'user_id', 'username', 'language', 'coin', 'number_of_files_sent', 'created_at', 'updated_at'
+    ]),
+    'usage': ('usage_events', [
+        'id', 'user_id', 'operation', 'input_size', 'duration', 'processing_ms', 'outcome', 'created_at'
+    ]),
+    'daily_usage': ('daily_usage', [
+        'day', 'operation', 'outcome', 'events', 'unique_users', 'input_bytes', 'media_seconds', 'processing_ms'
+    ]),
+    'transactions': ('transactions', [
+        'id', 'user_id', 'transaction_code', 'amount', 'bank', 'coins', 'created_at', 'updated_at'
+    ]),
+}
+
+
+def _server_side_cursor(connection):
+    """A cursor that fetches rows from the server as they're read instead of all at once."""
+    if connection.get_config('driver') == 'mysql':
+        # pylint: disable=import-outside-toplevel
+        from orator.connectors.mysql_connector import mysql
+
+        return connection.get_read_connection().cursor(mysql.cursors.SSDictCursor)
+
+    # sqlite3 cursors step through the results lazily anyway
+    return connection.get_read_connection().cursor()
+
+
+def stream_rows(db, table: str, columns: List[str], chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[List[dict]]:
+    """Read a whole table in chunks of `chunk_size` rows through a server-side cursor.
+
+    A pooled connection stays checked out until the generator is exhausted or closed.
+
+    **Keyword arguments:**
+     - db (PooledDatabaseManager) -- The database to read from
+     - table (str) -- The table to read
+     - columns (list) -- The columns to read
+     - chunk_size (int) -- The number of rows fetched at once
+
+    **Returns:**
+     An iterator over lists of rows
+    """
+    grammar = db.connection().get_query_grammar()
+    query = f"SELECT {grammar.columnize(columns)} FROM {grammar.wrap_table(table)}"
+
+    with db.connection().pool.checkout() as connection:
+        cursor = _server_side_cursor(connection)
+        try:
+            cursor.execute(query)
+
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(chunk_size)
+        finally:
+            # Unread rows of an unbuffered cursor have to be consumed before the connection is reused
+            cursor.close()
+
+
+def export_csv(db, name: str, path: str, chunk_size: int = EXPORT_CHUNK_SIZE) -> int:
+    """Write the export called `name` to `path` as gzipped CSV while it's read.
+
+    Only one chunk of rows is held in memory at any time.
+
+    **Keyword arguments:**
+     - db (PooledDatabaseManager) -- The database to read from
+     - name (str) -- One of `EXPORTS`
+     - path (str) -- The file to write
+     - chunk_size (int) -- The number of rows fetched at once
+
+    **Returns:**
+     The number of exported rows
+    """
+    table, columns = EXPORTS[name]
+    count = 0
+
+    with gzip.open(path, 'wt', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+
+        for rows in stream_rows(db, table, columns, chunk_size):
+            writer.writerows([row[column] for column in columns] for row in rows)
+            count += len(rows)
+
+    logger.info("Exported %s rows of %s", count, table)
+
+    return count
@@ -0,0 +1,262 @@
+import os
+import uuid
+import logging
+import threading
+
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict
+
+from models.transaction import Transaction
+from repositories.user import ADD, UserRepository, upsert_rows, users as default_users
+
+logger = logging.getLogger()
+
+COIN_COST_PER_JOB = int(os.getenv("COIN_COST_PER_JOB")) if os.getenv("COIN_COST_PER_JOB") else 0
+LEDGER_FLUSH_INTERVAL = int(os.getenv("LEDGER_FLUSH_INTERVAL")) if os.getenv("LEDGER_FLUSH_INTERVAL") else 10
+LEDGER_RECONCILE_INTERVAL = int(os.getenv("LEDGER_RECONCILE_INTERVAL")) \
+    if os.getenv("LEDGER_RECONCILE_INTERVAL") else 3600
+LEDGER_FLUSH_BATCH_SIZE = 500
+LEDGER_RECONCILE_BATCH_SIZE = 500
+
+DEBIT_BANK = 'coins'
+# The rows the migration to the ledger opened the balances from before it with
+OPENING_BANK = 'opening'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class CoinLedger:
+    """Keeps `users.coin` as the materialized sum of the user's rows in `transactions`.
+
+    Purchases are credited right away: the ledger row and the balance change are written
+    in one transaction, and a `transaction_code` that was already recorded is ignored, so
+    a payment callback can safely be delivered more than once.
+
+    Coins spent on media jobs are only subtracted in memory; `flush` writes the net change
+    of every user as one ledger row plus one multi-row balance update, so a job never
+    waits for a row lock. Balances already include the changes that aren't written yet;
+    a balance read while a flush is being written waits for it, so that it never counts
+    the flushed changes both in `users.coin` and in memory.
+
+    `reconcile` checks every balance against the sum of the user's rows once in a while
+    and repairs the ones that drifted, e.g. through a manual edit.
+
+    **Keyword arguments:**
+     - repository (UserRepository) -- Where the balances are read from
+    """
+
+    def __init__(self, repository: UserRepository = default_users) -> None:
+        self.users = repository
+        self._pending: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Odd while a flush is being written; counts up so readers notice flushes in between
+        self._flush_epoch = 0
+        self._flushed = threading.Condition(self._lock)
+
+    def balance(self, user_id: int) -> int:
+        """The number of coins the user has, including the changes that aren't written yet."""
+        while True:
+            with self._lock:
+                self._flushed.wait_for(lambda: self._flush_epoch % 2 == 0)
+                epoch = self._flush_epoch
+
+            user = self.users.get(user_id)
+            coins = user.coin if user is not None else 0
+
+            with self._lock:
+                # Otherwise `users.coin` may or may not include what was flushed meanwhile
+                if self._flush_epoch == epoch:
+                    return coins + self._pending.get(user_id, 0)
+
+    def debit(self, user_id: int, coins: int) -> bool:
+        """Spend `coins` of the user's coins unless they don't have that many.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - coins (int) -- The number of coins to spend
+
+        **Returns:**
+         Whether the coins were spent
+        """
+        if self.balance(user_id) < coins:
+            return False
+
+        self.refund(user_id, -coins)
+
+        return True
+
+    def refund(self, user_id: int, coins: int) -> None:
+        """Give back `coins` spent with `debit`, e.g. when the job they paid for failed."""
+        if not coins:
+            return
+
+        with self._lock:
+            self._pending[user_id] = self._pending.get(user_id, 0) + coins
+
+    def credit(self, user_id: int, transaction_code: str, coins: int, amount, bank: str) -> bool:
+        """Record a purchase and add its coins to the user's balance.
+
+        The user is created if they don't exist yet.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - transaction_code (str) -- The payment provider's unique code for the payment
+         - coins (int) -- The number of coins bought
+         - amount (Decimal) -- The amount paid
+         - bank (str) -- The payment provider
+
+        **Returns:**
+         `False` if the transaction was already recorded
+        """
+        connection = Transaction.resolve_connection()
+        marker = connection.get_query_grammar().get_marker()
+        ignore = "INSERT OR IGNORE" if connection.get_config('driver') == 'sqlite' else "INSERT IGNORE"
+        now = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+
+        with connection.transaction():
+            inserted = connection.affecting_statement(
+                f"{ignore} INTO transactions "
+                "(user_id, transaction_code, amount, bank, coins, created_at, updated_at) "
+                f"VALUES ({', '.join([marker] * 7)})",
+                [user_id, transaction_code, str(Decimal(str(amount))), bank, coins, now, now]
+            )
+            if inserted:
+                upsert_rows(connection, 'users', ['user_id', 'coin'], {'coin': ADD}, [(user_id, coins)])
+
+        if not inserted:
+            logger.info("Transaction %s was already recorded", transaction_code)
+            return False
+
+        self.users.invalidate(user_id, written=True)
+
+        return True
+
+    def flush(self) -> None:
+        """Write the coins spent and refunded since the last flush in batches."""
+        with self._flush_lock:
+            with self._lock:
+                pending = {user_id: coins for user_id, coins in self._pending.items() if coins}
+                self._pending = {}
+
+                if not pending:
+                    return
+
+                self._flush_epoch += 1
+
+            connection = Transaction.resolve_connection()
+            now = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+            rows = list(pending.items())
+
+            try:
+                with connection.transaction():
+                    for start in range(0, len(rows), LEDGER_FLUSH_BATCH_SIZE):
+                        batch = rows[start:start + LEDGER_FLUSH_BATCH_SIZE]
+                        Transaction.insert([
+                            {
+                                'user_id': user_id,
+                                'transaction_code': f"debit-{uuid.uuid4().hex}",
+                                'amount': 0,
+                                'bank': DEBIT_BANK,
+                                'coins': coins,
+                                'created_at': now,
+                                'updated_at': now,
+                            }
+                            for user_id, coins in batch
+                        ])
+                        upsert_rows(connection, 'users', ['user_id', 'coin'], {'coin': ADD}, batch)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Couldn't write the coin changes of %s users, will retry", len(rows))
+                with self._lock:
+                    for user_id, coins in pending.items():
+                        self._pending[user_id] = self._pending.get(user_id, 0) + coins
+                    self._end_flush()
+                return
+
+            with self._lock:
+                for user_id in pending:
+                    self.users.invalidate(user_id, written=True)
+                self._end_flush()
+
+            logger.debug("Wrote the coin changes of %s users", len(rows))
+
+    def reconcile(self, batch_size: int = LEDGER_RECONCILE_BATCH_SIZE) -> int:
+        """Set the `users.coin` that don't match the sum of the user's ledger rows to that sum.
+
+        Users are compared in batches, each in a single query on the primary, so a balance
+        and its rows are always read at the same point in time. Other shards may serve a
+        repaired balance from their cache until it expires.
+
+        **Keyword arguments:**
+         - batch_size (int) -- The number of users compared per query
+
+        **Returns:**
+         The number of balances repaired
+        """
+        connection = Transaction.resolve_connection()
+        marker = connection.get_query_grammar().get_marker()
+        repaired = 0
+        last_user_id = None
+
+        try:
+            while True:
+                after = f"WHERE users.user_id > {marker} " if last_user_id is not None else ''
+                rows = connection.select(
+                    "SELECT users.user_id, users.coin, COALESCE(SUM(transactions.coins), 0) AS ledger "
+                    "FROM users LEFT JOIN transactions ON transactions.user_id = users.user_id "
+                    f"{after}GROUP BY users.user_id, users.coin ORDER BY users.user_id LIMIT {int(batch_size)}",
+                    [last_user_id] if last_user_id is not None else [],
+                    use_read_connection=False
+                )
+                if not rows:
+                    break
+
+                last_user_id = rows[-1]['user_id']
+                drifted = [row['user_id'] for row in rows if int(row['coin']) != int(row['ledger'])]
+
+                if drifted:
+                    # Recomputed in the update itself, in case a flush landed since the select
+                    connection.update(
+                        "UPDATE users SET coin = (SELECT COALESCE(SUM(coins), 0) FROM transactions "
+                        "WHERE transactions.user_id = users.user_id) "
+                        f"WHERE user_id IN ({', '.join([marker] * len(drifted))})",
+                        drifted
+                    )
+                    for user_id in drifted:
+                        self.users.invalidate(user_id, written=True)
+
+                    logger.warning("Repaired the coin balances of %s users: %s", len(drifted), drifted)
+                    repaired += len(drifted)
+
+                if len(rows) < batch_size:
+                    break
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Couldn't reconcile the coin balances, will retry")
+
+        return repaired
+
+    def _end_flush(self) -> None:
+        # Called with `_lock` held
+        self._flush_epoch += 1
+        self._flushed.notify_all()
+
+
+ledger = CoinLedger()
+
+
+def handle_payment_callback(payload: dict) -> bool:
+    """Credit a payment reported by the payment provider, see `CoinLedger.credit`.
+
+    **Keyword arguments:**
+     - payload (dict) -- `user_id`, `transaction_code`, `coins`, `amount` and `bank`
+
+    **Returns:**
+     `False` if the payment was already credited
+    """
+    return ledger.credit(
+        int(payload['user_id']),
+        str(payload['transaction_code']),
+        int(payload['coins']),
+        Decimal(str(payload['amount'])),
+        str(payload['bank'])
+    )
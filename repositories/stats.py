@@ -0,0 +1,130 @@
+import os
+import time
+import logging
+import threading
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+from models.daily_usage import DailyUsage
+from models.usage_event import UsageEvent
+from models.user import User
+from repositories.usage import TIMESTAMP_FORMAT
+
+logger = logging.getLogger()
+
+STATS_REFRESH_INTERVAL = int(os.getenv("STATS_REFRESH_INTERVAL")) if os.getenv("STATS_REFRESH_INTERVAL") else 300
+STATS_DAYS = 7
+
+# `cached` jobs were answered from the output cache, `shared` ones by an identical job
+SUCCESSFUL_OUTCOMES = ('ok', 'cached', 'shared')
+
+
+class StatsSnapshot:
+    """The aggregates the admin statistics are served from."""
+
+    __slots__ = ('users', 'active_today', 'operations', 'refreshed_at')
+
+    def __init__(self) -> None:
+        self.users = 0
+        self.active_today = 0
+        # operation -> (events, failed events, average processing ms) over the last days
+        self.operations = {}
+        self.refreshed_at: Optional[float] = None
+
+
+class StatsAggregator:
+    """Computes the admin statistics when they're asked for and reuses them for a while.
+
+    Every shard has its own aggregator, so the statistics are only computed by the shard
+    the admin's `/stats` goes to, at most once every `max_age` seconds.
+
+    The number of users is counted incrementally: every refresh only counts the rows with
+    an `id` above the highest one seen so far, which is a range scan of the primary key
+    instead of a `COUNT(*)` over the whole table. Everything else comes from today's usage
+    events and the `daily_usage` rollups of the days before, which both stay small.
+    """
+
+    def __init__(self) -> None:
+        self._snapshot = StatsSnapshot()
+        self._users = 0
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def snapshot(self) -> StatsSnapshot:
+        with self._lock:
+            return self._snapshot
+
+    def _count_users(self) -> int:
+        row = User.where('id', '>', self._last_id).select_raw('COUNT(*) AS count, MAX(id) AS last_id').first()
+        if row is not None and row.count:
+            self._users += row.count
+            self._last_id = row.last_id
+
+        return self._users
+
+    def refresh_if_stale(self, max_age: int = STATS_REFRESH_INTERVAL) -> StatsSnapshot:
+        """The snapshot, recomputed first if it's older than `max_age` seconds.
+
+        **Keyword arguments:**
+         - max_age (int) -- How old a snapshot may be in seconds
+
+        **Returns:**
+         The snapshot, never refreshed if computing it failed
+        """
+        refreshed_at = self.snapshot.refreshed_at
+        if refreshed_at is None or time.time() - refreshed_at > max_age:
+            self.refresh()
+
+        return self.snapshot
+
+    def refresh(self) -> None:
+        """Recompute the snapshot."""
+        with self._refresh_lock:
+            snapshot = StatsSnapshot()
+            today = datetime.utcnow().date()
+            midnight = datetime(today.year, today.month, today.day).strftime(TIMESTAMP_FORMAT)
+
+            try:
+                snapshot.users = self._count_users()
+                snapshot.active_today = UsageEvent.where('created_at', '>=', midnight) \
+                    .select_raw('COUNT(DISTINCT user_id) AS count').first().count
+
+                # Today isn't rolled up yet, or only partially
+                rows = list(
+                    DailyUsage.where('day', '>', (today - timedelta(days=STATS_DAYS)).isoformat())
+                    .where('day', '<', today.isoformat())
+                    .group_by('operation', 'outcome')
+                    .select_raw('operation, outcome, SUM(events) AS events, SUM(processing_ms) AS processing_ms')
+                    .get()
+                )
+                rows += list(
+                    UsageEvent.where('created_at', '>=', midnight)
+                    .group_by('operation', 'outcome')
+                    .select_raw('operation, outcome, COUNT(*) AS events, SUM(processing_ms) AS processing_ms')
+                    .get()
+                )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Couldn't refresh the statistics")
+                return
+
+            for row in rows:
+                events, failed, processing_ms = snapshot.operations.get(row.operation, (0, 0, 0))
+                events += int(row.events)
+                failed += int(row.events) if row.outcome not in SUCCESSFUL_OUTCOMES else 0
+                processing_ms += int(row.processing_ms or 0)
+                snapshot.operations[row.operation] = (events, failed, processing_ms)
+
+            snapshot.operations = {
+                operation: (events, failed, processing_ms // events if events else 0)
+                for operation, (events, failed, processing_ms) in sorted(snapshot.operations.items())
+            }
+            snapshot.refreshed_at = time.time()
+
+            with self._lock:
+                self._snapshot = snapshot
+
+
+stats = StatsAggregator()
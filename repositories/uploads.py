@@ -0,0 +1,81 @@
+import os
+import logging
+import threading
+
+from typing import Optional
+
+from cachetools import LRUCache
+
+from models.uploaded_file import UploadedFile
+from repositories.user import upsert_statement
+
+logger = logging.getLogger()
+
+UPLOAD_INDEX_CACHE_SIZE = int(os.getenv("UPLOAD_INDEX_CACHE_SIZE")) if os.getenv("UPLOAD_INDEX_CACHE_SIZE") else 10000
+
+
+class UploadIndex:
+    """Remembers the Telegram `file_id` every output was uploaded as, by its `cache_key`.
+
+    Telegram sends a file again by its `file_id` without it being uploaded, so an output
+    that was sent once is never uploaded again, by any worker. The index lives in the
+    `uploaded_files` table; the most recently used `file_id`s are kept in memory.
+
+    **Keyword arguments:**
+     - maxsize (int) -- The number of `file_id`s kept in memory
+    """
+
+    def __init__(self, maxsize: int = UPLOAD_INDEX_CACHE_SIZE) -> None:
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def file_id(self, key: str) -> Optional[str]:
+        """The `file_id` the output with the given `cache_key` was uploaded as, if it was."""
+        with self._lock:
+            file_id = self._cache.get(key)
+
+        if file_id is not None:
+            return file_id
+
+        try:
+            row = UploadedFile.where('cache_key', key).select('file_id').first()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Couldn't look up the upload of %s", key)
+            return None
+
+        # Misses aren't cached, another worker may upload the output any time
+        if row is None:
+            return None
+
+        with self._lock:
+            self._cache[key] = row.file_id
+
+        return row.file_id
+
+    def remember(self, key: str, file_id: str) -> None:
+        """Record that the output with the given `cache_key` was uploaded as `file_id`."""
+        with self._lock:
+            self._cache[key] = file_id
+
+        connection = UploadedFile.resolve_connection()
+
+        try:
+            query = upsert_statement(
+                connection, 'uploaded_files', ['cache_key', 'file_id'], {'file_id': None}, key='cache_key'
+            )
+            connection.statement(query, [key, file_id])
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Couldn't record the upload of %s", key)
+
+    def forget(self, key: str) -> None:
+        """Drop a `file_id` Telegram doesn't accept anymore."""
+        with self._lock:
+            self._cache.pop(key, None)
+
+        try:
+            UploadedFile.where('cache_key', key).delete()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Couldn't forget the upload of %s", key)
+
+
+uploads = UploadIndex()
@@ -0,0 +1,134 @@
+import os
+import logging
+import threading
+
+from collections import deque
+from datetime import date, datetime, timedelta
+
+from models.daily_usage import DailyUsage
+from models.usage_event import UsageEvent
+
+logger = logging.getLogger()
+
+USAGE_EVENT_FLUSH_INTERVAL = int(os.getenv("USAGE_EVENT_FLUSH_INTERVAL")) \
+    if os.getenv("USAGE_EVENT_FLUSH_INTERVAL") else 10
+USAGE_EVENT_BUFFER_SIZE = int(os.getenv("USAGE_EVENT_BUFFER_SIZE")) if os.getenv("USAGE_EVENT_BUFFER_SIZE") else 10000
+USAGE_ROLLUP_INTERVAL = int(os.getenv("USAGE_ROLLUP_INTERVAL")) if os.getenv("USAGE_ROLLUP_INTERVAL") else 3600
+USAGE_EVENT_BATCH_SIZE = 500
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class UsageRecorder:
+    """Logs one `usage_events` row per media operation and rolls them up into `daily_usage`.
+
+    Events are buffered in memory and inserted in multi-row batches by `flush`. When the
+    database is unreachable for long, the buffer keeps the newest `max_buffered` events
+    and drops the oldest ones.
+
+    `rollup` aggregates a day's events per operation and outcome; it replaces the day's
+    rows, so running it again while the day is still going simply brings them up to date.
+    """
+
+    def __init__(self, max_buffered: int = USAGE_EVENT_BUFFER_SIZE) -> None:
+        self._buffer = deque(maxlen=max_buffered)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def record(
+        self,
+        user_id: int,
+        operation: str,
+        outcome: str,
+        input_size: int = 0,
+        duration: int = 0,
+        processing_ms: int = 0
+    ) -> None:
+        """Buffer a usage event; it's written on the next `flush`.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - operation (str) -- What was done, e.g. `video_to_gif`
+         - outcome (str) -- How it went, e.g. `ok`, `failed` or `rejected`
+         - input_size (int) -- The size of the input file in bytes
+         - duration (int) -- The duration of the input media in seconds
+         - processing_ms (int) -- How long the processing took
+        """
+        event = {
+            'user_id': user_id,
+            'operation': operation,
+            'input_size': input_size or 0,
+            'duration': duration or 0,
+            'processing_ms': processing_ms,
+            'outcome': outcome,
+            'created_at': datetime.utcnow().strftime(TIMESTAMP_FORMAT),
+        }
+
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                logger.warning("Usage event buffer is full, dropping the oldest event")
+            self._buffer.append(event)
+
+    def flush(self) -> None:
+        """Insert the buffered events in batched multi-row inserts."""
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._buffer)
+                self._buffer.clear()
+
+            if not events:
+                return
+
+            connection = UsageEvent.resolve_connection()
+
+            try:
+                with connection.transaction():
+                    for start in range(0, len(events), USAGE_EVENT_BATCH_SIZE):
+                        UsageEvent.insert(events[start:start + USAGE_EVENT_BATCH_SIZE])
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Couldn't write %s usage events, will retry", len(events))
+                with self._lock:
+                    # Back in front of the events recorded meanwhile, as long as there's room
+                    room = self._buffer.maxlen - len(self._buffer)
+                    if room:
+                        self._buffer.extendleft(reversed(events[-room:]))
+                return
+
+            logger.debug("Wrote %s usage events", len(events))
+
+    def rollup(self, day: date) -> None:
+        """Recompute the `daily_usage` rows of `day` (UTC) from its usage events.
+
+        **Keyword arguments:**
+         - day (date) -- The day to aggregate
+        """
+        connection = DailyUsage.resolve_connection()
+        marker = connection.get_query_grammar().get_marker()
+        start = datetime(day.year, day.month, day.day)
+        end = start + timedelta(days=1)
+
+        with connection.transaction():
+            DailyUsage.where('day', '=', day.isoformat()).delete()
+            connection.statement(
+                "INSERT INTO daily_usage "
+                "(day, operation, outcome, events, unique_users, input_bytes, media_seconds, processing_ms) "
+                f"SELECT {marker}, operation, outcome, COUNT(*), COUNT(DISTINCT user_id), "
+                "SUM(input_size), SUM(duration), SUM(processing_ms) "
+                f"FROM usage_events WHERE created_at >= {marker} AND created_at < {marker} "
+                "GROUP BY operation, outcome",
+                [day.isoformat(), start.strftime(TIMESTAMP_FORMAT), end.strftime(TIMESTAMP_FORMAT)]
+            )
+
+    def rollup_recent(self) -> None:
+        """Bring today's and yesterday's rollups up to date, the scheduled job."""
+        self.flush()
+
+        today = datetime.utcnow().date()
+        for day in (today - timedelta(days=1), today):
+            try:
+                self.rollup(day)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Couldn't roll up the usage of %s", day)
+
+
+usage = UsageRecorder()
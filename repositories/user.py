@@ -0,0 +1,304 @@
+import os
+import logging
+import threading
+
+from typing import Dict, List, Optional
+
+from cachetools import TTLCache
+
+from dbConfig import DB_READ_STICKINESS
+from models.user import User
+
+logger = logging.getLogger()
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE")) if os.getenv("USER_CACHE_SIZE") else 10000
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL")) if os.getenv("USER_CACHE_TTL") else 600
+USAGE_FLUSH_INTERVAL = int(os.getenv("USAGE_FLUSH_INTERVAL")) if os.getenv("USAGE_FLUSH_INTERVAL") else 10
+USAGE_FLUSH_BATCH_SIZE = 500
+
+ADD = object()
+
+
+def upsert_statement(
+    connection,
+    table: str,
+    columns: List[str],
+    updates: Dict[str, object],
+    rows: int = 1,
+    key: str = 'user_id'
+) -> str:
+    """Build an `INSERT` that updates the existing row instead when `key` already exists.
+
+    **Keyword arguments:**
+     - connection (Connection) -- The orator connection the statement is for
+     - table (str) -- The table to insert into
+     - columns (list) -- The inserted columns, bound in this order
+     - updates (dict) -- The columns to change on conflict, mapped to `None` to take the
+       inserted value or to `ADD` to add the inserted value to the stored one
+     - rows (int) -- The number of rows inserted at once
+     - key (str) -- The unique column the conflicts are on
+
+    **Returns:**
+     The SQL statement
+    """
+    marker = connection.get_query_grammar().get_marker()
+    driver = connection.get_config('driver')
+    inserted = "excluded.{}" if driver == 'sqlite' else "VALUES({})"
+
+    assignments = ", ".join(
+        f"{column} = {column} + {inserted.format(column)}" if update is ADD
+        else f"{column} = {inserted.format(column)}"
+        for column, update in updates.items()
+    )
+    values = f"({', '.join([marker] * len(columns))}, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"
+    query = f"INSERT INTO {table} ({', '.join(columns)}, created_at, updated_at) " \
+            f"VALUES {', '.join([values] * rows)} "
+
+    if driver == 'sqlite':
+        return query + f"ON CONFLICT({key}) DO UPDATE SET {assignments}, updated_at = CURRENT_TIMESTAMP"
+
+    return query + f"ON DUPLICATE KEY UPDATE {assignments}, updated_at = CURRENT_TIMESTAMP"
+
+
+def upsert_rows(
+    connection,
+    table: str,
+    columns: List[str],
+    updates: Dict[str, object],
+    rows: List[tuple],
+    key: str = 'user_id'
+) -> None:
+    """Write `rows` like `upsert_statement` does, but change the rows that exist with a plain
+    `UPDATE` and only upsert the others.
+
+    An upsert takes an `AUTO_INCREMENT` value for every row, even when it updates one, so
+    frequent batches of upserts of known users would run through the ids.
+
+    **Keyword arguments:**
+     - connection (Connection) -- The orator connection to write with
+     - table (str) -- The table to write to
+     - columns (list) -- The columns of each row, `key` included
+     - updates (dict) -- The columns to change on existing rows, see `upsert_statement`
+     - rows (list) -- The rows to write, as tuples in the order of `columns`
+     - key (str) -- The unique column identifying a row
+    """
+    marker = connection.get_query_grammar().get_marker()
+    key_index = columns.index(key)
+    keys = [row[key_index] for row in rows]
+
+    existing = {
+        row[key] for row in connection.select(
+            f"SELECT {key} FROM {table} WHERE {key} IN ({', '.join([marker] * len(keys))})",
+            keys,
+            use_read_connection=False
+        )
+    }
+
+    updated = [row for row in rows if row[key_index] in existing]
+    if updated:
+        assignments = []
+        bindings = []
+        for column, update in updates.items():
+            index = columns.index(column)
+            cases = " ".join([f"WHEN {marker} THEN {marker}"] * len(updated))
+            value = f"CASE {key} {cases} END"
+            assignments.append(f"{column} = {column} + {value}" if update is ADD else f"{column} = {value}")
+            bindings += [value for row in updated for value in (row[key_index], row[index])]
+
+        connection.update(
+            f"UPDATE {table} SET {', '.join(assignments)}, updated_at = CURRENT_TIMESTAMP "
+            f"WHERE {key} IN ({', '.join([marker] * len(updated))})",
+            bindings + [row[key_index] for row in updated]
+        )
+
+    inserted = [row for row in rows if row[key_index] not in existing]
+    if inserted:
+        # Still an upsert, in case another process inserted the row meanwhile
+        connection.statement(
+            upsert_statement(connection, table, columns, updates, rows=len(inserted), key=key),
+            [value for row in inserted for value in row]
+        )
+
+
+class UserRepository:
+    """Reads and writes `User` rows through an in-process cache.
+
+    Reads are served from a TTL/LRU cache; every write goes to the database first and is
+    then applied to the cached row, so the cache never holds data the database doesn't.
+    The TTL bounds how long a change made by another process can go unnoticed.
+
+    Writes that depend on the stored values are single statements evaluated by the
+    database, so concurrent updates of the same user from several workers never get lost.
+
+    Sent files are counted in memory and written behind by `flush_counters`: one
+    multi-row update adds up the counts of all the users that sent files since the last
+    flush, see `upsert_rows`. Cached rows already include the counts that aren't written yet.
+
+    Rows are read from a replica if there are any, except for users written within the
+    last `stickiness` seconds: they're read from the primary, so they always see their
+    own changes even if the replicas lag behind.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = USER_CACHE_SIZE,
+        ttl: int = USER_CACHE_TTL,
+        stickiness: int = DB_READ_STICKINESS
+    ) -> None:
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._written = TTLCache(maxsize=maxsize, ttl=stickiness)
+        self._lock = threading.Lock()
+        self._pending: Dict[int, List] = {}
+        self._flushing: Dict[int, List] = {}
+        self._flush_lock = threading.Lock()
+
+    def _cached(self, user_id: int) -> Optional[User]:
+        with self._lock:
+            return self._cache.get(user_id)
+
+    def _remember(self, user: User) -> None:
+        with self._lock:
+            self._cache[user.user_id] = user
+
+    def _wrote(self, user_id: int) -> None:
+        with self._lock:
+            self._written[user_id] = True
+
+    def get(self, user_id: int) -> Optional[User]:
+        """The user with the given `user_id`, or `None` if they never started the bot."""
+        user = self._cached(user_id)
+        if user is not None:
+            return user
+
+        with self._lock:
+            recently_written = user_id in self._written
+
+        query = User.where('user_id', '=', user_id)
+        if recently_written:
+            query = query.use_write_connection()
+
+        user = query.first()
+        if user is not None:
+            with self._lock:
+                # Counts that aren't written yet
+                for pending in (self._pending.get(user_id), self._flushing.get(user_id)):
+                    if pending:
+                        user.number_of_files_sent = user.number_of_files_sent + pending[0]
+                self._cache[user_id] = user
+
+        return user
+
+    def upsert(self, user_id: int, username: str) -> None:
+        """Create the user, or refresh their username if they already exist."""
+        try:
+            upsert_rows(
+                User.resolve_connection(), 'users', ['user_id', 'username'], {'username': None}, [(user_id, username)]
+            )
+        except Exception:
+            self.invalidate(user_id)
+            raise
+
+        self._wrote(user_id)
+
+        user = self._cached(user_id)
+        if user is not None:
+            user.username = username
+
+    def update(self, user_id: int, **values) -> None:
+        """Write `values` to the user's row, skipping the query if the cached row has them.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - values -- The columns to set
+        """
+        user = self._cached(user_id)
+        if user is not None:
+            values = {column: value for column, value in values.items() if getattr(user, column) != value}
+            if not values:
+                return
+
+        try:
+            User.where('user_id', '=', user_id).update(values)
+        except Exception:
+            self.invalidate(user_id)
+            raise
+
+        self._wrote(user_id)
+
+        if user is not None:
+            for column, value in values.items():
+                setattr(user, column, value)
+
+    def increment_files_sent(self, user_id: int, username: str) -> None:
+        """Count a file sent by the user and refresh their username on the next flush.
+
+        The user is created if they don't exist yet.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - username (str) -- The current username of the user
+        """
+        with self._lock:
+            pending = self._pending.setdefault(user_id, [0, username])
+            pending[0] += 1
+            pending[1] = username
+
+            user = self._cache.get(user_id)
+            if user is not None:
+                user.username = username
+                user.number_of_files_sent = user.number_of_files_sent + 1
+
+    def flush_counters(self) -> None:
+        """Write the counts gathered since the last flush in batched multi-row upserts."""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._flushing = self._pending
+                self._pending = {}
+
+            if not pending:
+                return
+
+            connection = User.resolve_connection()
+            rows = [(user_id, username, count) for user_id, (count, username) in pending.items()]
+
+            try:
+                with connection.transaction():
+                    for start in range(0, len(rows), USAGE_FLUSH_BATCH_SIZE):
+                        upsert_rows(
+                            connection,
+                            'users',
+                            ['user_id', 'username', 'number_of_files_sent'],
+                            {'username': None, 'number_of_files_sent': ADD},
+                            rows[start:start + USAGE_FLUSH_BATCH_SIZE]
+                        )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Couldn't write the usage counters of %s users, will retry", len(rows))
+                with self._lock:
+                    for user_id, (count, username) in pending.items():
+                        merged = self._pending.setdefault(user_id, [0, username])
+                        merged[0] += count
+                    self._flushing = {}
+                return
+
+            with self._lock:
+                self._flushing = {}
+                for user_id in pending:
+                    self._written[user_id] = True
+
+            logger.debug("Wrote the usage counters of %s users", len(rows))
+
+    def invalidate(self, user_id: int, written: bool = False) -> None:
+        """Drop the cached row of the user.
+
+        **Keyword arguments:**
+         - user_id (int) -- The user id of the user
+         - written (bool) -- Whether their row was just written elsewhere, so it's read
+           from the primary for a while
+        """
+        with self._lock:
+            self._cache.pop(user_id, None)
+            if written:
+                self._written[user_id] = True
+
+
+users = UserRepository()
@@ -1,7 +1,7 @@
 import os
 import re
+import json
 import logging
-import subprocess
 import requests
 
 import ffmpy
@@ -15,11 +15,19 @@ from telegram import ReplyKeyboardMarkup
 from telegram.ext import CallbackContext
 
 from models.admin import Admin
-from models.user import User
+from repositories.user import users
 from localization import keys
+from utils.aio import remove_file
+from utils.blobs import blobs, detach
+from utils.ffmpeg import FFmpegResult
+from utils.output_cache import cache_key, output_cache
+from utils.profiles import ANIMATION, VOICE_NOTE, output_path_for, transcode
+from utils.session import TagEditor
 
 logger = logging.getLogger()
 
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR") if os.getenv("DOWNLOAD_DIR") else 'downloads'
+
 def translate_key_to(key: str, destination_lang: str) -> str:
     """Find the specified key in the `keys` dictionary and returns the corresponding
     value for the given language
@@ -46,12 +54,11 @@ def delete_file(file_path: str) -> None:
         os.remove(file_path)
 
 
-def generate_music_info(tag_editor_context: dict) -> str:
+def generate_music_info(tag_editor_context: TagEditor) -> str:
     """Generate the details of the music based on the values in `tag_editor_context`
-    dictionary
 
     **Keyword arguments:**
-     - tag_editor_context (dict) -- The context object of the user
+     - tag_editor_context (TagEditor) -- The tag editor of the user
 
     **Returns:**
      `str`
@@ -59,86 +66,34 @@ def generate_music_info(tag_editor_context: dict) -> str:
     ctx = tag_editor_context
 
     return (
-        f"*🗣 Artist:* {ctx['artist'] if ctx['artist'] else '-'}\n"
-        f"*🎵 Title:* {ctx['title'] if ctx['title'] else '-'}\n"
-        f"*🎼 Album:* {ctx['album'] if ctx['album'] else '-'}\n"
-        f"*🎹 Genre:* {ctx['genre'] if ctx['genre'] else '-'}\n"
-        f"*📅 Year:* {ctx['year'] if ctx['year'] else '-'}\n"
-        f"*💿 Disk Number:* {ctx['disknumber'] if ctx['disknumber'] else '-'}\n"
-        f"*▶️ Track Number:* {ctx['tracknumber'] if ctx['tracknumber'] else '-'}\n"
+        f"*🗣 Artist:* {ctx.artist if ctx.artist else '-'}\n"
+        f"*🎵 Title:* {ctx.title if ctx.title else '-'}\n"
+        f"*🎼 Album:* {ctx.album if ctx.album else '-'}\n"
+        f"*🎹 Genre:* {ctx.genre if ctx.genre else '-'}\n"
+        f"*📅 Year:* {ctx.year if ctx.year else '-'}\n"
+        f"*💿 Disk Number:* {ctx.disknumber if ctx.disknumber else '-'}\n"
+        f"*▶️ Track Number:* {ctx.tracknumber if ctx.tracknumber else '-'}\n"
         "{}\n"
     )
 
 
-def increment_usage_counter_for_user(user_id: int) -> int:
-    """Increment the `number_of_files_sent` column of user with the specified `user_id`.
+def increment_usage_counter_for_user(user_id: int, username: str) -> None:
+    """Increment the `number_of_files_sent` column of user with the specified `user_id`
+    and refresh their username. Both are written behind, see `UserRepository.flush_counters`.
 
     **Keyword arguments:**
      - user_id (int) -- The user id of the user
-
-    **Returns:**
-     The new value for `user.number_of_files_sent`
+     - username (str) -- The current username of the user
     """
-    user = User.where('user_id', '=', user_id).first()
-
-    if user:
-        user.number_of_files_sent = user.number_of_files_sent + 1
-        user.push()
-
-        return user.number_of_files_sent
-
-    raise LookupError(f'User with id {user_id} not found.')
+    users.increment_files_sent(user_id, username)
 
 def reset_user_data_context(context: CallbackContext) -> None:
     user_data = context.user_data
-    language = user_data['language'] if ('language' in user_data) else 'en'
-
-    if 'voice_path' in user_data:
-        delete_file(user_data['voice_path'])
-    if 'voice_art_path' in user_data:
-        delete_file(user_data['voice_art_path'])
-    if 'new_voice_art_path' in user_data:
-        delete_file(user_data['new_voice_art_path'])
-    if 'music_path' in user_data:
-        delete_file(user_data['music_path'])
-    if 'art_path' in user_data:
-        delete_file(user_data['art_path'])
-    if 'new_art_path' in user_data:
-        delete_file(user_data['new_art_path'])
-    if 'video_path' in user_data:
-        delete_file(user_data['video_path'])
-    if 'video_art_path' in user_data:
-        delete_file(user_data['video_art_path'])
-    if 'new_video_art_path' in user_data:
-        delete_file(user_data['new_video_art_path'])
-    if 'gif' in user_data:
-        delete_file(user_data['gif'])
-
-    new_user_data = {
-        'convert_video_to_gif': False,
-        'convert_video_to_circle': False,
-        'convert_audio_to_voice': False,
-        'edit_tag_music': False,
-        'download_from_link': False,
-        'voice_path': '',
-        'voice_art_path': '',
-        'new_voice_art_path': '',
-        'video_path': '',
-        'video_art_path': '',
-        'new_video_art_path': '',
-        'gif': '',
-        'video_message_id': '',
-        'video_duration': '',
-        'tag_editor': {},
-        'music_path': '',
-        'music_duration': 0,
-        'art_path': '',
-        'new_art_path': '',
-        'current_active_module': '',
-        'music_message_id': 0,
-        'language': language,
-    }
-    context.user_data.update(new_user_data)
+
+    for file_path in user_data.temporary_files():
+        delete_file(file_path)
+
+    user_data.reset()
 
 def create_user_directory(user_id: int) -> str:
     """Create a directory for a user with a given id.
@@ -149,7 +104,7 @@ def create_user_directory(user_id: int) -> str:
     **Returns:**
      The path of the created directory
     """
-    user_download_dir = f"downloads/{user_id}"
+    user_download_dir = f"{DOWNLOAD_DIR}/{user_id}"
 
     try:
         Path(user_download_dir).mkdir(parents=True, exist_ok=True)
@@ -178,58 +133,139 @@ def convert_seconds_to_human_readable_form(seconds: int) -> str:
 
     return f"{minutes_formatted}:{seconds_formatted}"
 
-def download_file(user_id: int, file_to_download, file_type: str, context: CallbackContext) -> str:
-    """Download a file using convenience methods of "python-telegram-bot"
+def download_path_for(user_id: int, file_to_download, file_type: str) -> str:
+    """The path `download_file` saves a file to, known before downloading it
 
     **Keyword arguments:**
      - user_id (int) -- The user's id
      - file_to_download (*) -- The file object to download
-     - file_type (str) -- The type of the file, either 'photo' or 'audio'
-     - context (CallbackContext) -- The context object of the user
+     - file_type (str) -- The type of the file, either 'photo', 'audio', 'video' or 'voice'
 
     **Returns:**
-     The path of the downloaded file
+     The path of the file once downloaded
     """
-    user_download_dir = f"downloads/{user_id}"
-    file_id = ''
     file_extension = ''
 
-    if file_type == 'audio':
-        file_id = context.bot.get_file(file_to_download.file_id)
-        file_name = file_to_download.file_name
-        file_extension = file_name.split(".")[-1]
+    if file_type in ('audio', 'video'):
+        file_extension = file_to_download.file_name.split(".")[-1]
     elif file_type == 'photo':
-        file_id = context.bot.get_file(file_to_download.file_id)
         file_extension = 'jpg'
-    elif file_type == 'video':
-        file_id = context.bot.get_file(file_to_download.file_id)
-        file_name = file_to_download.file_name
-        file_extension = file_name.split(".")[-1]
     elif file_type == 'voice':
-        file_id = context.bot.get_file(file_to_download.file_id)
-        mime_type = file_to_download.mime_type
-        file_extension = mime_type.split("/")[-1]
+        file_extension = file_to_download.mime_type.split("/")[-1]
 
-        # voice_path = voice_path.split("/")[-1]
+    return f"{DOWNLOAD_DIR}/{user_id}/{file_to_download.file_id}.{file_extension}"
 
-        # mime_type = voice_path.split(".")[-1]
-        # voice = voice_path.split(".")[0]
+def download_file(user_id: int, file_to_download, file_type: str, context: CallbackContext) -> str:
+    """Download a file using convenience methods of "python-telegram-bot"
 
-        # # logger.error(voice_path)
-        # new_voice = ffmpegcommand(file_id.file_id, file_extension)
-        # os.system(new_voice)
+    **Keyword arguments:**
+     - user_id (int) -- The user's id
+     - file_to_download (*) -- The file object to download
+     - file_type (str) -- The type of the file, either 'photo' or 'audio'
+     - context (CallbackContext) -- The context object of the user
+
+    **Returns:**
+     The path of the downloaded file
+    """
+    file_download_path = download_path_for(user_id, file_to_download, file_type)
+
+    return ensure_downloaded(
+        file_to_download.file_id,
+        file_to_download.file_unique_id,
+        file_download_path,
+        context,
+        force=True
+    )
 
-        # logger.error(new_voice)
-        # logger.error(file_id.file_id)
+def ensure_downloaded(
+    file_id: str,
+    file_unique_id: str,
+    file_path: str,
+    context: CallbackContext,
+    force: bool = False
+) -> str:
+    """Download the file with the given `file_id` to `file_path` unless it's already there.
+
+    Files are only downloaded once an operation needs them, so a file whose outputs are
+    all cached is never downloaded at all. They're downloaded into the shared `blobs`
+    and linked to `file_path`, so a file sent by many users is only downloaded once.
+
+    **Keyword arguments:**
+     - file_id (str) -- The Telegram `file_id` of the file
+     - file_unique_id (str) -- The Telegram `file_unique_id` of the file
+     - file_path (str) -- Where the file is kept
+     - context (CallbackContext) -- The context object of the user
+     - force (bool) -- Put it there again even if it's there
 
-    file_download_path = f"{user_download_dir}/{file_id.file_id}.{file_extension}"
+    **Returns:**
+     The path of the downloaded file
+    """
+    if not force and os.path.exists(file_path):
+        return file_path
 
     try:
-        file_id.download(f"{user_download_dir}/{file_id.file_id}.{file_extension}")
+        if not file_unique_id:
+            # Remembered before sessions kept the `file_unique_id`
+            context.bot.get_file(file_id).download(file_path)
+            return file_path
+
+        return blobs.fetch(context.bot, file_id, file_unique_id, file_path)
     except ValueError as error:
         raise Exception(f"Couldn't download the file with file_id: {file_id}") from error
 
-    return file_download_path
+def read_music_tags(file_path: str) -> (dict, bytes):
+    """Read the tags the tag editor shows and the album art of a music file
+
+    **Keyword arguments:**
+     - file_path (str) -- The path of the music file
+
+    **Returns:**
+     The tags by name and the album art, `None` if it has none
+    """
+    music = music_tag.load_file(file_path)
+    art = music['artwork']
+
+    tags = {name: str(music[name]) for name in ('artist', 'title', 'album', 'genre')}
+    tags.update({name: str(music.raw[name]) for name in ('year', 'disknumber', 'tracknumber')})
+
+    return tags, art.first.data if art else None
+
+def cache_music_tags(file_unique_id: str, tags: dict, art) -> None:
+    """Keep what `read_music_tags` read in the output cache, so the file isn't downloaded
+    just to read its tags when it's sent again.
+
+    **Keyword arguments:**
+     - file_unique_id (str) -- The `file_unique_id` of the music file
+     - tags (dict) -- The tags by name
+     - art (bytes) -- The album art, `None` if it has none
+    """
+    output_cache.write(
+        cache_key(file_unique_id, 'tags'),
+        json.dumps(dict(tags, has_art=art is not None)).encode()
+    )
+    if art is not None:
+        output_cache.write(cache_key(file_unique_id, 'art'), art)
+
+def cached_music_tags(file_unique_id: str):
+    """The tags and album art cached by `cache_music_tags`
+
+    **Keyword arguments:**
+     - file_unique_id (str) -- The `file_unique_id` of the music file
+
+    **Returns:**
+     The tags by name and the album art, or `None` if they aren't cached
+    """
+    encoded = output_cache.read(cache_key(file_unique_id, 'tags'))
+    if encoded is None:
+        return None
+
+    tags = json.loads(encoded)
+    if not tags.pop('has_art'):
+        return tags, None
+
+    art = output_cache.read(cache_key(file_unique_id, 'art'))
+
+    return (tags, art) if art is not None else None
 
 def generate_back_button_keyboard(language: str) -> ReplyKeyboardMarkup:
     """Create an return an instance of `back_button_keyboard`
@@ -442,11 +478,11 @@ def save_text_into_tag(
     """
     if is_number:
         if isinstance(int(value), int):
-            context.user_data['tag_editor'][current_tag] = value
+            setattr(context.user_data.tag_editor, current_tag, value)
         else:
-            context.user_data['tag_editor'][current_tag] = 0
+            setattr(context.user_data.tag_editor, current_tag, 0)
     else:
-        context.user_data['tag_editor'][current_tag] = value
+        setattr(context.user_data.tag_editor, current_tag, value)
 
 def generate_module_coin_pay(language: str) -> ReplyKeyboardMarkup:
         return (
@@ -488,18 +524,20 @@ def generate_tag_editor_video_keyboard(language: str) -> ReplyKeyboardMarkup:
         )
     )
 
-def save_tags_to_file(file: str, tags: dict, new_art_path: str) -> str:
+def save_tags_to_file(file: str, tags: TagEditor, new_art_path: str) -> str:
     """Create an return an instance of `tag_editor_keyboard`
 
 
     **Keyword arguments:**
      - file (str) -- The path of the file
-     - tags (str) -- The dictionary containing the tags and their values
+     - tags (TagEditor) -- The tags and their values
      - new_art_path (str) -- The new album art to set
 
     **Returns:**
      The path of the file
     """
+    # The file may be linked to a blob other users' files are linked to as well
+    detach(file)
     music = music_tag.load_file(file)
 
     try:
@@ -509,13 +547,13 @@ def save_tags_to_file(file: str, tags: dict, new_art_path: str) -> str:
     except OSError as error:
         raise Exception("Couldn't set hashtags") from error
 
-    music['artist'] = tags['artist'] if tags['artist'] else ''
-    music['title'] = tags['title'] if tags['title'] else ''
-    music['album'] = tags['album'] if tags['album'] else ''
-    music['genre'] = tags['genre'] if tags['genre'] else ''
-    music['year'] = int(tags['year']) if tags['year'] else 0
-    music['disknumber'] = int(tags['disknumber']) if tags['disknumber'] else 0
-    music['tracknumber'] = int(tags['tracknumber']) if tags['tracknumber'] else 0
+    music['artist'] = tags.artist if tags.artist else ''
+    music['title'] = tags.title if tags.title else ''
+    music['album'] = tags.album if tags.album else ''
+    music['genre'] = tags.genre if tags.genre else ''
+    music['year'] = int(tags.year) if tags.year else 0
+    music['disknumber'] = int(tags.disknumber) if tags.disknumber else 0
+    music['tracknumber'] = int(tags.tracknumber) if tags.tracknumber else 0
 
     music.save()
 
@@ -566,25 +604,17 @@ def ffmpegcommand(voice, mime_type):
     # print(cmd)
     return cmd
 
-def myffmpegcommand(user_data):
-    input_voice_path = user_data['voice_path']
-    input_voice_path = input_voice_path.split(".")[0]
-    new_mime_type = ".mp3"
-    music_path = input_voice_path + new_mime_type
+async def myffmpegcommand(voice_path: str) -> FFmpegResult:
+    """Turn an audio file into a voice note next to it, see `utils.profiles.VOICE_NOTE`"""
+    voice_note_path = output_path_for(voice_path, VOICE_NOTE)
 
-    # music_path = f"{user_data['voice_path']}.mp3"
-    # user_data['current_active_module'] = 'mp3_to_voice_converter'  # TODO: Make modules a dict
+    result = await transcode(VOICE_NOTE, voice_path, voice_note_path)
+    if not result.ok:
+        await remove_file(voice_note_path)
 
-    os.system(
-        f"ffmpeg -i -y {input_voice_path} -ac 1 -map 0:a -codec:a opus -b:a 128k -vbr off \
-         {input_voice_path}"
-    )
-    os.system(f"ffmpeg -i {input_voice_path} -c:a libvorbis -q:a 4 {music_path}")
-
-    logging.error(input_voice_path)
-    logging.error(music_path)
+    return result
 
-    # new_voice_path = user_data['new_voice_art_path']
+    # new_voice_path = user_data.new_voice_art_path
 
     # voice = voice_path.split(".")[0]
     # new_mime_type = ".mp3"
@@ -593,9 +623,9 @@ def myffmpegcommand(user_data):
     # subprocess.run(["ffmpeg -i {voice_path} -map 0:a -acodec libmp3lame {new_voice}"])
     
     # subprocess.run(["ffmpeg", "-n", "-i", voice_path, "-acodec", "libmp3lame", "-ab", "128k", new_voice])
-    # user_data['new_voice_art_path'] = new_voice
-    # delete_file(user_data['voice_path'])
-    # logging.info(user_data['new_voice_art_path'])
+    # user_data.new_voice_art_path = new_voice
+    # delete_file(user_data.voice_path)
+    # logging.info(user_data.new_voice_art_path)
     # return
     # codec = "libmp3lame"
     # mp3_filename = filename + ".mp3"
@@ -627,16 +657,13 @@ def myffmpegcommand(user_data):
     # result = requests.post(upload_audio_url, files=file)
     # return result
 
-def video_to_gif(video_path, user_data):
-    video = video_path.split(".")[0]
-    new_mime_type = ".gif"
-    gif = video + new_mime_type
+async def video_to_gif(video_path: str, gif_path: str) -> FFmpegResult:
+    """Turn a video into an animation, see `utils.profiles.ANIMATION`"""
+    result = await transcode(ANIMATION, video_path, gif_path)
+    if not result.ok:
+        await remove_file(gif_path)
 
-    # logging.error(new_video)
-    # subprocess.run(["ffmpeg", "-i", video_path, "-pix_fmt", "rgb24", gif])
-    # subprocess.run(["ffmpeg", "-i", video_path, "-movflags", "faststart", "-pix_fmt", "yuv420p", "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2", gif])
-    subprocess.run(["ffmpeg", "-ss", "00:00:00.000", "-i", video_path, "-pix_fmt", "rgb24", "-r", "10", "-s", "320x240", "-t", "00:00:10.000", gif])
-    user_data['gif'] = gif
+    return result
 
 
     # subprocess(["ffmpeg -f gif -i " {video_path outfile.mp4}])
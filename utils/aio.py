@@ -0,0 +1,82 @@
+import os
+import asyncio
+import logging
+import functools
+import threading
+
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger()
+
+
+class AsyncRuntime:
+    """An asyncio event loop running on its own thread.
+
+    Media jobs are coroutines scheduled here: waiting on an ffmpeg child process or on disk
+    I/O costs no thread, so thousands of jobs can be in flight at once while the dispatcher
+    threads only deal with Telegram updates.
+    """
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._run, name='asyncio-runtime', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine: Awaitable) -> Future:
+        """Schedule `coroutine` on the loop from any thread.
+
+        **Keyword arguments:**
+         - coroutine (Awaitable) -- The coroutine to run
+
+        **Returns:**
+         A `concurrent.futures.Future` resolving to the coroutine's result
+        """
+        self.start()
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self) -> None:
+        """Stop the loop once the currently scheduled callbacks ran and wait for the thread."""
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+
+
+runtime = AsyncRuntime()
+
+
+async def run_blocking(function: Callable[..., Any], *args: Any) -> Any:
+    """Run a blocking function on the loop's default thread pool and await its result."""
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(None, functools.partial(function, *args))
+
+
+async def remove_file(file_path: str) -> None:
+    """Non-blocking counterpart of `utils.delete_file`."""
+    if file_path:
+        await run_blocking(_remove_if_exists, file_path)
+
+
+def _remove_if_exists(file_path: str) -> None:
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,181 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+from typing import Dict
+
+from cachetools import TTLCache
+
+logger = logging.getLogger()
+
+BLOB_DIR = os.getenv("BLOB_DIR") if os.getenv("BLOB_DIR") else 'cache/blobs'
+BLOB_IDLE_SECONDS = int(os.getenv("BLOB_IDLE_SECONDS")) if os.getenv("BLOB_IDLE_SECONDS") else 3600
+BLOB_COLLECT_INTERVAL = int(os.getenv("BLOB_COLLECT_INTERVAL")) if os.getenv("BLOB_COLLECT_INTERVAL") else 600
+# Telegram keeps a file's download link valid for at least an hour
+GET_FILE_TTL = 3600
+GET_FILE_CACHE_SIZE = 10000
+
+
+def detach(file_path: str) -> None:
+    """Give a file that's linked to a blob its own copy, so it can be changed in place
+    without changing the blob and every other user's file.
+
+    **Keyword arguments:**
+     - file_path (str) -- The path of the file
+    """
+    if os.stat(file_path).st_nlink == 1:
+        return
+
+    directory, name = os.path.split(file_path)
+    with tempfile.NamedTemporaryFile(dir=directory or '.', prefix=f".{name}.", delete=False) as temporary:
+        pass
+
+    try:
+        shutil.copy2(file_path, temporary.name)
+        os.replace(temporary.name, file_path)
+    except OSError:
+        if os.path.exists(temporary.name):
+            os.remove(temporary.name)
+        raise
+
+
+class BlobStore:
+    """Telegram files downloaded once for all users, keyed by their `file_unique_id`.
+
+    Users get hard links to the blobs in their own folders, so deleting a user's file works
+    as before and the file system counts the references: a blob nobody links to anymore
+    is removed by `collect` once it was unused for `idle_seconds`. Files that get changed
+    in place have to be `detach`ed first.
+
+    Concurrent downloads of the same file wait for the first one instead of downloading
+    it again, and the results of `get_file` are reused while their download link is valid.
+
+    **Keyword arguments:**
+     - directory (str) -- Where the blobs are kept
+     - idle_seconds (int) -- How long an unreferenced blob is kept for the next user
+    """
+
+    def __init__(self, directory: str = BLOB_DIR, idle_seconds: int = BLOB_IDLE_SECONDS) -> None:
+        self.directory = directory
+        self.idle_seconds = idle_seconds
+        self._files = TTLCache(maxsize=GET_FILE_CACHE_SIZE, ttl=GET_FILE_TTL)
+        self._downloads: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._metrics = {'downloads': 0, 'shared': 0, 'collected': 0}
+
+    def open(self) -> None:
+        """Create the directory; called at startup, nothing touches the disk before."""
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, file_unique_id: str) -> str:
+        return os.path.join(self.directory, file_unique_id)
+
+    def _get_file(self, bot, file_id: str, file_unique_id: str):
+        with self._lock:
+            telegram_file = self._files.get(file_unique_id)
+
+        if telegram_file is None:
+            telegram_file = bot.get_file(file_id)
+            with self._lock:
+                self._files[file_unique_id] = telegram_file
+
+        return telegram_file
+
+    def _download(self, bot, file_id: str, file_unique_id: str) -> str:
+        path = self._path(file_unique_id)
+
+        with self._lock:
+            download_lock = self._downloads.setdefault(file_unique_id, threading.Lock())
+
+        with download_lock:
+            try:
+                if os.path.exists(path):
+                    with self._lock:
+                        self._metrics['shared'] += 1
+                    return path
+
+                with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', delete=False) as temporary:
+                    pass
+
+                try:
+                    self._get_file(bot, file_id, file_unique_id).download(temporary.name)
+                    os.replace(temporary.name, path)
+                except BaseException:
+                    # The download link may have expired early
+                    with self._lock:
+                        self._files.pop(file_unique_id, None)
+                    if os.path.exists(temporary.name):
+                        os.remove(temporary.name)
+                    raise
+
+                with self._lock:
+                    self._metrics['downloads'] += 1
+            finally:
+                with self._lock:
+                    self._downloads.pop(file_unique_id, None)
+
+        return path
+
+    def fetch(self, bot, file_id: str, file_unique_id: str, destination: str) -> str:
+        """Put the Telegram file at `destination`, downloading it only if no one did before.
+
+        **Keyword arguments:**
+         - bot (Bot) -- The bot to download the file with
+         - file_id (str) -- The `file_id` of the file
+         - file_unique_id (str) -- The `file_unique_id` of the file
+         - destination (str) -- Where the user's file goes
+
+        **Returns:**
+         The destination
+        """
+        path = self._download(bot, file_id, file_unique_id)
+
+        if os.path.exists(destination):
+            os.remove(destination)
+
+        try:
+            os.link(path, destination)
+        except FileNotFoundError:
+            # Collected in the meantime
+            return self.fetch(bot, file_id, file_unique_id, destination)
+        except OSError:
+            # Across file systems, or on file systems without hard links
+            shutil.copyfile(path, destination)
+
+        return destination
+
+    def collect(self) -> None:
+        """Remove the blobs no user links to that weren't used for `idle_seconds`; runs on
+        a schedule."""
+        idle_since = time.time() - self.idle_seconds
+        collected = 0
+
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+
+            with self._lock:
+                if entry.name in self._downloads:
+                    continue
+
+                stat = entry.stat()
+                # Removing the last link changes the blob's ctime
+                if stat.st_nlink == 1 and stat.st_ctime < idle_since:
+                    os.remove(entry.path)
+                    collected += 1
+
+        with self._lock:
+            self._metrics['collected'] += collected
+
+        if collected:
+            logger.info("Removed %s unused blobs", collected)
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._metrics)
+
+
+blobs = BlobStore()
@@ -0,0 +1,176 @@
+import os
+import logging
+import functools
+import threading
+
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+logger = logging.getLogger()
+
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS")) if os.getenv("DISPATCH_WORKERS") else 16
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE")) if os.getenv("DISPATCH_BATCH_SIZE") else 8
+
+
+class UserSerialDispatcher:
+    """Runs work for different users in parallel and work for the same user strictly in order.
+
+    Every user gets a mailbox. The first item posted to an empty mailbox schedules a drain
+    on the pool; later items are appended and picked up by that same drain, so at most one
+    thread touches a user's `user_data` at any time. A drain hands its thread back after
+    `batch_size` items so one chatty user can't starve the others.
+    """
+
+    def __init__(
+        self,
+        dispatcher=None,
+        workers: int = DISPATCH_WORKERS,
+        batch_size: int = DISPATCH_BATCH_SIZE
+    ) -> None:
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='user-dispatch')
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._mailboxes: Dict[Hashable, deque] = {}
+        self._holds = Counter()
+
+    def post(self, key: Hashable, work: Callable[..., Any], *args: Any) -> None:
+        """Queue `work(*args)` behind everything already queued for `key`.
+
+        **Keyword arguments:**
+         - key (Hashable) -- The mailbox to post into, usually the user id
+         - work (callable) -- The function to run
+         - args -- Positional arguments for `work`
+        """
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is not None:
+                mailbox.append((work, args))
+                return
+
+            self._mailboxes[key] = deque([(work, args)])
+
+        self._pool.submit(self._drain, key)
+
+    def is_busy(self, key: Hashable) -> bool:
+        """Whether there's queued or running work for `key`."""
+        with self._lock:
+            return key in self._mailboxes
+
+    def pending(self, key: Hashable) -> int:
+        """The number of items queued for `key` and not started yet."""
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            return len(mailbox) if mailbox is not None else 0
+
+    def hold(self, key: Hashable) -> None:
+        """Mark `key` as having work outside its mailbox, e.g. a media job that will post back."""
+        with self._lock:
+            self._holds[key] += 1
+
+    def release(self, key: Hashable) -> None:
+        with self._lock:
+            self._holds[key] -= 1
+            if self._holds[key] <= 0:
+                del self._holds[key]
+
+    def is_held(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._holds
+
+    def stats(self) -> Dict[str, int]:
+        """The number of users with queued work, the queued items and the held users."""
+        with self._lock:
+            return {
+                'busy_users': len(self._mailboxes),
+                'queued': sum(len(mailbox) for mailbox in self._mailboxes.values()),
+                'held_users': len(self._holds),
+            }
+
+    def wrap(self, callback: Callable[[Update, CallbackContext], Any]) -> Callable:
+        """Turn a handler callback into one that posts itself into the user's mailbox.
+
+        **Keyword arguments:**
+         - callback (callable) -- A python-telegram-bot handler callback
+
+        **Returns:**
+         A callback that returns to the dispatcher immediately
+        """
+        @functools.wraps(callback)
+        def enqueue(update: Update, context: CallbackContext) -> None:
+            key = mailbox_key_for(update)
+            if key is None:
+                callback(update, context)
+                return
+
+            self.post(key, self._run_handler, callback, update, context)
+
+        return enqueue
+
+    def _run_handler(self, callback: Callable, update: Update, context: CallbackContext) -> None:
+        # pylint: disable=protected-access
+        if self.dispatcher is not None and context._user_id_and_data is not None:
+            # The user may have been evicted between building the context and now; the
+            # handler has to change the data that's resident, or its changes get lost
+            user_id = context._user_id_and_data[0]
+            context._user_id_and_data = (user_id, self.dispatcher.user_data[user_id])
+
+        callback(update, context)
+
+        if self.dispatcher is not None:
+            # The dispatcher already persisted this update before the callback ran here
+            self.dispatcher.update_persistence(update=update)
+
+    def _drain(self, key: Hashable) -> None:
+        for _ in range(self.batch_size):
+            with self._lock:
+                mailbox = self._mailboxes[key]
+                if not mailbox:
+                    self._close_mailbox(key)
+                    return
+
+                work, args = mailbox.popleft()
+
+            try:
+                work(*args)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error while processing work for %s", key)
+
+        with self._lock:
+            if not self._mailboxes[key]:
+                self._close_mailbox(key)
+                return
+
+        self._pool.submit(self._drain, key)
+
+    def _close_mailbox(self, key: Hashable) -> None:
+        del self._mailboxes[key]
+        if not self._mailboxes:
+            self._idle.notify_all()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the pool. With `wait`, every mailbox is drained first."""
+        if wait:
+            with self._idle:
+                self._idle.wait_for(lambda: not self._mailboxes)
+
+        self._pool.shutdown(wait=wait)
+
+
+def mailbox_key_for(update: Update) -> Hashable:
+    """The mailbox an update belongs to: its user, or its chat for updates without one."""
+    if not isinstance(update, Update):
+        return None
+
+    if update.effective_user:
+        return update.effective_user.id
+
+    if update.effective_chat:
+        return update.effective_chat.id
+
+    return None
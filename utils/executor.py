@@ -0,0 +1,177 @@
+import os
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from utils.aio import AsyncRuntime, runtime as default_runtime
+
+logger = logging.getLogger()
+
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS")) if os.getenv("MEDIA_WORKERS") else (os.cpu_count() or 2)
+MEDIA_QUEUE_SIZE = int(os.getenv("MEDIA_QUEUE_SIZE")) if os.getenv("MEDIA_QUEUE_SIZE") else 32
+
+
+class TranscodeExecutor:
+    """A bounded executor for CPU-heavy media jobs.
+
+    Jobs are coroutine functions run on the asyncio runtime; at most `workers` of them run
+    at once and each one awaits an ffmpeg child process instead of blocking a thread. At
+    most `workers + max_pending` jobs are accepted at once and `submit` refuses the rest
+    instead of queueing without bound.
+
+    Jobs submitted with a `key` while a job with the same key is in flight don't run at
+    all: they take no slot and get the result of the job in flight, `None` if it raised,
+    just like the job in flight does.
+    """
+
+    def __init__(
+        self,
+        workers: int = MEDIA_WORKERS,
+        max_pending: int = MEDIA_QUEUE_SIZE,
+        runtime: AsyncRuntime = default_runtime
+    ) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.runtime = runtime
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._running = None
+        self._counts_lock = threading.Lock()
+        self._accepted = 0
+        self._active = 0
+        self._rejected = 0
+        self._coalesced = 0
+        # key -> the completion callbacks of the jobs sharing the job in flight
+        self._in_flight: Dict[Hashable, List[Callable[[Any], None]]] = {}
+
+    def submit(
+        self,
+        job: Callable[[], Awaitable],
+        on_done: Callable[[Any], None],
+        key: Optional[Hashable] = None
+    ) -> bool:
+        """Schedule `job` and call `on_done` with its result once it finishes, or with
+        `None` if it raised.
+
+        `on_done` runs on the event loop thread, so it should only hand the result over,
+        e.g. post it into the user's mailbox.
+
+        If a job with the same `key` is in flight, `job` isn't run and `on_done` is called
+        with that job's result instead, or with `None` if that job raised.
+
+        **Keyword arguments:**
+         - job (callable) -- A coroutine function called without arguments
+         - on_done (callable) -- Called with the result of `job`
+         - key (hashable) -- Identifies the work `job` does, e.g. its input and parameters
+
+        **Returns:**
+         `False` if the executor is saturated and the job was not accepted
+        """
+        if key is not None and self._share(key, on_done):
+            return True
+
+        if not self._slots.acquire(blocking=False):
+            logger.warning("Transcode executor is saturated, rejecting a job.")
+            with self._counts_lock:
+                self._rejected += 1
+            return False
+
+        # An identical job may have been accepted in the meantime
+        if key is not None and self._share(key, on_done, register=True):
+            self._slots.release()
+            return True
+
+        try:
+            future = self.runtime.submit(self._run(job))
+        except RuntimeError:
+            self._slots.release()
+            for callback in self._take_sharing(key):
+                self._call(callback, None)
+            return False
+
+        with self._counts_lock:
+            self._accepted += 1
+
+        future.add_done_callback(lambda done: self._complete(done, on_done, key))
+
+        return True
+
+    async def _run(self, job: Callable[[], Awaitable]) -> Any:
+        if self._running is None:
+            # Created lazily so that it binds to the runtime's loop
+            self._running = asyncio.Semaphore(self.workers)
+
+        async with self._running:
+            with self._counts_lock:
+                self._active += 1
+            try:
+                return await job()
+            finally:
+                with self._counts_lock:
+                    self._active -= 1
+
+    def _share(self, key: Hashable, on_done: Callable[[Any], None], register: bool = False) -> bool:
+        with self._counts_lock:
+            sharing = self._in_flight.get(key)
+            if sharing is None:
+                if register:
+                    self._in_flight[key] = []
+                return False
+
+            sharing.append(on_done)
+            self._coalesced += 1
+
+            return True
+
+    def _take_sharing(self, key: Optional[Hashable]) -> List[Callable[[Any], None]]:
+        if key is None:
+            return []
+
+        with self._counts_lock:
+            return self._in_flight.pop(key, [])
+
+    def _complete(self, future: Future, on_done: Callable[[Any], None], key: Optional[Hashable]) -> None:
+        self._slots.release()
+        with self._counts_lock:
+            self._accepted -= 1
+
+        # Jobs submitted from now on run again, e.g. to retry a failure
+        sharing = self._take_sharing(key)
+
+        try:
+            result = future.result()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("A transcode job failed.")
+            result = None
+
+        # The job's own callback and the callbacks sharing it get the same result
+        for callback in (on_done, *sharing):
+            self._call(callback, result)
+
+    @staticmethod
+    def _call(callback: Callable[[Any], None], result: Any) -> None:
+        try:
+            callback(result)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("A transcode completion callback failed.")
+
+    def stats(self) -> Dict[str, int]:
+        """The running and waiting jobs, and the jobs rejected and coalesced since the start."""
+        with self._counts_lock:
+            return {
+                'running': self._active,
+                'waiting': self._accepted - self._active,
+                'capacity': self.workers + self.max_pending,
+                'rejected': self._rejected,
+                'coalesced': self._coalesced,
+            }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Wait for the accepted jobs to finish, then stop the runtime."""
+        if wait:
+            for _ in range(self.workers + self.max_pending):
+                self._slots.acquire()
+
+        self.runtime.stop()
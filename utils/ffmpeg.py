@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import asyncio
+import signal
+import logging
+import subprocess
+
+from typing import List, NamedTuple, Optional
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; limits are simply not applied there
+    resource = None
+
+logger = logging.getLogger()
+
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY") if os.getenv("FFMPEG_BINARY") else 'ffmpeg'
+FFPROBE_BINARY = os.getenv("FFPROBE_BINARY") if os.getenv("FFPROBE_BINARY") else 'ffprobe'
+FFPROBE_TIMEOUT = int(os.getenv("FFPROBE_TIMEOUT")) if os.getenv("FFPROBE_TIMEOUT") else 30
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT")) if os.getenv("FFMPEG_TIMEOUT") else 300
+FFMPEG_CPU_SECONDS = int(os.getenv("FFMPEG_CPU_SECONDS")) if os.getenv("FFMPEG_CPU_SECONDS") else 600
+FFMPEG_MEMORY_MB = int(os.getenv("FFMPEG_MEMORY_MB")) if os.getenv("FFMPEG_MEMORY_MB") else 1024
+
+STDERR_TAIL_LINES = 20
+
+
+class FFmpegResult(NamedTuple):
+    """The outcome of a single ffmpeg run"""
+    args: List[str]
+    returncode: int
+    stderr_tail: str
+    elapsed: float
+    timed_out: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+
+def _limit_resources(pid: int) -> None:
+    """Applied to ffmpeg right after it started. Setting them in the child before `exec`
+    with `preexec_fn` isn't safe in a process with threads and can deadlock the child."""
+    if getattr(resource, 'prlimit', None) is None:
+        # Linux only; the limits are simply not applied elsewhere
+        return
+
+    memory_bytes = FFMPEG_MEMORY_MB * 1024 * 1024
+
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (FFMPEG_CPU_SECONDS, FFMPEG_CPU_SECONDS))
+        resource.prlimit(pid, resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    except ProcessLookupError:
+        # Already done
+        pass
+    except OSError as error:
+        logger.warning("Couldn't limit the resources of ffmpeg: %s", error)
+
+
+def _tail(stderr: bytes) -> str:
+    lines = stderr.decode('utf-8', errors='replace').strip().splitlines()
+
+    return "\n".join(lines[-STDERR_TAIL_LINES:])
+
+
+def build_ffmpeg_command(args: List[str]) -> List[str]:
+    """Prefix the given ffmpeg arguments with the binary and the flags every run needs.
+
+    `-nostdin` makes sure ffmpeg never blocks on an interactive prompt, e.g. when an
+    output file already exists.
+
+    **Keyword arguments:**
+     - args (list) -- The ffmpeg arguments, inputs and outputs included
+
+    **Returns:**
+     The full argument list to execute
+    """
+    return [FFMPEG_BINARY, '-hide_banner', '-nostdin', '-loglevel', 'error', *[str(arg) for arg in args]]
+
+
+def run_ffmpeg(args: List[str], timeout: int = None) -> FFmpegResult:
+    """Run ffmpeg with a wall-clock timeout and CPU/memory limits.
+
+    The process is started in its own session so that a timeout kills ffmpeg together with
+    anything it spawned.
+
+    **Keyword arguments:**
+     - args (list) -- The ffmpeg arguments, see `build_ffmpeg_command`
+     - timeout (int) -- Seconds to wait before killing ffmpeg, defaults to `FFMPEG_TIMEOUT`
+
+    **Returns:**
+     `FFmpegResult` describing the exit status, the tail of stderr and the elapsed time
+    """
+    command = build_ffmpeg_command(args)
+    timeout = timeout if timeout else FFMPEG_TIMEOUT
+    started_at = time.monotonic()
+
+    try:
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    except OSError as error:
+        logger.error("Couldn't start ffmpeg: %s", error)
+        return FFmpegResult(command, -1, str(error), time.monotonic() - started_at)
+
+    _limit_resources(process.pid)
+
+    timed_out = False
+
+    try:
+        _, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+        _, stderr = process.communicate()
+
+    result = FFmpegResult(
+        command,
+        process.returncode,
+        _tail(stderr),
+        time.monotonic() - started_at,
+        timed_out
+    )
+    _log_result(result)
+
+    return result
+
+
+async def run_ffmpeg_async(args: List[str], timeout: int = None) -> FFmpegResult:
+    """The asyncio counterpart of `run_ffmpeg`; waiting on ffmpeg doesn't hold a thread.
+
+    **Keyword arguments:**
+     - args (list) -- The ffmpeg arguments, see `build_ffmpeg_command`
+     - timeout (int) -- Seconds to wait before killing ffmpeg, defaults to `FFMPEG_TIMEOUT`
+
+    **Returns:**
+     `FFmpegResult` describing the exit status, the tail of stderr and the elapsed time
+    """
+    command = build_ffmpeg_command(args)
+    timeout = timeout if timeout else FFMPEG_TIMEOUT
+    started_at = time.monotonic()
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+    except OSError as error:
+        logger.error("Couldn't start ffmpeg: %s", error)
+        return FFmpegResult(command, -1, str(error), time.monotonic() - started_at)
+
+    _limit_resources(process.pid)
+
+    timed_out = False
+    stderr_reader = asyncio.ensure_future(process.stderr.read())
+
+    try:
+        await asyncio.wait_for(process.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            process.kill()
+        await process.wait()
+
+    stderr = await stderr_reader
+
+    result = FFmpegResult(
+        command,
+        process.returncode,
+        _tail(stderr),
+        time.monotonic() - started_at,
+        timed_out
+    )
+    _log_result(result)
+
+    return result
+
+
+async def run_ffprobe_async(file_path: str, timeout: int = FFPROBE_TIMEOUT) -> Optional[dict]:
+    """Read the container and stream metadata of a media file with ffprobe.
+
+    **Keyword arguments:**
+     - file_path (str) -- The file to probe
+     - timeout (int) -- Seconds to wait before killing ffprobe
+
+    **Returns:**
+     ffprobe's `format` and `streams` as a dict, or `None` if the file couldn't be probed
+    """
+    command = [
+        FFPROBE_BINARY, '-hide_banner', '-loglevel', 'error',
+        '-print_format', 'json', '-show_format', '-show_streams', file_path
+    ]
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as error:
+        logger.error("Couldn't start ffprobe: %s", error)
+        return None
+
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.error("ffprobe timed out: %s", file_path)
+        return None
+
+    if process.returncode != 0:
+        logger.warning("ffprobe exited with %s: %s", process.returncode, file_path)
+        return None
+
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        logger.warning("ffprobe printed no JSON for %s", file_path)
+        return None
+
+
+def _log_result(result: FFmpegResult) -> None:
+    command = result.args
+
+    if result.timed_out:
+        logger.error("ffmpeg timed out after %.1fs: %s", result.elapsed, command)
+    elif not result.ok:
+        logger.error(
+            "ffmpeg exited with %s after %.1fs: %s\n%s",
+            result.returncode,
+            result.elapsed,
+            command,
+            result.stderr_tail
+        )
+    else:
+        logger.info("ffmpeg finished in %.1fs: %s", result.elapsed, command)
@@ -0,0 +1,223 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger()
+
+OUTPUT_CACHE_DIR = os.getenv("OUTPUT_CACHE_DIR") if os.getenv("OUTPUT_CACHE_DIR") else 'cache/outputs'
+OUTPUT_CACHE_MAX_MB = int(os.getenv("OUTPUT_CACHE_MAX_MB")) if os.getenv("OUTPUT_CACHE_MAX_MB") else 2048
+OUTPUT_CACHE_RESCAN_INTERVAL = int(os.getenv("OUTPUT_CACHE_RESCAN_INTERVAL")) \
+    if os.getenv("OUTPUT_CACHE_RESCAN_INTERVAL") else 300
+
+
+def cache_key(file_unique_id: str, operation: str, *params) -> str:
+    """The cache key of an operation's output for a Telegram file.
+
+    `file_unique_id` is the same for a file whoever sends it, so the outputs are shared
+    by all users.
+
+    **Keyword arguments:**
+     - file_unique_id (str) -- The `file_unique_id` of the input file
+     - operation (str) -- The operation that produced the output
+     - params -- Whatever else the output depends on, e.g. the cutting range
+
+    **Returns:**
+     The key, a hex digest
+    """
+    encoded = json.dumps([file_unique_id, operation, *params], separators=(',', ':'))
+
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class OutputCache:
+    """Finished outputs on disk, keyed by `cache_key`, evicting the least recently used.
+
+    Entries are handed out as copies, so callers can edit, upload and delete them as usual
+    and an eviction never removes a file someone is still uploading. The order of use
+    survives restarts through the entries' modification times.
+
+    All shard workers share the directory: entries another process stored are found on
+    disk when they aren't known yet, and `rescan` regularly reloads the whole directory so
+    that its total size is kept at `max_bytes`, whoever added the entries. Nothing touches
+    the disk before `open`.
+
+    **Keyword arguments:**
+     - directory (str) -- Where the entries are kept
+     - max_bytes (int) -- The total size the entries are evicted down to
+    """
+
+    def __init__(self, directory: str = OUTPUT_CACHE_DIR, max_bytes: int = OUTPUT_CACHE_MAX_MB * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._metrics = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def open(self) -> None:
+        """Create the directory and load the entries that are already there; called at startup."""
+        os.makedirs(self.directory, exist_ok=True)
+        self.rescan()
+
+    def rescan(self) -> None:
+        """Reload the entries from the directory, including the ones other processes added,
+        and evict down to `max_bytes`; runs on a schedule."""
+        scanned = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.'):
+                continue
+
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    scanned.append((stat.st_mtime, entry.name, stat.st_size))
+            except FileNotFoundError:
+                # Evicted by another process meanwhile
+                continue
+
+        entries: 'OrderedDict[str, int]' = OrderedDict()
+        for _, key, size in sorted(scanned):
+            entries[key] = size
+
+        with self._lock:
+            self._entries = entries
+            self._size = sum(entries.values())
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self._metrics['evictions'] += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _hit(self, key: str) -> Optional[str]:
+        path = self._path(key)
+
+        with self._lock:
+            known = key in self._entries
+            if known:
+                self._entries.move_to_end(key)
+                self._metrics['hits'] += 1
+
+        if not known:
+            # Maybe stored by another process since the last rescan
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                with self._lock:
+                    self._metrics['misses'] += 1
+                return None
+
+            with self._lock:
+                self._size += size - self._entries.pop(key, 0)
+                self._entries[key] = size
+                self._metrics['hits'] += 1
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process, or removed by hand
+            with self._lock:
+                self._size -= self._entries.pop(key, 0)
+            return None
+
+        return path
+
+    def fetch(self, key: str, destination: str) -> bool:
+        """Put the cached output for `key` at `destination`.
+
+        **Returns:**
+         `False` on a miss
+        """
+        path = self._hit(key)
+        if path is None:
+            return False
+
+        try:
+            shutil.copyfile(path, destination)
+        except OSError:
+            logger.warning("Couldn't hand out the cached output %s", key, exc_info=True)
+            return False
+
+        return True
+
+    def read(self, key: str) -> Optional[bytes]:
+        """The content of a small entry stored with `write`, or `None` on a miss."""
+        path = self._hit(key)
+        if path is None:
+            return None
+
+        try:
+            with open(path, 'rb') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def store(self, key: str, source: str) -> None:
+        """Add the file at `source` as the output for `key`."""
+        temporary = None
+
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', delete=False) as temporary:
+                pass
+
+            shutil.copyfile(source, temporary.name)
+            os.replace(temporary.name, self._path(key))
+        except OSError:
+            logger.warning("Couldn't cache the output %s", key, exc_info=True)
+            self._discard(temporary)
+            return
+
+        self._added(key)
+
+    def write(self, key: str, content: bytes) -> None:
+        """Add a small entry, e.g. the tags read from a file."""
+        temporary = None
+
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.directory, prefix='.', delete=False) as temporary:
+                temporary.write(content)
+
+            os.replace(temporary.name, self._path(key))
+        except OSError:
+            # A full or read-only cache only makes the entry miss
+            logger.warning("Couldn't cache the entry %s", key, exc_info=True)
+            self._discard(temporary)
+            return
+
+        self._added(key)
+
+    @staticmethod
+    def _discard(temporary) -> None:
+        if temporary is not None and os.path.exists(temporary.name):
+            os.remove(temporary.name)
+
+    def _added(self, key: str) -> None:
+        size = os.path.getsize(self._path(key))
+
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._metrics['stores'] += 1
+            self._evict()
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._metrics, entries=len(self._entries), bytes=self._size)
+
+
+output_cache = OutputCache()
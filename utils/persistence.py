@@ -0,0 +1,305 @@
+import os
+import sqlite3
+import hashlib
+import time
+import logging
+import threading
+
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telegram.ext import BasePersistence
+
+from utils.session import UserSession
+
+logger = logging.getLogger()
+
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND") if os.getenv("PERSISTENCE_BACKEND") else 'sqlite'
+PERSISTENCE_FLUSH_INTERVAL = int(os.getenv("PERSISTENCE_FLUSH_INTERVAL")) \
+    if os.getenv("PERSISTENCE_FLUSH_INTERVAL") else 30
+USER_DATA_IDLE_SECONDS = int(os.getenv("USER_DATA_IDLE_SECONDS")) if os.getenv("USER_DATA_IDLE_SECONDS") else 900
+MAX_RESIDENT_USERS = int(os.getenv("MAX_RESIDENT_USERS")) if os.getenv("MAX_RESIDENT_USERS") else 10000
+USER_DATA_EVICT_INTERVAL = int(os.getenv("USER_DATA_EVICT_INTERVAL")) if os.getenv("USER_DATA_EVICT_INTERVAL") else 60
+
+USER_DATA_TABLE = 'user_data'
+
+
+class SQLiteUserDataStore:
+    """Keeps one row per user in a local SQLite file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {USER_DATA_TABLE} ("
+            "user_id INTEGER PRIMARY KEY, "
+            "data TEXT NOT NULL, "
+            "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        )
+        self._connection.commit()
+
+    def load(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT data FROM {USER_DATA_TABLE} WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def save_many(self, rows: List[Tuple[int, str]]) -> None:
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT INTO {USER_DATA_TABLE} (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP",
+                rows
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class DatabaseUserDataStore:
+    """Keeps one row per user in the `user_data` table of the orator database."""
+
+    def __init__(self, db) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+
+    def load(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            row = self.db.table(USER_DATA_TABLE).where('user_id', user_id).first()
+
+        return row['data'] if row else None
+
+    def save_many(self, rows: List[Tuple[int, str]]) -> None:
+        connection = self.db.connection()
+        marker = connection.get_query_grammar().get_marker()
+
+        if connection.get_config('driver') == 'sqlite':
+            query = f"INSERT INTO {USER_DATA_TABLE} (user_id, data) VALUES ({marker}, {marker}) " \
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP"
+        else:
+            query = f"INSERT INTO {USER_DATA_TABLE} (user_id, data) VALUES ({marker}, {marker}) " \
+                    "ON DUPLICATE KEY UPDATE data = VALUES(data), updated_at = CURRENT_TIMESTAMP"
+
+        with self._lock, connection.transaction():
+            for user_id, data in rows:
+                connection.statement(query, [user_id, data])
+
+    def close(self) -> None:
+        pass
+
+
+class LazyUserData(defaultdict):
+    """`Dispatcher.user_data` that loads a user's data the first time it's accessed.
+
+    Together with `UserDataPersistence.evict` only the recently active users are held in
+    memory; the others come back from the storage on their next update.
+    """
+
+    def __init__(self, loader: Callable[[int], Optional[UserSession]]) -> None:
+        super().__init__(UserSession)
+        self.loader = loader
+
+    def __missing__(self, user_id: int) -> UserSession:
+        session = self.loader(user_id)
+
+        return self.setdefault(user_id, session if session is not None else self.default_factory())
+
+    def __copy__(self) -> 'LazyUserData':
+        # `BasePersistence.insert_bot` copies the mapping it's given; it has to stay the lazy one
+        return self
+
+    def copy(self) -> dict:
+        return dict(self)
+
+
+def _digest(encoded: str) -> bytes:
+    return hashlib.blake2b(encoded.encode(), digest_size=16).digest()
+
+
+class UserDataPersistence(BasePersistence):
+    """Persists every user's `UserSession` as its own row and only writes the users that changed.
+
+    `update_user_data` is called after every update; it only serializes the user's data
+    and compares it with what was last stored. Changed users are written in one batch on
+    `flush`, which runs on a schedule and on shutdown, so the cost of a flush depends on
+    the number of users active since the last one.
+
+    Users that have been idle for a while, or the least recently active ones once there
+    are too many in memory, are handed to the storage and dropped from `user_data`.
+
+    **Keyword arguments:**
+     - store (SQLiteUserDataStore|DatabaseUserDataStore) -- Where the rows are kept
+    """
+
+    def __init__(self, store) -> None:
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.store = store
+        self.user_data = None
+        self._digests: Dict[int, bytes] = {}
+        self._dirty: Dict[int, str] = {}
+        self._flushing: Dict[int, str] = {}
+        self._last_seen: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _load(self, user_id: int) -> Optional[UserSession]:
+        with self._lock:
+            # Evicted, but not written yet
+            encoded = self._dirty.get(user_id) or self._flushing.get(user_id)
+
+        if encoded is None:
+            encoded = self.store.load(user_id)
+
+        if encoded is None:
+            return None
+
+        with self._lock:
+            self._digests[user_id] = _digest(encoded)
+            self._last_seen[user_id] = time.monotonic()
+
+        return UserSession.from_json(encoded)
+
+    def get_user_data(self) -> LazyUserData:
+        if self.user_data is None:
+            self.user_data = LazyUserData(self._load)
+
+        return self.user_data
+
+    def get_chat_data(self) -> defaultdict:
+        return defaultdict(dict)
+
+    def get_bot_data(self) -> dict:
+        return {}
+
+    def get_conversations(self, name: str) -> dict:
+        return {}
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        pass
+
+    def update_user_data(self, user_id: int, data: UserSession) -> None:
+        encoded = data.to_json()
+        digest = _digest(encoded)
+
+        with self._lock:
+            self._last_seen[user_id] = time.monotonic()
+
+            if self._digests.get(user_id) == digest:
+                return
+
+            self._digests[user_id] = digest
+            self._dirty[user_id] = encoded
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    def update_bot_data(self, data: dict) -> None:
+        pass
+
+    def refresh_user_data(self, user_id: int, user_data: UserSession) -> None:
+        pass
+
+    def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    def eviction_candidates(
+        self,
+        idle_seconds: int = USER_DATA_IDLE_SECONDS,
+        max_resident: int = MAX_RESIDENT_USERS
+    ) -> List[Tuple[int, float]]:
+        """The users to drop from memory, least recently active first.
+
+        **Keyword arguments:**
+         - idle_seconds (int) -- Users idle for longer than this are evicted
+         - max_resident (int) -- At most this many users are kept in memory
+
+        **Returns:**
+         `(user_id, last_seen)` pairs to pass to `evict`
+        """
+        with self._lock:
+            by_age = sorted(self._last_seen.items(), key=lambda item: item[1])
+
+        deadline = time.monotonic() - idle_seconds
+        overflow = len(by_age) - max_resident
+
+        return [
+            (user_id, last_seen)
+            for index, (user_id, last_seen) in enumerate(by_age)
+            if last_seen < deadline or index < overflow
+        ]
+
+    def evict(self, user_id: int, last_seen: float) -> bool:
+        """Drop `user_id` from memory unless they've been active since `last_seen`.
+
+        Must run in the user's mailbox so that no handler is using their data meanwhile.
+        Their data is queued for the next `flush`, which is also where it's loaded from
+        until then.
+
+        **Returns:**
+         Whether the user was evicted
+        """
+        with self._lock:
+            if self._last_seen.get(user_id) != last_seen:
+                return False
+
+        data = self.user_data.pop(user_id, None)
+        if data is not None:
+            self.update_user_data(user_id, data)
+
+        with self._lock:
+            self._last_seen.pop(user_id, None)
+            self._digests.pop(user_id, None)
+
+        return True
+
+    def flush(self) -> None:
+        """Write the users that changed since the last flush in a single batch."""
+        with self._flush_lock:
+            with self._lock:
+                dirty = self._flushing = self._dirty
+                self._dirty = {}
+
+            if not dirty:
+                return
+
+            try:
+                self.store.save_many(list(dirty.items()))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Couldn't persist the user data of %s users, will retry", len(dirty))
+                with self._lock:
+                    for user_id, encoded in dirty.items():
+                        self._dirty.setdefault(user_id, encoded)
+                return
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+            logger.debug("Persisted the user data of %s users", len(dirty))
+
+
+def create_persistence(db=None, backend: str = PERSISTENCE_BACKEND, suffix: str = '') -> UserDataPersistence:
+    """Build the persistence configured by `PERSISTENCE_BACKEND`.
+
+    **Keyword arguments:**
+     - db (DatabaseManager) -- The orator database, used by the `database` backend
+     - backend (str) -- Either `sqlite` or `database`
+     - suffix (str) -- Appended to the SQLite file name, e.g. the shard suffix
+
+    **Returns:**
+     The `UserDataPersistence` to pass to the `Updater`
+    """
+    if backend == 'database':
+        return UserDataPersistence(DatabaseUserDataStore(db))
+
+    if backend == 'sqlite':
+        return UserDataPersistence(SQLiteUserDataStore(f"persistence_storage{suffix}.sqlite3"))
+
+    raise ValueError(f"Unknown PERSISTENCE_BACKEND: {backend}")
@@ -0,0 +1,214 @@
+import json
+import logging
+
+from typing import List, NamedTuple, Optional, Tuple
+
+from utils.aio import run_blocking
+from utils.ffmpeg import FFmpegResult, run_ffmpeg_async, run_ffprobe_async
+from utils.output_cache import cache_key, output_cache
+
+logger = logging.getLogger()
+
+
+class TranscodeProfile(NamedTuple):
+    """How an output Telegram handles natively is encoded, in a single ffmpeg pass, and
+    when the input's streams can simply be copied into it instead, see `can_copy`"""
+    name: str
+    extension: str
+    output_args: List[str]
+    # Used instead of `output_args` when the streams can be copied
+    copy_args: Tuple[str, ...] = ()
+    # The codecs of the streams that can be copied, `None` for streams the output drops
+    video_codecs: Optional[Tuple[str, ...]] = None
+    audio_codecs: Optional[Tuple[str, ...]] = None
+    # Limits of the video and of the whole input for copying, 0 for none
+    max_side: int = 0
+    square: bool = False
+    max_duration: float = 0
+
+
+VOICE_NOTE = TranscodeProfile(
+    'voice_note', 'ogg',
+    [
+        # Telegram only shows Opus in Ogg as a voice note, mono is plenty for it
+        '-vn', '-map_metadata', '-1',
+        '-c:a', 'libopus', '-ac', '1', '-ar', '48000', '-b:a', '48k', '-vbr', 'on',
+        '-application', 'audio',
+    ],
+    copy_args=('-vn', '-map_metadata', '-1', '-c:a', 'copy'),
+    audio_codecs=('opus',),
+)
+
+MP3_AUDIO = TranscodeProfile(
+    'mp3_audio', 'mp3',
+    [
+        '-vn', '-map_metadata', '0',
+        '-c:a', 'libmp3lame', '-q:a', '4', '-id3v2_version', '3',
+    ],
+    copy_args=('-vn', '-map_metadata', '0', '-c:a', 'copy', '-id3v2_version', '3'),
+    audio_codecs=('mp3',),
+)
+
+VIDEO_NOTE = TranscodeProfile(
+    'video_note', 'mp4',
+    [
+        # Video notes are square and at most a minute long
+        '-t', '60',
+        '-vf', 'crop=min(iw\\,ih):min(iw\\,ih),scale=384:384,setsar=1',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '26', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-ac', '1', '-b:a', '64k',
+        '-movflags', '+faststart',
+    ],
+    copy_args=('-c:v', 'copy', '-c:a', 'copy', '-movflags', '+faststart'),
+    video_codecs=('h264',),
+    audio_codecs=('aac',),
+    max_side=640,
+    square=True,
+    max_duration=60,
+)
+
+ANIMATION = TranscodeProfile(
+    'animation', 'mp4',
+    [
+        # A silent H.264 video is shown as a GIF and is a fraction of the size of one
+        '-t', '10', '-an',
+        '-vf', 'fps=15,scale=min(480\\,iw):-2',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '28', '-pix_fmt', 'yuv420p',
+        '-movflags', '+faststart',
+    ],
+    copy_args=('-t', '10', '-an', '-c:v', 'copy', '-movflags', '+faststart'),
+    video_codecs=('h264',),
+    max_side=480,
+)
+
+PROFILES = {profile.name: profile for profile in (VOICE_NOTE, MP3_AUDIO, VIDEO_NOTE, ANIMATION)}
+
+
+def output_path_for(input_path: str, profile: TranscodeProfile) -> str:
+    """The path a transcode of `input_path` with `profile` is written to"""
+    return f"{input_path}.{profile.name}.{profile.extension}"
+
+
+def build_transcode_args(
+    profile: TranscodeProfile,
+    input_path: str,
+    output_path: str,
+    copy: bool = False
+) -> List[str]:
+    """The ffmpeg arguments encoding `input_path` with `profile`
+
+    **Keyword arguments:**
+     - profile (TranscodeProfile) -- How the output is encoded
+     - input_path (str) -- The file to encode
+     - output_path (str) -- The file to write
+     - copy (bool) -- Copy the streams instead of encoding them, see `can_copy`
+
+    **Returns:**
+     The arguments, without the ffmpeg binary
+    """
+    return ['-y', '-i', input_path, *(profile.copy_args if copy else profile.output_args), output_path]
+
+
+def _first_stream(probe: dict, codec_type: str) -> Optional[dict]:
+    for stream in probe.get('streams', []):
+        # Album art shows up as a video stream
+        if stream.get('codec_type') == codec_type and not stream.get('disposition', {}).get('attached_pic'):
+            return stream
+
+    return None
+
+
+def can_copy(profile: TranscodeProfile, probe: Optional[dict]) -> bool:
+    """Whether the streams of a probed input can be copied into an output of `profile`
+    as they are, which takes milliseconds where encoding them takes seconds.
+
+    **Keyword arguments:**
+     - profile (TranscodeProfile) -- How the output is encoded
+     - probe (dict) -- The input's metadata, see `probe_input`
+
+    **Returns:**
+     `False` if the input has to be encoded
+    """
+    if not profile.copy_args or not probe:
+        return False
+
+    if profile.video_codecs is not None:
+        video = _first_stream(probe, 'video')
+        if video is None or video.get('codec_name') not in profile.video_codecs:
+            return False
+        if video.get('pix_fmt') != 'yuv420p':
+            return False
+
+        width, height = video.get('width', 0), video.get('height', 0)
+        if profile.max_side and max(width, height) > profile.max_side:
+            return False
+        if profile.square and width != height:
+            return False
+
+    if profile.audio_codecs is not None:
+        audio = _first_stream(probe, 'audio')
+        if audio is None:
+            # Videos may come without sound, audio can't
+            if profile.video_codecs is None:
+                return False
+        elif audio.get('codec_name') not in profile.audio_codecs:
+            return False
+
+    if profile.max_duration:
+        duration = float(probe.get('format', {}).get('duration') or 0)
+        if not duration or duration > profile.max_duration:
+            return False
+
+    return True
+
+
+async def probe_input(input_path: str, file_unique_id: str = '') -> Optional[dict]:
+    """Probe an input once; the result is kept in `output_cache` by its `file_unique_id`
+
+    **Keyword arguments:**
+     - input_path (str) -- The file to probe
+     - file_unique_id (str) -- The Telegram `file_unique_id` of the file, if it has one
+
+    **Returns:**
+     The input's metadata, see `run_ffprobe_async`
+    """
+    key = cache_key(file_unique_id, 'probe') if file_unique_id else ''
+
+    if key:
+        cached = await run_blocking(output_cache.read, key)
+        if cached is not None:
+            return json.loads(cached)
+
+    probe = await run_ffprobe_async(input_path)
+    if probe is not None and key:
+        await run_blocking(output_cache.write, key, json.dumps(probe).encode())
+
+    return probe
+
+
+async def transcode(
+    profile: TranscodeProfile,
+    input_path: str,
+    output_path: str,
+    file_unique_id: str = ''
+) -> FFmpegResult:
+    """Produce an output of `profile` from `input_path` in a single ffmpeg pass, copying
+    the input's streams if they allow it and encoding them otherwise
+
+    **Keyword arguments:**
+     - profile (TranscodeProfile) -- How the output is encoded
+     - input_path (str) -- The file to encode
+     - output_path (str) -- The file to write
+     - file_unique_id (str) -- The Telegram `file_unique_id` of the input, to reuse its probe
+
+    **Returns:**
+     The result of the ffmpeg run
+    """
+    if can_copy(profile, await probe_input(input_path, file_unique_id)):
+        result = await run_ffmpeg_async(build_transcode_args(profile, input_path, output_path, copy=True))
+        if result.ok:
+            return result
+
+        logger.warning("Couldn't copy the streams of %s into a %s, encoding them", input_path, profile.name)
+
+    return await run_ffmpeg_async(build_transcode_args(profile, input_path, output_path))
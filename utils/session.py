@@ -0,0 +1,138 @@
+import json
+
+from enum import IntEnum
+from typing import Iterator
+
+
+class Module(IntEnum):
+    """The module a user is currently working with"""
+    NONE = 0
+    TAG_EDITOR = 1
+    MUSIC_CUTTER = 2
+    MUSIC_TO_VOICE_CONVERTER = 3
+
+
+class TagEditor:
+    """The tags of the music a user is editing and the tag they're about to change."""
+
+    __slots__ = ('current_tag', 'artist', 'title', 'album', 'genre', 'year', 'disknumber', 'tracknumber')
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        for name in self.__slots__:
+            setattr(self, name, '')
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name)}
+
+    def load(self, values: dict) -> None:
+        for name in self.__slots__:
+            if name in values:
+                setattr(self, name, values[name])
+
+
+class UserSession:
+    """The state the bot keeps for a user between their updates.
+
+    Every attribute always exists, so data stored by an older version simply comes back
+    with the defaults for anything it lacks. Only the values that differ from the defaults
+    are serialized.
+    """
+
+    DEFAULTS = {
+        'current_module': Module.NONE,
+        'convert_video_to_gif': False,
+        'convert_video_to_circle': False,
+        'convert_audio_to_voice': False,
+        'edit_tag_music': False,
+        'download_from_link': False,
+        'voice_path': '',
+        'voice_file_id': '',
+        'voice_unique_id': '',
+        'voice_art_path': '',
+        'new_voice_art_path': '',
+        'voice_message_id': 0,
+        'voice_duration': 0,
+        'video_path': '',
+        'video_unique_id': '',
+        'video_art_path': '',
+        'new_video_art_path': '',
+        'video_message_id': 0,
+        'video_duration': 0,
+        'gif': '',
+        'music_path': '',
+        'music_file_id': '',
+        'music_unique_id': '',
+        'music_duration': 0,
+        'music_message_id': 0,
+        'art_path': '',
+        'new_art_path': '',
+    }
+
+    TEMPORARY_FILES = (
+        'voice_path', 'voice_art_path', 'new_voice_art_path',
+        'music_path', 'art_path', 'new_art_path',
+        'video_path', 'video_art_path', 'new_video_art_path',
+        'gif',
+    )
+
+    __slots__ = ('language', 'tag_editor', *DEFAULTS)
+
+    def __init__(self, language: str = 'en') -> None:
+        self.language = language
+        self.tag_editor = TagEditor()
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget everything about the current file and module, but keep the language."""
+        for name, value in self.DEFAULTS.items():
+            setattr(self, name, value)
+
+        self.tag_editor.reset()
+
+    def temporary_files(self) -> Iterator[str]:
+        """The paths of the downloaded and generated files this session refers to."""
+        for name in self.TEMPORARY_FILES:
+            path = getattr(self, name)
+            if path:
+                yield path
+
+    def __copy__(self) -> 'UserSession':
+        session = UserSession(self.language)
+        for name, default in self.DEFAULTS.items():
+            value = getattr(self, name)
+            if value != default:
+                setattr(session, name, value)
+
+        session.tag_editor.load(self.tag_editor.to_dict())
+
+        return session
+
+    def to_json(self) -> str:
+        values = {
+            name: getattr(self, name)
+            for name, default in self.DEFAULTS.items()
+            if getattr(self, name) != default
+        }
+        values['language'] = self.language
+
+        tags = self.tag_editor.to_dict()
+        if tags:
+            values['tag_editor'] = tags
+
+        return json.dumps(values, ensure_ascii=False, separators=(',', ':'), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, encoded: str) -> 'UserSession':
+        values = json.loads(encoded)
+        session = cls(values.get('language', 'en'))
+
+        for name in cls.DEFAULTS.keys() & values.keys():
+            setattr(session, name, values[name])
+
+        session.current_module = Module(session.current_module)
+        session.tag_editor.load(values.get('tag_editor') or {})
+
+        return session
@@ -0,0 +1,242 @@
+import os
+import sys
+import bisect
+import hashlib
+import logging
+import threading
+import subprocess
+
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from telegram import Update
+
+from utils.webhook import PAYMENT_SECRET, UpdateIntake, WEBHOOK_PORT, WEBHOOK_QUEUE_SIZE, WEBHOOK_SECRET
+
+logger = logging.getLogger()
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS")) if os.getenv("SHARD_WORKERS") else 2
+SHARD_WORKER_URLS = os.getenv("SHARD_WORKER_URLS") if os.getenv("SHARD_WORKER_URLS") else ''
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT")) if os.getenv("SHARD_BASE_PORT") else WEBHOOK_PORT + 1
+SHARD_INDEX = os.getenv("SHARD_INDEX") if os.getenv("SHARD_INDEX") else ''
+SHARD_FORWARD_TIMEOUT = int(os.getenv("SHARD_FORWARD_TIMEOUT")) if os.getenv("SHARD_FORWARD_TIMEOUT") else 10
+
+RING_REPLICAS = 128
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes.
+
+    Each node is placed on the ring `replicas` times; adding or removing a node only moves
+    the keys of the ring segments it owns, so most users keep their shard.
+    """
+
+    def __init__(self, nodes: List[str], replicas: int = RING_REPLICAS) -> None:
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+
+        self._ring = sorted(
+            (self._hash(f"{node}#{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int(hashlib.md5(value.encode()).hexdigest()[:16], 16)
+
+    def node_for(self, key) -> str:
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+
+        return self._ring[index][1]
+
+
+def shard_key_for_payload(payload: dict) -> Optional[int]:
+    """The id updates are sharded by: the effective user, or the chat if there's no user."""
+    update = Update.de_json(payload, None)
+    if update is None:
+        return None
+
+    if update.effective_user:
+        return update.effective_user.id
+
+    if update.effective_chat:
+        return update.effective_chat.id
+
+    return None
+
+
+class ShardForwarder:
+    """Delivers one shard's updates to its worker, in order.
+
+    Delivery is retried until the worker accepts the update, so a restarting worker only
+    delays its own users; its queue absorbs the backlog in the meantime.
+    """
+
+    def __init__(self, url: str, queue_size: int = WEBHOOK_QUEUE_SIZE) -> None:
+        self.url = url
+        self.session = requests.Session()
+        self.intake = UpdateIntake(self._deliver, maxsize=queue_size)
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        self.intake.start()
+
+    def _deliver(self, payload: dict) -> None:
+        delay = 0.5
+
+        while True:
+            try:
+                response = self.session.post(self.url, json=payload, timeout=SHARD_FORWARD_TIMEOUT)
+                if response.status_code < 500:
+                    return
+                logger.warning("Worker %s answered %s, retrying.", self.url, response.status_code)
+            except requests.RequestException as error:
+                logger.warning("Couldn't reach worker %s: %s", self.url, error)
+
+            if self._stopping.wait(delay):
+                logger.error("Giving up on update %s for worker %s", payload.get('update_id'), self.url)
+                return
+
+            delay = min(delay * 2, 10)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        self.intake.stop()
+
+
+def payment_url_for(worker_url: str, payment_secret: str = PAYMENT_SECRET) -> str:
+    """The payment callback URL of the worker whose webhook is at `worker_url`."""
+    scheme, netloc, path, _, _ = urlsplit(worker_url)
+
+    return urlunsplit((scheme, netloc, f"{path.rsplit('/', 1)[0]}/payments/{payment_secret}", '', ''))
+
+
+class ShardRouter:
+    """The front process' view of the workers: routes every update to its user's shard.
+
+    It takes the place of `UpdateIntake` in the webhook server, so a backed up shard makes
+    the front answer 503 instead of dropping updates.
+
+    Payment callbacks are passed on to the paying user's shard as well, so the worker that
+    caches the user's balance is the one that credits it.
+    """
+
+    def __init__(self, worker_urls: List[str], queue_size: int = WEBHOOK_QUEUE_SIZE) -> None:
+        self.forwarders: Dict[str, ShardForwarder] = {
+            url: ShardForwarder(url, queue_size) for url in worker_urls
+        }
+        self.ring = HashRing(worker_urls)
+
+    def start(self) -> None:
+        for forwarder in self.forwarders.values():
+            forwarder.start()
+
+    def offer(self, payload: dict) -> bool:
+        """Queue `payload` for its shard; `False` if that shard is backed up."""
+        key = shard_key_for_payload(payload)
+        url = self.ring.node_for(key if key is not None else payload.get('update_id'))
+
+        if not self.forwarders[url].intake.offer(payload):
+            logger.warning("Shard %s is backed up, asking Telegram to retry.", url)
+            return False
+
+        return True
+
+    def credit_payment(self, payload: dict) -> bool:
+        """Have the paying user's worker credit a payment, see `handle_payment_callback`.
+
+        **Keyword arguments:**
+         - payload (dict) -- The payment as POSTed by the payment provider
+
+        **Returns:**
+         `False` if the payment was already credited
+        """
+        url = self.ring.node_for(int(payload['user_id']))
+
+        response = requests.post(payment_url_for(url), json=payload, timeout=SHARD_FORWARD_TIMEOUT)
+        if response.status_code == 400:
+            raise ValueError(f"Worker {url} refused the payment")
+        # Anything else makes the front answer 500, so the payment provider retries
+        response.raise_for_status()
+
+        return bool(response.json()['credited'])
+
+    def stop(self) -> None:
+        for forwarder in self.forwarders.values():
+            forwarder.stop()
+
+
+class LocalWorkerPool:
+    """Spawns `Cover.py` worker processes on this machine and restarts them when they die.
+
+    Every worker serves a webhook on its own port and gets its own persistence file, so it
+    only ever holds its slice of the users.
+    """
+
+    def __init__(self, count: int, base_port: int = SHARD_BASE_PORT, secret: str = WEBHOOK_SECRET) -> None:
+        self.count = count
+        self.base_port = base_port
+        self.secret = secret
+        self._processes: Dict[int, subprocess.Popen] = {}
+        self._stopping = threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise, name='shard-supervisor', daemon=True)
+
+    @property
+    def urls(self) -> List[str]:
+        return [f"http://127.0.0.1:{self.base_port + index}/{self.secret}" for index in range(self.count)]
+
+    def _spawn(self, index: int) -> subprocess.Popen:
+        env = dict(
+            os.environ,
+            BOT_MODE='webhook',
+            SHARD_INDEX=str(index),
+            SHARD_WORKERS='0',
+            WEBHOOK_LISTEN='127.0.0.1',
+            WEBHOOK_PORT=str(self.base_port + index),
+            WEBHOOK_SECRET=self.secret,
+            WEBHOOK_URL='',
+        )
+        script = os.path.abspath(sys.modules['__main__'].__file__)
+
+        logger.info("Starting shard worker %s on port %s", index, self.base_port + index)
+
+        return subprocess.Popen([sys.executable, script], env=env)
+
+    def start(self) -> None:
+        for index in range(self.count):
+            self._processes[index] = self._spawn(index)
+
+        self._supervisor.start()
+
+    def _supervise(self) -> None:
+        while not self._stopping.wait(1):
+            for index, process in list(self._processes.items()):
+                if process.poll() is not None and not self._stopping.is_set():
+                    logger.error("Shard worker %s exited with %s, restarting", index, process.returncode)
+                    self._processes[index] = self._spawn(index)
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+        for process in self._processes.values():
+            process.terminate()
+
+        for process in self._processes.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def shard_suffix() -> str:
+    """The suffix a worker appends to its per-shard storage paths; empty when not sharded."""
+    return f"_shard{SHARD_INDEX}" if SHARD_INDEX else ''
+
+
+def runs_global_jobs() -> bool:
+    """Whether this process runs the scheduled jobs that work on everyone's rows, e.g. the
+    usage rollups; with sharding only the first worker does, so they don't run concurrently."""
+    return SHARD_INDEX in ('', '0')
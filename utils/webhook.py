@@ -0,0 +1,289 @@
+import os
+import hmac
+import json
+import queue
+import asyncio
+import signal
+import logging
+import threading
+
+from typing import Callable
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from telegram import Update
+
+logger = logging.getLogger()
+
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN") if os.getenv("WEBHOOK_LISTEN") else '127.0.0.1'
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT")) if os.getenv("WEBHOOK_PORT") else 8443
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") if os.getenv("WEBHOOK_SECRET") else ''
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") if os.getenv("WEBHOOK_URL") else ''
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE")) if os.getenv("WEBHOOK_QUEUE_SIZE") else 1000
+# Only shared with the payment provider; Telegram knows WEBHOOK_SECRET from the webhook URL
+PAYMENT_SECRET = os.getenv("PAYMENT_SECRET") if os.getenv("PAYMENT_SECRET") else ''
+
+
+class UpdateIntake:
+    """A bounded queue between the HTTP server and whatever consumes the updates.
+
+    The server only ever calls `offer`, which never blocks; a single pump thread feeds the
+    queued payloads to `consumer` in arrival order. When the queue is full `offer` fails and
+    the server answers 503, so Telegram keeps the update and retries later.
+    """
+
+    def __init__(self, consumer: Callable[[dict], None], maxsize: int = WEBHOOK_QUEUE_SIZE) -> None:
+        self.consumer = consumer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self._thread = threading.Thread(target=self._pump, name='webhook-intake', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def offer(self, payload: dict) -> bool:
+        try:
+            self.queue.put_nowait(payload)
+        except queue.Full:
+            return False
+
+        return True
+
+    def _pump(self) -> None:
+        while True:
+            payload = self.queue.get()
+            if payload is None:
+                return
+
+            try:
+                self.consumer(payload)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error while consuming a webhook update.")
+
+    def stop(self) -> None:
+        """Let the pump finish what's queued, then stop it."""
+        self.queue.put(None)
+        self._thread.join()
+
+
+def dispatcher_consumer(dispatcher) -> Callable[[dict], None]:
+    """Build an intake consumer that decodes payloads and hands them to `dispatcher`."""
+    def consume(payload: dict) -> None:
+        update = Update.de_json(payload, dispatcher.bot)
+        dispatcher.process_update(update)
+
+    return consume
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Accepts updates POSTed to `/<secret>`; anything else is answered with 404."""
+
+    def initialize(self, intake, secret: str) -> None:
+        # pylint: disable=arguments-differ
+        self.intake = intake
+        self.secret = secret
+
+    def post(self, path_secret: str) -> None:
+        if not hmac.compare_digest(path_secret.encode(), self.secret.encode()):
+            raise tornado.web.HTTPError(404)
+
+        try:
+            payload = json.loads(self.request.body)
+        except ValueError as error:
+            raise tornado.web.HTTPError(400) from error
+
+        if not isinstance(payload, dict):
+            raise tornado.web.HTTPError(400)
+
+        if not self.intake.offer(payload):
+            logger.warning("Webhook intake queue is full, asking Telegram to retry.")
+            raise tornado.web.HTTPError(503)
+
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb) -> None:
+        # Requests with a wrong secret shouldn't show up as errors in the logs
+        if isinstance(value, tornado.web.HTTPError) and value.status_code in (400, 404):
+            return
+
+        super().log_exception(typ, value, tb)
+
+
+class PaymentCallbackHandler(tornado.web.RequestHandler):
+    """Accepts payment notifications POSTed as JSON to `/payments/<PAYMENT_SECRET>`.
+
+    Answers `{"credited": false}` for a payment that was already credited, so the payment
+    provider can retry until it gets a 200.
+    """
+
+    def initialize(self, payments: Callable[[dict], bool], secret: str) -> None:
+        # pylint: disable=arguments-differ
+        self.payments = payments
+        self.secret = secret
+
+    async def post(self, path_secret: str) -> None:
+        if not hmac.compare_digest(path_secret.encode(), self.secret.encode()):
+            raise tornado.web.HTTPError(404)
+
+        try:
+            payload = json.loads(self.request.body)
+        except ValueError as error:
+            raise tornado.web.HTTPError(400) from error
+
+        if not isinstance(payload, dict):
+            raise tornado.web.HTTPError(400)
+
+        try:
+            # The database work would otherwise block the loop that accepts updates
+            credited = await IOLoop.current().run_in_executor(None, self.payments, payload)
+        except (KeyError, TypeError, ValueError, ArithmeticError) as error:
+            raise tornado.web.HTTPError(400) from error
+
+        self.write({'credited': credited})
+
+    def log_exception(self, typ, value, tb) -> None:
+        if isinstance(value, tornado.web.HTTPError) and value.status_code in (400, 404):
+            return
+
+        super().log_exception(typ, value, tb)
+
+
+def payment_routes(payments: Callable[[dict], bool], payment_secret: str) -> list:
+    """The route of `PaymentCallbackHandler`, none while `payment_secret` isn't set."""
+    if not payment_secret:
+        logger.warning("PAYMENT_SECRET isn't set, payment callbacks won't be accepted.")
+        return []
+
+    return [(r"/payments/([^/]+)", PaymentCallbackHandler, dict(payments=payments, secret=payment_secret))]
+
+
+def make_webhook_app(
+    intake,
+    secret: str,
+    payments: Callable[[dict], bool] = None,
+    payment_secret: str = PAYMENT_SECRET
+) -> tornado.web.Application:
+    handlers = [(r"/([^/]+)", WebhookHandler, dict(intake=intake, secret=secret))]
+
+    if payments is not None:
+        if payment_secret and hmac.compare_digest(payment_secret.encode(), secret.encode()):
+            raise ValueError("PAYMENT_SECRET must differ from WEBHOOK_SECRET")
+
+        handlers.extend(payment_routes(payments, payment_secret))
+
+    return tornado.web.Application(handlers)
+
+
+class PaymentServer:
+    """Serves only the payment callbacks, for when updates are polled instead of POSTed.
+
+    The server runs on its own IO loop in a thread next to the updater; its port is bound
+    in `start`, so a port that's taken fails right away.
+
+    **Keyword arguments:**
+     - payments (callable) -- Credits the payments POSTed to `/payments/{payment_secret}`
+     - listen (str) -- The address to bind
+     - port (int) -- The port to bind
+     - payment_secret (str) -- The path segment the payment provider has to POST to
+    """
+
+    def __init__(
+        self,
+        payments: Callable[[dict], bool],
+        listen: str = WEBHOOK_LISTEN,
+        port: int = WEBHOOK_PORT,
+        payment_secret: str = PAYMENT_SECRET
+    ) -> None:
+        self.payments = payments
+        self.listen = listen
+        self.port = port
+        self.payment_secret = payment_secret
+        self._sockets = []
+        self._app = None
+        self._io_loop = None
+        self._loop_ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, name='payment-server', daemon=True)
+
+    def start(self) -> None:
+        routes = payment_routes(self.payments, self.payment_secret)
+        if not routes:
+            return
+
+        self._sockets = bind_sockets(self.port, address=self.listen)
+        self._app = tornado.web.Application(routes)
+        self._thread.start()
+        self._loop_ready.wait()
+        logger.info("Serving payment callbacks on %s:%s", self.listen, self.port)
+
+    def _serve(self) -> None:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self._io_loop = IOLoop.current()
+
+        server = HTTPServer(self._app)
+        server.add_sockets(self._sockets)
+        self._loop_ready.set()
+
+        self._io_loop.start()
+
+        server.stop()
+        self._io_loop.close(all_fds=True)
+
+    def stop(self) -> None:
+        if self._io_loop is None:
+            return
+
+        self._io_loop.add_callback(self._io_loop.stop)
+        self._thread.join()
+
+
+def serve_webhook(
+    intake,
+    bot=None,
+    listen: str = WEBHOOK_LISTEN,
+    port: int = WEBHOOK_PORT,
+    secret: str = WEBHOOK_SECRET,
+    webhook_url: str = WEBHOOK_URL,
+    payments: Callable[[dict], bool] = None,
+    payment_secret: str = PAYMENT_SECRET,
+) -> None:
+    """Serve updates over HTTP until SIGINT/SIGTERM.
+
+    Updates are accepted on `http://{listen}:{port}/{secret}`. When `webhook_url` is set,
+    the webhook is registered with Telegram as `{webhook_url}/{secret}`; put a TLS-terminating
+    proxy in front of the server for that.
+
+    **Keyword arguments:**
+     - intake (UpdateIntake) -- Receives the accepted update payloads, anything with
+       `start`, `offer` and `stop` works
+     - bot (Bot) -- Used to register the webhook with Telegram
+     - listen (str) -- The address to bind
+     - port (int) -- The port to bind
+     - secret (str) -- The path segment Telegram has to POST to
+     - webhook_url (str) -- The public base URL of the server
+     - payments (callable) -- Credits the payments POSTed to `/payments/{payment_secret}`, if given
+     - payment_secret (str) -- The path segment the payment provider has to POST to
+    """
+    if not secret:
+        raise ValueError("WEBHOOK_SECRET must be set to serve updates over a webhook")
+
+    intake.start()
+
+    server = make_webhook_app(intake, secret, payments, payment_secret).listen(port, address=listen)
+    logger.info("Serving webhook updates on %s:%s", listen, port)
+
+    if webhook_url and bot is not None:
+        bot.set_webhook(url=f"{webhook_url.rstrip('/')}/{secret}")
+
+    io_loop = IOLoop.current()
+
+    def stop(_signum, _frame) -> None:
+        io_loop.add_callback_from_signal(io_loop.stop)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    io_loop.start()
+
+    server.stop()
+    intake.stop()